@@ -0,0 +1,170 @@
+"""
+A per-worker cache of query results.
+
+Reading a query result from the Redshift result cache takes several Redis round
+trips (result_available, result_as_of, response_payload_data...). The results of
+global queries are also kept in each worker's memory, keyed by the query cache_key
+and tagged with their result_as_of, for up to QUERY_RESULT_CACHE_TTL seconds.
+Once an entry expires, only result_as_of is read again; the payload is re-read only
+when the result actually changed.
+
+Concurrent requests for the same expired (or missing) entry are coalesced: one
+thread loads it while the others wait for its result.
+"""
+import threading
+import time
+from calendar import timegm
+from collections import OrderedDict
+
+from django.conf import settings
+from django.http import HttpResponse
+
+
+class CachedQueryResult:
+	__slots__ = ("as_of", "content", "content_type", "expires")
+
+	def __init__(self, as_of, content, content_type, expires):
+		self.as_of = as_of
+		self.content = content
+		self.content_type = content_type
+		self.expires = expires
+
+	def __len__(self):
+		return len(self.content or "")
+
+	@property
+	def last_modified(self):
+		if self.as_of:
+			return timegm(self.as_of.utctimetuple())
+
+	def as_response(self):
+		return HttpResponse(content=self.content, content_type=self.content_type)
+
+
+class _Flight:
+	def __init__(self):
+		self.done = threading.Event()
+		self.result = None
+		self.failed = False
+
+
+class QueryResultCache:
+	def __init__(self, ttl=None, max_bytes=None, wait_timeout=10):
+		self._ttl = ttl
+		self._max_bytes = max_bytes
+		self.wait_timeout = wait_timeout
+		self.size = 0
+		self._entries = OrderedDict()
+		self._inflight = {}
+		self._lock = threading.Lock()
+
+	@property
+	def ttl(self):
+		if self._ttl is not None:
+			return self._ttl
+		return getattr(settings, "QUERY_RESULT_CACHE_TTL", 30)
+
+	@property
+	def max_bytes(self):
+		if self._max_bytes is not None:
+			return self._max_bytes
+		return getattr(settings, "QUERY_RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+
+	def __len__(self):
+		return len(self._entries)
+
+	def is_cacheable(self, parameterized_query):
+		return self.ttl > 0 and not parameterized_query.is_personalized
+
+	def get(self, parameterized_query, on_load=None):
+		"""
+		Returns a (CachedQueryResult, from_memory) tuple for parameterized_query.
+		The result is None if the query has no result available.
+
+		on_load(parameterized_query) is called whenever the entry is (re)loaded from
+		the result cache, eg. to schedule a refresh of stale results.
+		"""
+		key = parameterized_query.cache_key
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is not None and entry.expires > time.time():
+				self._entries.move_to_end(key)
+				return entry, True
+
+		return self._single_flight(
+			key, lambda: self._load(parameterized_query, entry, on_load)
+		), False
+
+	def evict(self, key):
+		with self._lock:
+			self._pop(key)
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self.size = 0
+
+	def _pop(self, key):
+		entry = self._entries.pop(key, None)
+		if entry is not None:
+			self.size -= len(entry)
+
+	def _load(self, parameterized_query, previous, on_load):
+		key = parameterized_query.cache_key
+		if not parameterized_query.result_available:
+			self.evict(key)
+			return None
+
+		if on_load:
+			on_load(parameterized_query)
+
+		as_of = parameterized_query.result_as_of
+		expires = time.time() + self.ttl
+		if previous is not None and previous.as_of == as_of:
+			entry = CachedQueryResult(as_of, previous.content, previous.content_type, expires)
+		else:
+			entry = CachedQueryResult(
+				as_of,
+				parameterized_query.response_payload_data,
+				parameterized_query.response_payload_type,
+				expires
+			)
+
+		with self._lock:
+			self._pop(key)
+			if len(entry) <= self.max_bytes:
+				self._entries[key] = entry
+				self.size += len(entry)
+			while self.size > self.max_bytes:
+				_, evicted = self._entries.popitem(last=False)
+				self.size -= len(evicted)
+
+		return entry
+
+	def _single_flight(self, key, func):
+		with self._lock:
+			flight = self._inflight.get(key)
+			leader = flight is None
+			if leader:
+				flight = self._inflight[key] = _Flight()
+
+		if not leader:
+			if flight.done.wait(self.wait_timeout) and not flight.failed:
+				return flight.result
+			# The leader failed or is too slow, load it ourselves
+			return func()
+
+		try:
+			flight.result = func()
+		except Exception:
+			flight.failed = True
+			raise
+		finally:
+			with self._lock:
+				del self._inflight[key]
+			flight.done.set()
+
+		return flight.result
+
+
+query_result_cache = QueryResultCache()
@@ -26,6 +26,7 @@ from hsreplaynet.features.decorators import view_requires_feature_access
 from hsreplaynet.utils import influx, log
 from hsreplaynet.utils.aws.redshift import get_redshift_query
 
+from .cache import query_result_cache
 from .processing import (
 	attempt_request_triggered_query_execution, evict_locks_cache,
 	get_concurrent_redshift_query_queue_semaphore
@@ -36,6 +37,7 @@ from .processing import (
 def evict_query_from_cache(request, name):
 	parameterized_query = _get_query_and_params(request, name)
 	parameterized_query.evict_cache()
+	query_result_cache.evict(parameterized_query.cache_key)
 
 	# Clear out any lingering dogpile locks on this query
 	evict_locks_cache(parameterized_query)
@@ -55,6 +57,7 @@ def evict_all_from_cache(request, name):
 def refresh_query_from_cache(request, name):
 	parameterized_query = _get_query_and_params(request, name)
 	parameterized_query.mark_stale()
+	query_result_cache.evict(parameterized_query.cache_key)
 
 	# Clear out any lingering dogpile locks on this query
 	evict_locks_cache(parameterized_query)
@@ -187,24 +190,27 @@ def fetch_query_results(request, name):
 		if issubclass(parameterized_query.__class__, HttpResponse):
 			return parameterized_query
 
-		last_modified = parameterized_query.result_as_of
-		if last_modified:
-			last_modified = timegm(last_modified.utctimetuple())
+		if query_result_cache.is_cacheable(parameterized_query):
+			response, last_modified = _fetch_cached_query_results(request, parameterized_query)
+		else:
+			last_modified = parameterized_query.result_as_of
+			if last_modified:
+				last_modified = timegm(last_modified.utctimetuple())
 
-		response = None
+			response = None
 
-		is_cache_hit = parameterized_query.result_available
-		if is_cache_hit:
-			_trigger_if_stale(parameterized_query)
-			# Try to return a minimal response
-			response = get_conditional_response(request, last_modified=last_modified)
+			is_cache_hit = parameterized_query.result_available
+			if is_cache_hit:
+				_trigger_if_stale(parameterized_query)
+				# Try to return a minimal response
+				response = get_conditional_response(request, last_modified=last_modified)
 
-		if not response:
-			if request.method == "HEAD":
-				response = HttpResponse(204)
-			else:
-				# Resort to a full response
-				response = _fetch_query_results(parameterized_query, user=request.user)
+			if not response:
+				if request.method == "HEAD":
+					response = HttpResponse(204)
+				else:
+					# Resort to a full response
+					response = _fetch_query_results(parameterized_query, user=request.user)
 
 		# Add Last-Modified header
 		if response.status_code in (200, 204, 304):
@@ -231,6 +237,58 @@ def fetch_query_results(request, name):
 	return response
 
 
+def _fetch_cached_query_results(request, parameterized_query):
+	"""
+	Serves a global query from the worker result cache.
+	Returns a (response, last_modified) tuple.
+	"""
+	result, from_memory = query_result_cache.get(
+		parameterized_query, on_load=_trigger_if_stale
+	)
+	if result is None:
+		# No result available yet, this will trigger the query as needed
+		last_modified = parameterized_query.result_as_of
+		if last_modified:
+			last_modified = timegm(last_modified.utctimetuple())
+		if request.method == "HEAD":
+			return HttpResponse(204), last_modified
+		return _fetch_query_results(parameterized_query, user=request.user), last_modified
+
+	response = get_conditional_response(request, last_modified=result.last_modified)
+	if not response:
+		if request.method == "HEAD":
+			response = HttpResponse(204)
+		else:
+			response = result.as_response()
+			_query_fetch_metric(
+				parameterized_query,
+				cache_populated=True,
+				cache_hit=True,
+				triggered_refresh=False,
+				worker_cache_hit=from_memory,
+			)
+
+	return response, result.last_modified
+
+
+def _query_fetch_metric(parameterized_query, **tags):
+	query_fetch_metric_fields = {
+		"count": 1,
+	}
+	query_fetch_metric_fields.update(
+		parameterized_query.supplied_non_filters_dict
+	)
+
+	influx.influx_sampled_metric(
+		"redshift_query_fetch",
+		query_fetch_metric_fields,
+		settings.REDSHIFT_QUERY_METRICS_SAMPLE_RATE,
+		query_name=parameterized_query.query_name,
+		**tags,
+		**parameterized_query.supplied_filters_dict
+	)
+
+
 @staff_member_required
 def fetch_local_query_results(request, name):
 	# This end point is intended only for administrator use.
@@ -285,21 +343,11 @@ def _fetch_query_results(parameterized_query, run_local=False, user=None, priori
 		triggered_refresh
 	))
 
-	query_fetch_metric_fields = {
-		"count": 1,
-	}
-	query_fetch_metric_fields.update(
-		parameterized_query.supplied_non_filters_dict
-	)
-
-	influx.influx_metric(
-		"redshift_query_fetch",
-		query_fetch_metric_fields,
+	_query_fetch_metric(
+		parameterized_query,
 		cache_populated=cache_is_populated,
 		cache_hit=is_cache_hit,
-		query_name=parameterized_query.query_name,
 		triggered_refresh=triggered_refresh,
-		**parameterized_query.supplied_filters_dict
 	)
 
 	return response
@@ -333,9 +381,10 @@ def _trigger_if_stale(parameterized_query, run_local=False, priority=None):
 		parameterized_query.supplied_non_filters_dict
 	)
 
-	influx.influx_metric(
+	influx.influx_sampled_metric(
 		"redshift_response_payload_staleness",
 		query_fetch_metric_fields,
+		settings.REDSHIFT_QUERY_METRICS_SAMPLE_RATE,
 		query_name=parameterized_query.query_name,
 		did_preschedule=did_preschedule,
 		**parameterized_query.supplied_filters_dict
@@ -480,9 +529,7 @@ class SingleClusterUpdateView(View):
 
 		class_cluster = cluster.class_cluster
 		# Changing external_id assignments affects CCP_signatures
-		# So call update_cluster_signatures() to recalculate
-		class_cluster.update_cluster_signatures()
-		for cluster in class_cluster.clusters:
-			cluster.save()
+		# So call save_cluster_signatures() to recalculate
+		class_cluster.save_cluster_signatures()
 
 		return JsonResponse({"msg": "OKAY"}, status=200)
@@ -1,6 +1,6 @@
 from rest_framework import permissions
 
-from hsreplaynet.features.models import Feature
+from hsreplaynet.features.utils import feature_enabled_for_user
 
 
 class IsOwnerOrStaff(permissions.BasePermission):
@@ -41,8 +41,7 @@ class BaseUserHasFeature(permissions.BasePermission):
 	def has_permission(self, request, view):
 		if request.user.is_staff:
 			return True
-		feature = Feature.objects.get(name=self.FEATURE)
-		return feature.enabled_for_user(request.user)
+		return feature_enabled_for_user(self.FEATURE, request.user)
 
 
 def UserHasFeature(feature_name):
@@ -1,12 +1,13 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from djpaypal.models import webhooks as djpaypal_webhooks
+from djpaypal.models import BillingPlan, webhooks as djpaypal_webhooks
 from djstripe import webhooks as djstripe_webhooks
+from djstripe.models import Plan
 
 from hsreplaynet.analytics.processing import enable_premium_accounts_for_users_in_redshift
 from hsreplaynet.utils.instrumentation import error_handler
 
-from .utils import check_for_referrals
+from .utils import check_for_referrals, invalidate_plan_catalogue
 
 
 @djstripe_webhooks.handler("customer.subscription.created")
@@ -40,3 +41,11 @@ def on_paypal_webhook_error(sender, instance, **kwargs):
 			raise Exception("%s - %s" % (instance.exception, instance.id))
 		except Exception as e:
 			error_handler(e)
+
+
+@receiver(post_save, sender=Plan)
+@receiver(post_delete, sender=Plan)
+@receiver(post_save, sender=BillingPlan)
+@receiver(post_delete, sender=BillingPlan)
+def on_plan_change(sender, instance, **kwargs):
+	invalidate_plan_catalogue()
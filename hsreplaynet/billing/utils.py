@@ -1,11 +1,14 @@
+import time
 from datetime import timedelta
 
 from django.conf import settings
 from django.utils import timezone
 from django_reflinks.models import ReferralHit
-from djpaypal.models import WebhookEvent
-from djstripe.models import Event
-from djstripe.settings import _get_idempotency_key
+from djpaypal.models import BillingPlan, WebhookEvent
+from djpaypal.settings import PAYPAL_LIVE_MODE
+from djstripe.enums import SubscriptionStatus
+from djstripe.models import Event, Plan
+from djstripe.settings import STRIPE_LIVE_MODE, _get_idempotency_key
 
 from .models import Referral
 
@@ -102,3 +105,61 @@ def user_subscription_events_count(user) -> int:
 	paypal_events = user_paypal_subscribe_events(user)
 
 	return len(stripe_events) + len(paypal_events)
+
+
+_plan_catalogue = {}
+
+
+def get_plan_catalogue():
+	"""
+	Returns the Stripe and PayPal premium plans, as a {context name: plan} dict.
+
+	The catalogue is cached per process, for up to PLAN_CATALOGUE_TTL seconds. It is
+	dropped whenever a plan is saved or deleted (see billing.signals).
+	"""
+	ttl = getattr(settings, "PLAN_CATALOGUE_TTL", 300)
+	cached = _plan_catalogue.get("plans")
+	if cached is None or time.time() - cached[1] > ttl:
+		stripe_plans = {
+			plan.stripe_id: plan for plan in Plan.objects.filter(
+				livemode=STRIPE_LIVE_MODE,
+				stripe_id__in=(settings.MONTHLY_PLAN_ID, settings.SEMIANNUAL_PLAN_ID)
+			)
+		}
+		paypal_plans = {
+			plan.id: plan for plan in BillingPlan.objects.filter(
+				livemode=PAYPAL_LIVE_MODE,
+				id__in=(settings.PAYPAL_MONTHLY_PLAN_ID, settings.PAYPAL_SEMIANNUAL_PLAN_ID)
+			)
+		}
+		plans = {
+			"stripe_monthly_plan": stripe_plans.get(settings.MONTHLY_PLAN_ID),
+			"stripe_semiannual_plan": stripe_plans.get(settings.SEMIANNUAL_PLAN_ID),
+			"paypal_monthly_plan": paypal_plans.get(settings.PAYPAL_MONTHLY_PLAN_ID),
+			"paypal_semiannual_plan": paypal_plans.get(settings.PAYPAL_SEMIANNUAL_PLAN_ID),
+		}
+		cached = (plans, time.time())
+		_plan_catalogue["plans"] = cached
+
+	return cached[0]
+
+
+def invalidate_plan_catalogue():
+	_plan_catalogue.clear()
+
+
+def user_has_subscription_past_due(user) -> bool:
+	"""
+	Returns whether the user has a past due Stripe subscription.
+	The result is memoized on the user object (ie. for the current request).
+	"""
+	if not user.is_authenticated:
+		return False
+
+	if not hasattr(user, "_has_subscription_past_due"):
+		customer = user.stripe_customer
+		user._has_subscription_past_due = bool(customer) and customer.subscriptions.filter(
+			status=SubscriptionStatus.past_due
+		).exists()
+
+	return user._has_subscription_past_due
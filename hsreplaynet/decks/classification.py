@@ -0,0 +1,189 @@
+"""
+Batch archetype classification.
+
+The live signature weights of a (game format, player class) are loaded into a dense
+archetypes x dbf_ids matrix, so that a whole batch of decks is scored with a single
+matrix product: the score of an archetype is the sum of the weights of the signature
+cards in the deck, multiplied by their count, and the best scoring archetype wins
+(the first one on ties). This matches hsarchetypes.classify_deck(), which
+tests/test_archetype_classification.py checks, and which is still used one deck at a
+time when the matrix holds no signature cards.
+
+Signature weights are versioned by the id of the live cluster set and a digest of
+the signatures of its clusters. They are cached per version, both in a per-process
+LRU and in the shared cache (ARCHETYPE_SIGNATURES_CACHE), so the signature tables are
+only queried once per version for the whole cluster. The live versions are kept in
+the shared cache for up to SIGNATURE_VERSION_CACHE_TTL seconds, and each process
+checks them at most every SIGNATURE_VERSION_TTL seconds. Promoting a cluster set or
+saving new signatures (see ClusterSetSnapshot.update_archetype_signatures() and
+ClassClusterSnapshot.save_cluster_signatures()) drops the shared versions, so that
+they are computed again.
+"""
+import collections
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from hearthstone.enums import CardClass, FormatType
+from hsarchetypes import classify_deck
+
+
+SIGNATURE_VERSION_TTL = 60
+SIGNATURE_VERSION_CACHE_TTL = 3600
+SIGNATURE_WEIGHTS_CACHE_TTL = 86400 * 7
+SIGNATURE_WEIGHTS_LRU_SIZE = 64
+
+
+class SignatureMatrix:
+	def __init__(self, signature_weights, version=None):
+		self.version = version
+		self.signature_weights = signature_weights
+		self.archetype_ids = list(signature_weights.keys())
+		dbf_ids = sorted(set(
+			int(dbf_id) for weights in signature_weights.values() for dbf_id in weights
+		))
+		self.columns = {dbf_id: column for column, dbf_id in enumerate(dbf_ids)}
+		self.weights = np.zeros((len(self.archetype_ids), len(dbf_ids)))
+		for row, archetype_id in enumerate(self.archetype_ids):
+			for dbf_id, weight in signature_weights[archetype_id].items():
+				self.weights[row, self.columns[int(dbf_id)]] = weight
+
+	def __len__(self):
+		return len(self.archetype_ids)
+
+	def vectorize(self, dbf_maps):
+		"""Returns a decks x dbf_ids matrix of the count of each card in each deck"""
+		decks = np.zeros((len(dbf_maps), len(self.columns)))
+		for row, dbf_map in enumerate(dbf_maps):
+			for dbf_id, count in dbf_map.items():
+				column = self.columns.get(int(dbf_id))
+				if column is not None:
+					decks[row, column] = count
+		return decks
+
+	def scores(self, dbf_maps):
+		"""Returns a decks x archetypes matrix of the score of each archetype"""
+		return self.vectorize(dbf_maps).dot(self.weights.T)
+
+	def classify(self, dbf_maps):
+		"""
+		Returns the archetype id of each deck (a {dbf_id: count} dict) in dbf_maps,
+		or None for the decks which do not match any signature.
+		"""
+		if not self.archetype_ids:
+			return [None] * len(dbf_maps)
+
+		if not self.columns:
+			return [classify_deck(dbf_map, self.signature_weights) for dbf_map in dbf_maps]
+
+		scores = self.scores(dbf_maps)
+		best = scores.argmax(axis=1)
+		return [
+			self.archetype_ids[column] if scores[row, column] > 0 else None
+			for row, column in enumerate(best)
+		]
+
+
+def get_shared_cache():
+	return caches[getattr(settings, "ARCHETYPE_SIGNATURES_CACHE", "default")]
+
+
+def _version_cache_key(game_format):
+	return "ARCHETYPE_SIGNATURES:VERSION:%i" % (int(game_format))
+
+
+def _weights_cache_key(version, game_format, player_class):
+	return "ARCHETYPE_SIGNATURES:%s:%i:%i" % (version, int(game_format), int(player_class))
+
+
+_live_versions = {}
+
+
+def get_live_signature_version(game_format):
+	"""
+	Returns the version of the signatures live for game_format, as a
+	"<cluster set id>:<signatures digest>" string, or None if no cluster set is live.
+	"""
+	from hsreplaynet.decks.models import ClusterSetSnapshot, ClusterSnapshot
+
+	game_format = FormatType(int(game_format))
+	version, checked = _live_versions.get(game_format, (None, 0))
+	if time.time() - checked <= SIGNATURE_VERSION_TTL:
+		return version
+
+	cache = get_shared_cache()
+	cache_key = _version_cache_key(game_format)
+	version = cache.get(cache_key)
+	if version is None:
+		cluster_set_id = ClusterSetSnapshot.objects.filter(
+			live_in_production=True, game_format=game_format
+		).values_list("id", flat=True).first()
+		if cluster_set_id:
+			digest = ClusterSnapshot.objects.get_signatures_digest(cluster_set_id)
+			version = "%i:%s" % (cluster_set_id, digest)
+			cache.set(cache_key, version, SIGNATURE_VERSION_CACHE_TTL)
+
+	_live_versions[game_format] = (version, time.time())
+	return version
+
+
+_signature_weights = collections.OrderedDict()
+
+
+def get_signature_weights(game_format, player_class):
+	"""
+	Returns the {archetype_id: {dbf_id: weight}} signature weights live for
+	game_format and player_class, and their version.
+	"""
+	from hsreplaynet.decks.models import ClusterSnapshot
+
+	version = get_live_signature_version(game_format)
+	if version is None:
+		return {}, None
+
+	key = (version, FormatType(int(game_format)), CardClass(int(player_class)))
+	if key in _signature_weights:
+		_signature_weights.move_to_end(key)
+		return _signature_weights[key], version
+
+	cache = get_shared_cache()
+	cache_key = _weights_cache_key(*key)
+	signature_weights = cache.get(cache_key)
+	if signature_weights is None:
+		cluster_set_id = int(version.split(":")[0])
+		signature_weights = ClusterSnapshot.objects.get_signature_weights(
+			game_format, player_class, cluster_set_id=cluster_set_id
+		)
+		cache.set(cache_key, signature_weights, SIGNATURE_WEIGHTS_CACHE_TTL)
+
+	_signature_weights[key] = signature_weights
+	while len(_signature_weights) > SIGNATURE_WEIGHTS_LRU_SIZE:
+		_signature_weights.popitem(last=False)
+
+	return signature_weights, version
+
+
+_signature_matrices = {}
+
+
+def get_signature_matrix(game_format, player_class):
+	key = (FormatType(int(game_format)), CardClass(int(player_class)))
+	signature_weights, version = get_signature_weights(*key)
+	signature_matrix = _signature_matrices.get(key)
+	if signature_matrix is None or signature_matrix.version != version:
+		signature_matrix = SignatureMatrix(signature_weights, version=version)
+		_signature_matrices[key] = signature_matrix
+
+	return signature_matrix
+
+
+def invalidate_signature_weights():
+	"""Makes every process read the live signature versions again."""
+	get_shared_cache().delete_many([_version_cache_key(f) for f in FormatType])
+	_live_versions.clear()
+
+
+def classify_decks(game_format, player_class, dbf_maps):
+	"""Returns the archetype id (or None) of each {dbf_id: count} dict in dbf_maps"""
+	return get_signature_matrix(game_format, player_class).classify(dbf_maps)
@@ -0,0 +1,144 @@
+"""
+A journal of the archetype changes of decks.
+
+Archetype changes are replicated into Redshift through the archetype Firehose
+stream, as "deck_id|archetype_id|as_of" lines. Rather than sending one record per
+change, changes are journaled and sent with put_record_batch.
+
+Changes made within a transaction are only journaled once it commits, and are
+forgotten if it is rolled back. The journal is flushed when such a transaction
+commits, whenever it holds a full batch, at the end of each web request, when a
+Lambda invocation returns and when the process exits.
+"""
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import connection, transaction
+from django.dispatch.dispatcher import receiver
+from django.utils.timezone import now
+
+from hsreplaynet.utils import log
+from hsreplaynet.utils.aws.clients import FIREHOSE
+from hsreplaynet.utils.influx import influx_metric
+
+
+# The maximum number of records and bytes of a put_record_batch call
+MAX_BATCH_SIZE = 500
+MAX_BATCH_BYTES = 4 * 1024 * 1024
+
+MAX_ATTEMPTS = 3
+
+
+class ArchetypeChangeJournal:
+	def __init__(self, stream_name=None, batch_size=MAX_BATCH_SIZE, max_workers=8):
+		self._stream_name = stream_name
+		self.batch_size = batch_size
+		self.max_workers = max_workers
+		self.records = []
+		self._lock = threading.Lock()
+		self._last_uncommitted = 0
+
+	def __len__(self):
+		return len(self.records)
+
+	@property
+	def stream_name(self):
+		return self._stream_name or settings.ARCHETYPE_FIREHOSE_STREAM_NAME
+
+	def record(self, deck_id, archetype_id, as_of=None):
+		self.record_many([(deck_id, archetype_id)], as_of=as_of)
+
+	def record_many(self, changes, as_of=None):
+		"""Journals an iterable of (deck_id, archetype_id) changes"""
+		timestamp = (as_of or now().replace(tzinfo=None)).isoformat(sep=" ")
+		records = [
+			"%s|%s|%s\n" % (deck_id, archetype_id or "", timestamp)
+			for deck_id, archetype_id in changes
+		]
+
+		if connection.in_atomic_block:
+			with self._lock:
+				self._last_uncommitted += 1
+				token = self._last_uncommitted
+			transaction.on_commit(lambda: self._append(records, token))
+		else:
+			self._append(records)
+
+	def _append(self, records, token=None):
+		with self._lock:
+			self.records += records
+			full = len(self.records) >= self.batch_size
+			last = token is not None and token == self._last_uncommitted
+
+		# Flush once the last change of the committed transaction has been journaled
+		if full or last:
+			self.flush()
+
+	def flush(self):
+		"""Sends all the journaled records, up to max_workers batches at a time."""
+		with self._lock:
+			records, self.records = self.records, []
+
+		batches = list(self._batches(records))
+		if len(batches) < 2 or self.max_workers < 2:
+			for batch in batches:
+				self._put_record_batch(batch)
+			return
+
+		with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+			# Consume the results to surface any exception
+			list(executor.map(self._put_record_batch, batches))
+
+	def _batches(self, records):
+		batch, batch_bytes = [], 0
+		for record in records:
+			record_bytes = len(record.encode("utf-8"))
+			if len(batch) >= self.batch_size or batch_bytes + record_bytes > MAX_BATCH_BYTES:
+				yield batch
+				batch, batch_bytes = [], 0
+			batch.append(record)
+			batch_bytes += record_bytes
+
+		if batch:
+			yield batch
+
+	def _put_record_batch(self, records):
+		attempt = 0
+		while records and attempt < MAX_ATTEMPTS:
+			attempt += 1
+			try:
+				result = FIREHOSE.put_record_batch(
+					DeliveryStreamName=self.stream_name,
+					Records=[{"Data": record.encode("utf-8")} for record in records]
+				)
+			except Exception as e:
+				log.exception("Exception while flushing the archetype journal: %r", e)
+				continue
+
+			records = [
+				record for record, response in zip(records, result["RequestResponses"])
+				if "ErrorCode" in response
+			]
+
+		if records:
+			log.warning("Dropping %i archetype changes after %i attempts", len(records), attempt)
+			influx_metric("archetype_journal_failures", {"count": len(records)})
+
+
+archetype_journal = ArchetypeChangeJournal()
+
+
+def flush_archetype_journal():
+	if FIREHOSE is not None and len(archetype_journal):
+		archetype_journal.flush()
+
+
+@receiver(request_finished)
+def flush_archetype_journal_on_request_finished(sender, **kwargs):
+	flush_archetype_journal()
+
+
+atexit.register(flush_archetype_journal)
@@ -1,5 +1,6 @@
 import json
 import time
+from collections import defaultdict
 from datetime import date, timedelta
 
 import redis
@@ -64,6 +65,9 @@ AND p.game_date BETWEEN :start_date AND :end_date
 )
 
 
+OBSERVATION_BATCH_SIZE = 1000
+
+
 class Command(BaseCommand):
 	def add_arguments(self, parser):
 		parser.add_argument("--redis_host", nargs=1)
@@ -84,9 +88,8 @@ class Command(BaseCommand):
 		redis_host = options["redis_host"]
 		if redis_host:
 			redis_client = redis.StrictRedis(host=redis_host[0])
-			pipeline = redis_client.pipeline(transaction=False)
 		else:
-			pipeline = None
+			redis_client = None
 
 		params = {
 			"start_date": start_ts,
@@ -94,6 +97,11 @@ class Command(BaseCommand):
 		}
 		compiled_statement = REDSHIFT_QUERY.params(params).compile(bind=conn)
 		start_ts = time.time()
+
+		# Observations are grouped by tree and flushed with observe_many()
+		trees = {}
+		observations = defaultdict(list)
+		pending = 0
 		for row in conn.execute(compiled_statement):
 			as_of = row["match_start"]
 			deck_id = row["deck_id"]
@@ -102,25 +110,30 @@ class Command(BaseCommand):
 			format = FormatType.FT_STANDARD if row["game_type"] == 2 else FormatType.FT_WILD
 			played_cards = json.loads(row["played_cards"])
 
-			tree = deck_prediction_tree(player_class, format, redis_client=pipeline)
+			if (player_class, format) not in trees:
+				trees[(player_class, format)] = deck_prediction_tree(
+					player_class, format, redis_client=redis_client
+				)
+			tree = trees[(player_class, format)]
 			min_played_cards = tree.max_depth - 1
 			played_card_dbfs = played_cards[:min_played_cards]
 			deck_size = sum(dbf_map.values())
 
 			if deck_size == 30:
-				tree.observe(
-					deck_id,
-					dbf_map,
-					played_card_dbfs,
-					as_of=as_of
-				)
+				observations[tree].append((deck_id, dbf_map, played_card_dbfs, as_of))
+				pending += 1
 
-			if len(pipeline) >= 8000:
-				pipeline.execute()
+			if pending >= OBSERVATION_BATCH_SIZE:
+				self.flush(observations)
+				pending = 0
 
-		if len(pipeline):
-			pipeline.execute()
+		self.flush(observations)
 
 		end_ts = time.time()
 		duration_seconds = round(end_ts - start_ts)
 		print("Took: %i Seconds" % duration_seconds)
+
+	def flush(self, observations):
+		for tree, tree_observations in observations.items():
+			tree.observe_many(tree_observations)
+		observations.clear()
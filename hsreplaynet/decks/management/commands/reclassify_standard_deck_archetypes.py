@@ -1,16 +1,17 @@
 import json
 import math
 import time
+from collections import defaultdict
 from datetime import date, datetime, timedelta
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
 from hearthstone.enums import CardClass, FormatType
-from hsarchetypes import classify_deck
 from sqlalchemy import Date, Integer, String
 from sqlalchemy.sql import bindparam, text
 
-from hsreplaynet.decks.models import Archetype, ClusterSnapshot, Deck
+from hsreplaynet.decks.classification import get_signature_matrix
+from hsreplaynet.decks.models import Archetype, Deck
 from hsreplaynet.utils.aws import redshift
 from hsreplaynet.utils.aws.clients import FIREHOSE
 
@@ -63,11 +64,12 @@ class Command(BaseCommand):
 		self.db_archetypes_to_update = {}
 		self.firehose_buffer = []
 		self.timestamp = datetime.now().isoformat(sep=" ")
-		self.signature_weights = {
+		self.signature_matrices = {
 			FormatType.FT_WILD: {},
 			FormatType.FT_STANDARD: {},
 		}
 		self.firehose_batch_size = 500
+		self.classification_batch_size = 10000
 		super().__init__(*args, **kwargs)
 
 	def add_arguments(self, parser):
@@ -98,25 +100,10 @@ class Command(BaseCommand):
 				for a in Archetype.objects.live().filter(player_class=card_class):
 					self.archetype_map[a.id] = a
 
-				# Standard Signature Weights
-				standard_weight_values = ClusterSnapshot.objects.get_signature_weights(
-					FormatType.FT_STANDARD,
-					card_class
-				)
-				if len(standard_weight_values):
-					self.signature_weights[
-						FormatType.FT_STANDARD
-					][card_class] = standard_weight_values
-
-				# Wild Signature Weights
-				wild_weight_values = ClusterSnapshot.objects.get_signature_weights(
-					FormatType.FT_WILD,
-					card_class
-				)
-				if len(wild_weight_values):
-					self.signature_weights[
-						FormatType.FormatType.FT_WILD
-					][card_class] = wild_weight_values
+				for format in (FormatType.FT_STANDARD, FormatType.FT_WILD):
+					signature_matrix = get_signature_matrix(format, card_class)
+					if len(signature_matrix):
+						self.signature_matrices[format][card_class] = signature_matrix
 
 		result_set = list(conn.execute(compiled_statement))
 		total_rows = len(result_set)
@@ -124,17 +111,55 @@ class Command(BaseCommand):
 		if is_dry_run:
 			self.stdout.write("Dry run, will not flush to databases")
 
+		new_archetype_ids = self.classify_rows(result_set)
+
 		for counter, row in enumerate(result_set):
 			deck_id = row["deck_id"]
 			if not is_dry_run and counter % 100000 == 0:
 				self.flush_db_buffer()
 				self.flush_firehose_buffer()
 
+			if counter not in new_archetype_ids:
+				continue
+
+			current_archetype_id = row["archetype_id"]
+			new_archetype_id = new_archetype_ids[counter]
+
+			if new_archetype_id == current_archetype_id:
+				if verbosity > 1:
+					self.stdout.write("Deck %r - Nothing to do." % (deck_id))
+				continue
+
+			current_name = self.get_archetype_name(current_archetype_id)
+			new_name = self.get_archetype_name(new_archetype_id)
+
+			pct_complete = str(math.floor(100.0 * counter / total_rows))
+
+			self.stdout.write("\t[%s%%] Reclassifying deck %r: %s => %s\n" % (
+				pct_complete, deck_id, current_name, new_name
+			))
+
+			if not is_dry_run:
+				self.buffer_archetype_update(deck_id, new_archetype_id)
+
+		if not is_dry_run:
+			self.flush_db_buffer()
+			self.flush_firehose_buffer()
+		else:
+			self.stdout.write("Dry run complete")
+
+	def classify_rows(self, result_set):
+		"""
+		Returns a {row index: archetype id} dict for the rows which can be classified.
+		The decks of each format and player class are scored in batches.
+		"""
+		pending = defaultdict(list)
+		for counter, row in enumerate(result_set):
+			deck_id = row["deck_id"]
 			if deck_id is None:
 				self.stderr.write("Got deck_id %r ... skipping" % (deck_id))
 				continue
 
-			current_archetype_id = row["archetype_id"]
 			player_class = CardClass(row["player_class"])
 			if player_class == CardClass.NEUTRAL:
 				# Most likely noise
@@ -142,39 +167,25 @@ class Command(BaseCommand):
 				continue
 			format = FormatType.FT_STANDARD if row["game_type"] == 2 else FormatType.FT_WILD
 
-			dbf_map = {dbf_id: count for dbf_id, count in json.loads(row["deck_list"])}
-			if player_class not in self.signature_weights[format]:
+			if player_class not in self.signature_matrices[format]:
 				raise RuntimeError(
 					"%r not found for %r. Are signatures present?" % (player_class, format)
 				)
 
-			if self.signature_weights[format][player_class]:
-				new_archetype_id = classify_deck(
-					dbf_map, self.signature_weights[format][player_class]
-				)
-
-				if new_archetype_id == current_archetype_id:
-					if verbosity > 1:
-						self.stdout.write("Deck %r - Nothing to do." % (deck_id))
-					continue
-
-				current_name = self.get_archetype_name(current_archetype_id)
-				new_name = self.get_archetype_name(new_archetype_id)
-
-				pct_complete = str(math.floor(100.0 * counter / total_rows))
-
-				self.stdout.write("\t[%s%%] Reclassifying deck %r: %s => %s\n" % (
-					pct_complete, deck_id, current_name, new_name
-				))
-
-				if not is_dry_run:
-					self.buffer_archetype_update(deck_id, new_archetype_id)
-
-		if not is_dry_run:
-			self.flush_db_buffer()
-			self.flush_firehose_buffer()
-		else:
-			self.stdout.write("Dry run complete")
+			dbf_map = {dbf_id: count for dbf_id, count in json.loads(row["deck_list"])}
+			pending[(format, player_class)].append((counter, dbf_map))
+
+		ret = {}
+		batch_size = self.classification_batch_size
+		for (format, player_class), rows in pending.items():
+			signature_matrix = self.signature_matrices[format][player_class]
+			for i in range(0, len(rows), batch_size):
+				batch = rows[i:i + batch_size]
+				archetype_ids = signature_matrix.classify([dbf_map for _, dbf_map in batch])
+				for (counter, _), archetype_id in zip(batch, archetype_ids):
+					ret[counter] = archetype_id
+
+		return ret
 
 	def buffer_archetype_update(self, deck_id, new_archetype_id):
 		if new_archetype_id not in self.db_archetypes_to_update:
@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 from hearthstone.enums import FormatType
 
+from hsreplaynet.decks.journal import flush_archetype_journal
 from hsreplaynet.decks.models import Archetype, Deck
 
 
@@ -24,3 +25,5 @@ class Command(BaseCommand):
 					deck.sync_archetype_to_firehose()
 				if counter % 1000 == 0:
 					print("Counter: %i" % counter)
+
+		flush_archetype_journal()
@@ -3,6 +3,7 @@ import hashlib
 import json
 import os
 import string
+import threading
 import time
 
 from django.conf import settings
@@ -18,21 +19,45 @@ from django.utils.timezone import now
 from django_hearthstone.cards.models import Card
 from django_intenum import IntEnumField
 from hearthstone import deckstrings, enums
-from hsarchetypes import classify_deck
 from hsarchetypes.clustering import ClassClusters, Cluster, ClusterSet, create_cluster_set
 from shortuuid.main import int_to_string, string_to_int
 
 from hsreplaynet.utils import card_db, log
 from hsreplaynet.utils.aws import s3_object_exists
-from hsreplaynet.utils.aws.clients import FIREHOSE, LAMBDA, S3
+from hsreplaynet.utils.aws.clients import LAMBDA, S3
 from hsreplaynet.utils.aws.redshift import get_redshift_query
+from hsreplaynet.utils.cards import bump_card_data_version, get_card
 from hsreplaynet.utils.db import dictfetchall
 from hsreplaynet.utils.influx import influx_metric, influx_timer
 
+from .classification import classify_decks, invalidate_signature_weights
+from .journal import archetype_journal
+
 
 ALPHABET = string.ascii_letters + string.digits
 
 
+# Resolves a batch of decks through get_or_create_deck() in a single statement.
+# Decks created by the function are not visible to the outer query's snapshot, so
+# their columns are taken from the function's result; archetype and guessed full
+# deck are always NULL for those anyway.
+GET_OR_CREATE_DECKS_QUERY = """
+	SELECT
+		r.deck_id AS id,
+		r.digest,
+		COALESCE(cd.created, r.deck_creation_ts::timestamptz) AS created,
+		COALESCE(cd.size, r.deck_size) AS size,
+		cd.archetype_id,
+		cd.guessed_full_deck_id,
+		r.created AS was_created,
+		v.idx
+	FROM (VALUES {values}) AS v(idx, id_list)
+	CROSS JOIN LATERAL get_or_create_deck(v.id_list) r
+	LEFT JOIN cards_deck cd ON cd.id = r.deck_id
+	ORDER BY v.idx;
+"""
+
+
 class DeckManager(models.Manager):
 	def get_or_create_from_id_list(
 		self,
@@ -41,39 +66,76 @@ class DeckManager(models.Manager):
 		game_type=None,
 		classify_archetype=False
 	):
-		deck, created = self._get_or_create_deck_from_db(id_list)
-
-		archetypes_enabled = settings.ARCHETYPE_CLASSIFICATION_ENABLED
-		archetype_missing = deck.archetype_id is None
-		full_deck = deck.size == 30
-		if archetypes_enabled and classify_archetype and archetype_missing and full_deck:
-			player_class = self._convert_hero_id_to_player_class(hero_id)
-			deck.classify_into_archetype(player_class)
+		return self.get_or_create_many(
+			[id_list],
+			hero_ids=[hero_id],
+			game_type=game_type,
+			classify_archetype=classify_archetype
+		)[0]
+
+	def get_or_create_many(
+		self,
+		id_lists,
+		hero_ids=None,
+		game_type=None,
+		classify_archetype=False
+	):
+		"""
+		Returns a (deck, created) tuple for each list of card ids in id_lists, in
+		the same order. All the non-empty decks are fetched or created in a single
+		round trip to the database; identical lists resolve to the same instance.
+		"""
+		results = self._get_or_create_decks_from_db(id_lists)
 
-		return deck, created
+		if hero_ids is None:
+			hero_ids = [None] * len(id_lists)
 
-	def _get_or_create_deck_from_db(self, id_list):
-		if not id_list:
-			# Empty list; not supported by our db function
+		archetypes_enabled = settings.ARCHETYPE_CLASSIFICATION_ENABLED
+		for (deck, created), hero_id in zip(results, hero_ids):
+			archetype_missing = deck.archetype_id is None
+			full_deck = deck.size == 30
+			if archetypes_enabled and classify_archetype and archetype_missing and full_deck:
+				player_class = self._convert_hero_id_to_player_class(hero_id)
+				deck.classify_into_archetype(player_class)
+
+		return results
+
+	def _get_or_create_decks_from_db(self, id_lists):
+		results = [None] * len(id_lists)
+		pending = collections.OrderedDict()
+		for i, id_list in enumerate(id_lists):
 			digest = generate_digest_from_deck_list(id_list)
-			return Deck.objects.get_or_create(digest=digest)
+			if not id_list:
+				# Empty list; not supported by our db function
+				results[i] = Deck.objects.get_or_create(digest=digest)
+			else:
+				pending.setdefault(digest, []).append(i)
+
+		if not pending:
+			return results
 
 		# This native implementation in the DB is to reduce the volume
 		# of DB chatter between Lambdas and the DB
-		cursor = connection.cursor()
-		cursor.callproc("get_or_create_deck", (id_list, ))
-		result_row = cursor.fetchone()
-		deck_id = int(result_row[0])
-		created_ts, digest, created, deck_size = result_row[1:]
-		cursor.close()
-		d = Deck.objects.get(id=deck_id)
-		return d, created
+		indexes = list(pending.values())
+		values = ", ".join(["(%s, %s::text[])"] * len(indexes))
+		params = []
+		for idx, deck_indexes in enumerate(indexes):
+			params += [idx, list(id_lists[deck_indexes[0]])]
+
+		query = GET_OR_CREATE_DECKS_QUERY.format(values=values)
+		for deck in self.raw(query, params):
+			deck_indexes = indexes[deck.idx]
+			results[deck_indexes[0]] = (deck, deck.was_created)
+			for i in deck_indexes[1:]:
+				results[i] = (deck, False)
+
+		return results
 
 	def _convert_hero_id_to_player_class(self, hero_id):
 		if isinstance(hero_id, int):
-			return Card.objects.get(dbf_id=hero_id).card_class
+			return get_card(dbf_id=hero_id).card_class
 		elif hero_id:
-			return Card.objects.get(card_id=hero_id).card_class
+			return get_card(card_id=hero_id).card_class
 		return enums.CardClass.INVALID
 
 	def bulk_update_to_archetype(self, deck_ids, archetype):
@@ -83,39 +145,52 @@ class DeckManager(models.Manager):
 			archetype_id = archetype
 
 		timestamp = now().replace(tzinfo=None)
-		record_batch = []
 		id_batch = []
 		for deck_id in deck_ids:
-			record = "{deck_id}|{archetype_id}|{as_of}\n".format(
-				deck_id=str(deck_id),
-				archetype_id=str(archetype_id or ""),
-				as_of=timestamp.isoformat(sep=" "),
-			)
-			record_batch.append(record)
+			archetype_journal.record(deck_id, archetype_id, as_of=timestamp)
 			id_batch.append(deck_id)
 
-			if len(record_batch) >= 100:
-				full_record = "".join(record_batch)
-				FIREHOSE.put_record(
-					DeliveryStreamName=settings.ARCHETYPE_FIREHOSE_STREAM_NAME,
-					Record={
-						"Data": full_record.encode("utf-8"),
-					}
-				)
+			if len(id_batch) >= 100:
 				Deck.objects.filter(id__in=id_batch).update(archetype_id=archetype_id)
-				record_batch = []
 				id_batch = []
 
-		if len(record_batch):
-			full_record = "".join(record_batch)
-			FIREHOSE.put_record(
-				DeliveryStreamName=settings.ARCHETYPE_FIREHOSE_STREAM_NAME,
-				Record={
-					"Data": full_record.encode("utf-8"),
-				}
-			)
+		if len(id_batch):
 			Deck.objects.filter(id__in=id_batch).update(archetype_id=archetype_id)
 
+		archetype_journal.flush()
+
+	UPDATE_ARCHETYPES_BY_DIGEST_QUERY = """
+		UPDATE cards_deck d
+		SET archetype_id = v.archetype_id
+		FROM (VALUES {values}) AS v(digest, archetype_id)
+		WHERE d.digest = v.digest
+		RETURNING d.id, d.archetype_id;
+	"""
+
+	def update_archetypes_by_digest(self, assignments):
+		"""
+		Applies an iterable of (digest, archetype_id) assignments with a single
+		UPDATE, and journals the changes for Redshift.
+		Returns the number of decks which were updated.
+		"""
+		# A deck can only be updated once per statement; the last assignment wins
+		assignments = dict(assignments)
+		if not assignments:
+			return 0
+
+		values = ", ".join(["(%s, %s::int)"] * len(assignments))
+		params = []
+		for digest, archetype_id in assignments.items():
+			params += [digest, archetype_id]
+
+		timestamp = now().replace(tzinfo=None)
+		with connection.cursor() as cursor:
+			cursor.execute(self.UPDATE_ARCHETYPES_BY_DIGEST_QUERY.format(values=values), params)
+			changes = cursor.fetchall()
+
+		archetype_journal.record_many(changes, as_of=timestamp)
+		return len(changes)
+
 	def get_digest_from_shortid(self, shortid):
 		try:
 			id = string_to_int(shortid, ALPHABET)
@@ -130,6 +205,18 @@ class DeckManager(models.Manager):
 		)
 
 
+def _chunks(iterable, size):
+	chunk = []
+	for item in iterable:
+		chunk.append(item)
+		if len(chunk) >= size:
+			yield chunk
+			chunk = []
+
+	if chunk:
+		yield chunk
+
+
 def generate_digest_from_deck_list(id_list):
 	sorted_cards = sorted(id_list)
 	m = hashlib.md5()
@@ -137,6 +224,59 @@ def generate_digest_from_deck_list(id_list):
 	return m.hexdigest()
 
 
+# The cards of a deck never change once it has been created, so they are cached for
+# the lifetime of the process. The cache holds the DBF_PAIRS_CACHE_SIZE most
+# recently used decks.
+DBF_PAIRS_CACHE_SIZE = 10000
+_dbf_pairs_cache = collections.OrderedDict()
+_dbf_pairs_cache_lock = threading.Lock()
+
+
+def get_dbf_pairs(deck_ids):
+	"""
+	Returns a {deck_id: ((dbf_id, count), ...)} dict of the cards of each deck,
+	sorted by dbf_id. Decks which are not cached yet are loaded in a single query.
+	"""
+	ret = {}
+	missing = []
+	with _dbf_pairs_cache_lock:
+		for deck_id in deck_ids:
+			pairs = _dbf_pairs_cache.get(deck_id)
+			if pairs is not None:
+				_dbf_pairs_cache.move_to_end(deck_id)
+				ret[deck_id] = pairs
+			else:
+				missing.append(deck_id)
+
+	if missing:
+		loaded = {deck_id: [] for deck_id in missing}
+		includes = Include.objects.filter(deck_id__in=missing).values_list(
+			"deck_id", "card__dbf_id", "count"
+		)
+		for deck_id, dbf_id, count in includes:
+			loaded[deck_id].append((dbf_id, count))
+
+		with _dbf_pairs_cache_lock:
+			for deck_id, pairs in loaded.items():
+				ret[deck_id] = _dbf_pairs_cache[deck_id] = tuple(sorted(pairs))
+
+			while len(_dbf_pairs_cache) > DBF_PAIRS_CACHE_SIZE:
+				_dbf_pairs_cache.popitem(last=False)
+
+	return ret
+
+
+def dbf_pairs_as_json(dbf_pairs, serialized=True):
+	"""Serialize a deck list (as returned by get_dbf_pairs) for storage in Redshift"""
+	result = [[dbf_id, count] for dbf_id, count in dbf_pairs]
+
+	if serialized:
+		# separators=(",", ":") creates compact JSON encoding
+		return json.dumps(result, separators=(",", ":"))
+	else:
+		return result
+
+
 class Deck(models.Model):
 	"""
 	Represents an abstract collection of cards.
@@ -161,6 +301,14 @@ class Deck(models.Model):
 	class Meta:
 		db_table = "cards_deck"
 
+	@classmethod
+	def from_db(cls, db, field_names, values):
+		instance = super().from_db(db, field_names, values)
+		if "archetype_id" in field_names:
+			# Tracked to detect archetype changes on save without reloading the deck
+			instance._loaded_archetype_id = instance.archetype_id
+		return instance
+
 	def __str__(self):
 		if self.archetype:
 			return str(self.archetype)
@@ -189,7 +337,7 @@ class Deck(models.Model):
 
 	@property
 	def hero_dbf_id(self):
-		return Card.objects.get(card_id=self.hero).dbf_id
+		return get_card(card_id=self.hero).dbf_id
 
 	@cached_property
 	def deck_class(self):
@@ -199,11 +347,14 @@ class Deck(models.Model):
 				return card_class
 		return enums.CardClass.INVALID
 
+	@property
+	def dbf_pairs(self):
+		"""The (dbf_id, count) pairs of the deck, sorted by dbf_id"""
+		return get_dbf_pairs([self.id])[self.id]
+
 	@cached_property
 	def card_dbf_id_packed_list(self):
-		cardlist = self.card_dbf_id_list()
-		sorted_list = sorted(set(cardlist))
-		return [(id, cardlist.count(id)) for id in sorted_list]
+		return list(self.dbf_pairs)
 
 	@cached_property
 	def deckstring(self):
@@ -260,35 +411,20 @@ class Deck(models.Model):
 		return True
 
 	def sync_archetype_to_firehose(self):
-		timestamp = now().replace(tzinfo=None)
-		record = "{deck_id}|{archetype_id}|{as_of}\n".format(
-			deck_id=str(self.id),
-			archetype_id=str(self.archetype_id or ""),
-			as_of=timestamp.isoformat(sep=" "),
-		)
-
-		result = FIREHOSE.put_record(
-			DeliveryStreamName=settings.ARCHETYPE_FIREHOSE_STREAM_NAME,
-			Record={
-				"Data": record.encode("utf-8"),
-			}
-		)
-
-		return result
+		"""Journals the current archetype of the deck for replication into Redshift"""
+		archetype_journal.record(self.id, self.archetype_id)
 
 	def card_dbf_id_list(self):
 		result = []
 
-		includes = self.includes.values_list("card__dbf_id", "count")
-		for id, count in includes:
+		for id, count in self.dbf_pairs:
 			for i in range(count):
 				result.append(id)
 
 		return result
 
 	def dbf_map(self, transformer=int):
-		includes = self.includes.values_list("card__dbf_id", "count")
-		return {transformer(id): count for id, count in includes}
+		return {transformer(id): count for id, count in self.dbf_pairs}
 
 	def card_id_list(self):
 		result = []
@@ -306,24 +442,12 @@ class Deck(models.Model):
 
 	def as_dbf_json(self, serialized=True):
 		"""Serialize the deck list for storage in Redshift"""
-		result = []
-		for include in self.includes.all():
-			result.append([include.card.dbf_id, include.count])
-
-		if serialized:
-			# separators=(",", ":") creates compact JSON encoding
-			return json.dumps(result, separators=(",", ":"))
-		else:
-			return result
+		return dbf_pairs_as_json(self.dbf_pairs, serialized=serialized)
 
 	def classify_into_archetype(self, player_class, save: bool=True) -> int:
 		game_format = self.format
 
-		signature_weights = ClusterSnapshot.objects.get_signature_weights(
-			game_format, player_class
-		)
-
-		sig_archetype_id = classify_deck(self.dbf_map(), signature_weights)
+		sig_archetype_id = classify_decks(game_format, player_class, [self.dbf_map()])[0]
 
 		# New Style Deck Prediction
 		nn_archetype_id = None
@@ -360,11 +484,26 @@ class Deck(models.Model):
 @receiver(models.signals.pre_save, sender=Deck)
 def update_deck_archetype(sender, instance, **kwargs):
 	if instance.id is not None:
-		orig = Deck.objects.get(id=instance.id)
-		if orig.archetype_id != instance.archetype_id:
+		if hasattr(instance, "_loaded_archetype_id"):
+			orig_archetype_id = instance._loaded_archetype_id
+		else:
+			# Instances which were not loaded from the database (see Deck.from_db())
+			orig_archetype_id = Deck.objects.get(id=instance.id).archetype_id
+		if orig_archetype_id != instance.archetype_id:
 			instance.sync_archetype_to_firehose()
 
 
+@receiver(models.signals.post_save, sender=Deck)
+def track_deck_archetype(sender, instance, **kwargs):
+	instance._loaded_archetype_id = instance.archetype_id
+
+
+@receiver(models.signals.post_save, sender=Card)
+@receiver(models.signals.post_delete, sender=Card)
+def invalidate_card_lookups(sender, instance, **kwargs):
+	transaction.on_commit(bump_card_data_version)
+
+
 class Include(models.Model):
 	id = models.BigAutoField(primary_key=True)
 	deck = models.ForeignKey(Deck, on_delete=models.CASCADE, related_name="includes")
@@ -670,6 +809,16 @@ class ClassClusterSnapshot(models.Model, ClassClusters):
 		for cluster in clusters:
 			cluster.class_cluster = self
 
+	def save_cluster_signatures(self):
+		"""
+		Recalculates and saves the signatures of the clusters.
+		The classifiers pick them up once committed, if the cluster set is live.
+		"""
+		self.update_cluster_signatures()
+		for cluster in self.clusters:
+			cluster.save()
+		transaction.on_commit(invalidate_signature_weights)
+
 	def _fetch_training_data(
 		self,
 		num_examples=1000000,
@@ -855,11 +1004,48 @@ class ClusterManager(models.Manager):
 		AND c.external_id != -1;
 	"""
 
-	def get_signature_weights(self, game_format, player_class):
+	CLUSTER_SET_SIGNATURES_QUERY = """
+		SELECT
+			c.external_id,
+			c.ccp_signature
+		FROM decks_classclustersnapshot ccs
+		JOIN decks_clustersnapshot c ON c.class_cluster_id = ccs.id
+		WHERE ccs.cluster_set_id = %s
+		AND ccs.player_class = %s
+		AND c.external_id != -1;
+	"""
+
+	SIGNATURES_DIGEST_QUERY = """
+		SELECT md5(string_agg(
+			c.id || ':' || coalesce(c.external_id::text, '') || ':' || c.ccp_signature::text,
+			',' ORDER BY c.id
+		))
+		FROM decks_classclustersnapshot ccs
+		JOIN decks_clustersnapshot c ON c.class_cluster_id = ccs.id
+		WHERE ccs.cluster_set_id = %s;
+	"""
+
+	def get_signatures_digest(self, cluster_set_id):
+		"""Returns a digest of the archetypes and signatures of the cluster set"""
 		with connection.cursor() as cursor:
-			cursor.execute(
-				self.LIVE_SIGNATURES_QUERY % (int(game_format), int(player_class))
+			cursor.execute(self.SIGNATURES_DIGEST_QUERY, [int(cluster_set_id)])
+			return cursor.fetchone()[0] or ""
+
+	def get_signature_weights(self, game_format, player_class, cluster_set_id=None):
+		"""
+		Returns the signature weights of the live cluster set, or of the cluster set
+		cluster_set_id if passed. Use hsreplaynet.decks.classification to read
+		them through the cache instead.
+		"""
+		if cluster_set_id is None:
+			query = self.LIVE_SIGNATURES_QUERY % (int(game_format), int(player_class))
+		else:
+			query = self.CLUSTER_SET_SIGNATURES_QUERY % (
+				int(cluster_set_id), int(player_class)
 			)
+
+		with connection.cursor() as cursor:
+			cursor.execute(query)
 			result = {}
 			for record in dictfetchall(cursor):
 				if len(record["ccp_signature"]):
@@ -1042,9 +1228,7 @@ class ClusterSetSnapshot(models.Model, ClusterSet):
 
 	def update_all_signatures(self):
 		for class_cluster in self.class_clusters:
-			class_cluster.update_cluster_signatures()
-			for cluster in class_cluster.clusters:
-				cluster.save()
+			class_cluster.save_cluster_signatures()
 
 	def update_archetype_signatures(self, force=False):
 		if force or all(c.neural_network_ready() for c in self.class_clusters):
@@ -1055,24 +1239,55 @@ class ClusterSetSnapshot(models.Model, ClusterSet):
 				self.live_in_production = True
 				self.promoted_on = now()
 				self.save()
+				# Only once the new live cluster set is visible to the other processes
+				transaction.on_commit(invalidate_signature_weights)
 				self.synchronize_deck_archetype_assignments()
 		else:
 			msg = "Cannot promote to live=True because the neural network is not ready"
 			raise RuntimeError(msg)
 
-	def synchronize_deck_archetype_assignments(self):
-		for_update = collections.defaultdict(list)
-
-		for class_cluster in self.class_clusters:
-			for cluster in class_cluster.clusters:
-				if cluster.external_id and cluster.external_id != -1:
-					for data_point in cluster.data_points:
-						digest = Deck.objects.get_digest_from_shortid(data_point["shortid"])
-						for_update[cluster.external_id].append(digest)
-
-		for external_id, digests in for_update.items():
-			deck_ids = Deck.objects.filter(digest__in=digests).values_list("id", flat=True)
-			Deck.objects.bulk_update_to_archetype(deck_ids, external_id)
+	def synchronize_deck_archetype_assignments(self, chunk_size=10000):
+		"""
+		Assigns the decks of each cluster to the cluster's archetype.
+		The (digest, archetype) assignments are streamed from the clusters and applied
+		chunk_size at a time, see Deck.objects.update_archetypes_by_digest().
+		"""
+		start_time = time.time()
+		total_updated = 0
+		for chunk in _chunks(self._iter_deck_archetype_assignments(), chunk_size):
+			chunk_start_time = time.time()
+			updated = Deck.objects.update_archetypes_by_digest(chunk)
+			total_updated += updated
+			chunk_duration = time.time() - chunk_start_time
+			log.info(
+				"Synchronized %i deck archetypes (%i total) in %.2f seconds",
+				updated, total_updated, chunk_duration
+			)
+			influx_metric("deck_archetype_assignment_sync_progress", {
+				"assignments": len(chunk),
+				"updated": updated,
+				"total_updated": total_updated,
+				"duration": chunk_duration,
+				"decks_per_second": updated / chunk_duration if chunk_duration else 0,
+			}, cluster_set_id=self.id)
+
+		duration = time.time() - start_time
+		influx_metric("deck_archetype_assignment_sync", {
+			"updated": total_updated,
+			"duration": duration,
+			"decks_per_second": total_updated / duration if duration else 0,
+		}, cluster_set_id=self.id)
+
+	def _iter_deck_archetype_assignments(self):
+		clusters = ClusterSnapshot.objects.filter(
+			class_cluster__cluster_set=self,
+			external_id__isnull=False,
+		).exclude(external_id__in=(-1, 0)).values_list("external_id", "data_points")
+
+		for external_id, data_points in clusters.iterator():
+			for data_point in data_points:
+				digest = Deck.objects.get_digest_from_shortid(data_point["shortid"])
+				yield digest, external_id
 
 	def train_neural_network(
 		self,
@@ -297,9 +297,7 @@ class ClusterSnapshotUpdateView(View):
 
 		class_cluster = cluster.class_cluster
 		# Changing external_id assignments affects CCP_signatures
-		# So call update_cluster_signatures() to recalculate
-		class_cluster.update_cluster_signatures()
-		for cluster in class_cluster.clusters:
-			cluster.save()
+		# So call save_cluster_signatures() to recalculate
+		class_cluster.save_cluster_signatures()
 
 		return JsonResponse({"msg": "OKAY"}, status=200)
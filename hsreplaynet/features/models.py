@@ -95,7 +95,17 @@ class Feature(models.Model):
 		offset = int(self.created.microsecond / 10000)
 		return (base + offset) % 100 <= self.rollout_percent
 
-	def enabled_for_user(self, user) -> bool:
+	def is_user_authorized(self, user, group_names=None) -> bool:
+		if group_names is None:
+			return user.groups.filter(name=self.authorized_group_name).exists()
+		return self.authorized_group_name in group_names
+
+	def enabled_for_user(self, user, group_names=None) -> bool:
+		"""
+		Returns whether the feature is enabled for user.
+		group_names may be a container of the group names of the user, which
+		is checked instead of querying the user groups.
+		"""
 		if self.status == FeatureStatus.OFF:
 			return False
 
@@ -103,10 +113,10 @@ class Feature(models.Model):
 			return user.is_superuser or user.is_staff
 
 		if self.status == FeatureStatus.AUTHORIZED_ONLY:
-			return user.groups.filter(name=self.authorized_group_name).exists()
+			return self.is_user_authorized(user, group_names)
 
 		if not self.is_user_part_of_rollout(user):
-			return user.groups.filter(name=self.authorized_group_name).exists()
+			return self.is_user_authorized(user, group_names)
 
 		if self.status == FeatureStatus.LOGGED_IN_USERS:
 			return user.is_authenticated
@@ -117,16 +127,22 @@ class Feature(models.Model):
 		return False
 
 	def add_user_to_authorized_group(self, user) -> bool:
+		from .utils import invalidate_feature_snapshot
+
 		group = self.authorized_group
 		if group not in user.groups.all():
 			user.groups.add(self.authorized_group)
+			invalidate_feature_snapshot(user)
 			return True
 		return False
 
 	def remove_user(self, user) -> bool:
+		from .utils import invalidate_feature_snapshot
+
 		group = self.authorized_group
 		if group in user.groups.all():
 			user.groups.remove(self.authorized_group)
+			invalidate_feature_snapshot(user)
 			return True
 		return False
 
@@ -246,3 +262,11 @@ class FeatureInvite(models.Model):
 @receiver(models.signals.post_save, sender=Feature)
 def create_feature_membership_groups(sender, instance, **kwargs):
 	Group.objects.get_or_create(name=instance.authorized_group_name)
+
+
+@receiver(models.signals.post_save, sender=Feature)
+@receiver(models.signals.post_delete, sender=Feature)
+def invalidate_features_cache(sender, instance, **kwargs):
+	from .utils import invalidate_features
+
+	invalidate_features()
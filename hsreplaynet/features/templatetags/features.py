@@ -1,6 +1,6 @@
 from django import template
 
-from hsreplaynet.features.models import Feature
+from hsreplaynet.features.utils import get_feature_snapshot
 
 
 register = template.Library()
@@ -14,13 +14,13 @@ def get_feature_context(user, feature_name):
 		"exists": True,
 	}
 
-	try:
-		feature = Feature.objects.get(name=feature_name)
-	except Feature.DoesNotExist as e:
+	snapshot = get_feature_snapshot(user)
+	feature = snapshot.get(feature_name)
+	if feature is None:
 		feature_context["exists"] = False
 		feature_context["enabled"] = user.is_staff
 	else:
-		feature_context["enabled"] = feature.enabled_for_user(user)
+		feature_context["enabled"] = snapshot.is_enabled(feature_name)
 		feature_context["read_only"] = feature.read_only
 
 	return feature_context
@@ -1,11 +1,89 @@
+"""
+Feature flag resolution.
+
+The Feature table is small and read on nearly every request, so it is cached per
+process for FEATURES_CACHE_TTL seconds (and dropped as soon as a Feature is saved
+or deleted in this process). Flags are evaluated in memory against a per-user
+FeatureSnapshot, which loads the group names of the user at most once. The snapshot
+is stored on the user object, so that the context processor, the template tags and
+the view decorators of a request all share it.
+"""
+import time
+
+from django.conf import settings
+
 from .models import Feature
 
 
-def feature_enabled_for_user(feature_name: str, user) -> bool:
+_features_cache = {}
+
+
+def get_features():
+	"""Returns a {name: Feature} dict of all the features."""
+	ttl = getattr(settings, "FEATURES_CACHE_TTL", 10)
+	cached = _features_cache.get("features")
+	if cached is None or time.time() - cached[1] > ttl:
+		cached = ({f.name: f for f in Feature.objects.all()}, time.time())
+		_features_cache["features"] = cached
+	return cached[0]
+
+
+def invalidate_features():
+	_features_cache.clear()
+
+
+class UserGroupNames:
+	"""The group names of a user, loaded with a single query on first use."""
+	def __init__(self, user):
+		self.user = user
+		self._names = None
+
+	def __contains__(self, name):
+		if self._names is None:
+			if self.user.is_authenticated:
+				self._names = frozenset(self.user.groups.values_list("name", flat=True))
+			else:
+				self._names = frozenset()
+		return name in self._names
 
+
+class FeatureSnapshot:
+	def __init__(self, user, features):
+		self.user = user
+		self.features = features
+		self.group_names = UserGroupNames(user)
+		self._enabled = {}
+
+	def get(self, name):
+		return self.features.get(name)
+
+	def is_enabled(self, name) -> bool:
+		if name not in self._enabled:
+			feature = self.features.get(name)
+			self._enabled[name] = bool(
+				feature and feature.enabled_for_user(self.user, group_names=self.group_names)
+			)
+		return self._enabled[name]
+
+	def enabled_features(self):
+		return [feature for name, feature in self.features.items() if self.is_enabled(name)]
+
+
+def get_feature_snapshot(user) -> FeatureSnapshot:
+	features = get_features()
+	snapshot = getattr(user, "_feature_snapshot", None)
+	if snapshot is None or snapshot.features is not features:
+		snapshot = FeatureSnapshot(user, features)
+		user._feature_snapshot = snapshot
+	return snapshot
+
+
+def invalidate_feature_snapshot(user):
 	try:
-		feature = Feature.objects.get(name=feature_name)
-	except Feature.DoesNotExist as e:
-		return False
-	else:
-		return feature.enabled_for_user(user)
+		del user._feature_snapshot
+	except AttributeError:
+		pass
+
+
+def feature_enabled_for_user(feature_name: str, user) -> bool:
+	return get_feature_snapshot(user).is_enabled(feature_name)
@@ -1,12 +1,15 @@
 import json
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from hashlib import sha1
-from io import StringIO
 
 from dateutil.parser import parse as dateutil_parse
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
+from django.db import connections, transaction
 from django.db.utils import IntegrityError
 from django.utils import timezone
 from django_hearthstone.cards.models import Card
@@ -23,13 +26,13 @@ from hearthsim.identity.accounts.models import BlizzardAccount
 from hsredshift.etl.exceptions import CorruptReplayDataError, CorruptReplayPacketError
 from hsredshift.etl.exporters import RedshiftPublishingExporter
 from hsredshift.etl.firehose import flush_exporter_to_firehose
-from hsreplaynet.decks.models import Deck
-from hsreplaynet.live.distributions import (
-	get_live_stats_redis, get_played_cards_distribution, get_player_class_distribution
-)
+from hsreplaynet.decks.models import Deck, dbf_pairs_as_json, get_dbf_pairs
+from hsreplaynet.live.distributions import LiveStatsUpdate
 from hsreplaynet.uploads.models import UploadEventStatus
+from hsreplaynet.uploads.utils import LogStreamReader
 from hsreplaynet.utils import guess_ladder_season, log
-from hsreplaynet.utils.influx import influx_metric, influx_timer
+from hsreplaynet.utils.cards import get_card
+from hsreplaynet.utils.influx import influx_flush, influx_metric, influx_timer
 from hsreplaynet.utils.instrumentation import error_handler
 from hsreplaynet.utils.prediction import deck_prediction_tree
 
@@ -108,6 +111,34 @@ def save_hsreplay_document(hsreplay_doc, shortid, existing_replay):
 	return ContentFile(xml_str)
 
 
+def save_replay_file(replay, xml_file, previous_filename=None):
+	"""
+	Writes the replay file, then points the replay at the name the storage gave it.
+	The previous file of the replay is only deleted once it is no longer referenced.
+	"""
+	filename = replay.replay_xml.name
+	replay.replay_xml.save("hsreplay.xml", xml_file, save=False)
+	if replay.replay_xml.name != filename:
+		replay.save(update_fields=["replay_xml"])
+
+	if previous_filename and previous_filename != replay.replay_xml.name:
+		delete_replay_file(previous_filename)
+
+
+def save_replay_file_on_commit(replay, xml_file, previous_filename=None):
+	"""
+	Writes the replay file once the replay is committed, so that the files of replays
+	which are rolled back are not written (or overwritten).
+	"""
+	transaction.on_commit(lambda: save_replay_file(replay, xml_file, previous_filename))
+
+
+def delete_replay_file(filename):
+	if default_storage.exists(filename):
+		log.debug("Deleting %r", filename)
+		default_storage.delete(filename)
+
+
 def generate_globalgame_digest(meta, lo1, lo2):
 	game_handle = meta["game_handle"]
 	server_address = meta["server_ip"]
@@ -222,20 +253,17 @@ def find_or_create_replay(parser, entity_tree, meta, upload_event, global_game,
 
 	if existing_replay:
 		log.debug("Found existing replay %r", existing_replay.shortid)
-		# Clean up existing replay file
-		filename = existing_replay.replay_xml.name
-		if filename and filename != replay_xml_path and default_storage.exists(filename):
-			# ... but only if it's not the same path as the new one (it'll get overwridden)
-			log.debug("Deleting %r", filename)
-			default_storage.delete(filename)
-
-		# Now update all the fields
+		# Now update all the fields. The replay keeps pointing to its existing file
+		# until the new one has been written.
 		defaults.update(common)
+		del defaults["replay_xml"]
 		for k, v in defaults.items():
 			setattr(existing_replay, k, v)
 
-		# Save the replay file
-		existing_replay.replay_xml.save("hsreplay.xml", xml_file, save=False)
+		# Save the replay file, and clean up the existing one if its path differs
+		save_replay_file_on_commit(
+			existing_replay, xml_file, previous_filename=existing_replay.replay_xml.name
+		)
 
 		# Finally, save to the db and exit early with created=False
 		existing_replay.save()
@@ -268,7 +296,7 @@ def find_or_create_replay(parser, entity_tree, meta, upload_event, global_game,
 		raise ReplayAlreadyExists(msg, replay)
 
 	# Save the replay file
-	replay.replay_xml.save("hsreplay.xml", xml_file, save=False)
+	save_replay_file_on_commit(replay, xml_file)
 
 	if replay.shortid != upload_event.shortid:
 		# We must ensure an alias for this upload_event.shortid is recorded
@@ -276,13 +304,9 @@ def find_or_create_replay(parser, entity_tree, meta, upload_event, global_game,
 		ReplayAlias.objects.get_or_create(replay=replay, shortid=upload_event.shortid)
 
 	if user and not user.is_fake and user.webhook_endpoints.filter(is_deleted=False).exists():
-		# Re-query the replay object and create an Event for it
-		from hsreplaynet.webhooks.models import Event
-		replay = GameReplay.objects.get(id=replay.id)
-		event = Event.objects.create(
-			user=user, type="replay.created", data=replay.serialize()
-		)
-		event.create_webhooks()
+		# The Event is created (and its webhooks delivered) from the outbox
+		from hsreplaynet.webhooks.outbox import queue_outbox_event
+		queue_outbox_event(user, "replay.created", replay.shortid)
 
 	return replay, created
 
@@ -313,28 +337,15 @@ def process_upload_event(upload_event):
 	Wrapper around do_process_upload_event() to set the event's
 	status and error/traceback as needed.
 	"""
-	upload_event.error = ""
-	upload_event.traceback = ""
-	if upload_event.status != UploadEventStatus.PROCESSING:
-		upload_event.status = UploadEventStatus.PROCESSING
-		upload_event.save()
+	prepare_upload_event_for_processing(upload_event)
+	live_stats = LiveStatsUpdate()
 
 	try:
-		replay, do_flush_exporter = do_process_upload_event(upload_event)
-	except Exception as e:
-		from traceback import format_exc
-		upload_event.error = str(e)
-		upload_event.traceback = format_exc()
-		upload_event.status, reraise = handle_upload_event_exception(e, upload_event)
-		metric_fields = {"count": 1}
-		if upload_event.game:
-			metric_fields["shortid"] = str(upload_event.game.shortid)
-		influx_metric(
-			"upload_event_exception",
-			metric_fields,
-			error=upload_event.status.name.lower()
+		replay, do_flush_exporter = do_process_upload_event(
+			upload_event, live_stats=live_stats
 		)
-		upload_event.save()
+	except Exception as e:
+		reraise = record_upload_event_exception(e, upload_event)
 		if reraise:
 			raise
 		else:
@@ -344,6 +355,164 @@ def process_upload_event(upload_event):
 		upload_event.status = UploadEventStatus.SUCCESS
 		upload_event.save()
 
+	with live_stats_update_in_background(live_stats):
+		flush_redshift_exporter(do_flush_exporter)
+
+	return replay
+
+
+def process_upload_events(upload_events, max_workers=None):
+	"""
+	Batch variant of process_upload_event().
+
+	The logs of all the events are parsed in parallel in a process pool, then the
+	games are created one after the other. Each event is saved in its own transaction,
+	so a failing replay only rolls back its own rows, and the locks taken while saving
+	a replay (eg. on new decks) are not held for the rest of the batch.
+
+	Statuses and errors are set exactly like process_upload_event() does. Exceptions
+	that would be reraised there are reported instead, so that one broken upload cannot
+	fail the whole batch.
+
+	Returns a list of (upload_event, replay) tuples. The replay is None on failure.
+	"""
+	upload_events = list(upload_events)
+	for upload_event in upload_events:
+		prepare_upload_event_for_processing(upload_event)
+
+	with influx_timer("upload_event_batch_parsing_duration", batch_size=len(upload_events)):
+		parsed = _parse_upload_events_in_pool(upload_events, max_workers)
+
+	results = []
+	processed = []
+	batch_live_stats = LiveStatsUpdate()
+	for upload_event, (meta, parser, parsing_exception) in zip(upload_events, parsed):
+		# Only keep the live stats of the replays which were not rolled back
+		live_stats = LiveStatsUpdate()
+		try:
+			if parsing_exception is not None:
+				raise parsing_exception
+			with transaction.atomic():
+				replay, do_flush_exporter = do_process_upload_event(
+					upload_event, meta=meta, parser=parser, live_stats=live_stats
+				)
+		except Exception as e:
+			# Recorded outside of the transaction, which has been rolled back
+			if record_upload_event_exception(e, upload_event):
+				error_handler(e)
+			results.append((upload_event, None))
+		else:
+			upload_event.game = replay
+			upload_event.status = UploadEventStatus.SUCCESS
+			upload_event.save()
+			batch_live_stats.extend(live_stats)
+			processed.append((upload_event, replay, do_flush_exporter))
+			results.append((upload_event, replay))
+
+	influx_metric("upload_event_batch", {
+		"count": len(upload_events),
+		"success": len(processed),
+	})
+
+	with live_stats_update_in_background(batch_live_stats):
+		for upload_event, replay, do_flush_exporter in processed:
+			flush_redshift_exporter(do_flush_exporter)
+
+	return results
+
+
+def _parse_upload_events_in_pool(upload_events, max_workers=None):
+	"""
+	Returns a (meta, parser, exception) tuple for each upload event, in order.
+	"""
+	ret = []
+	pending = []
+	for upload_event in upload_events:
+		try:
+			meta = get_upload_event_metadata(upload_event)
+			match_start = get_upload_event_match_start(upload_event, meta)
+		except Exception as e:
+			ret.append((None, None, e))
+		else:
+			ret.append((meta, None, None))
+			pending.append((len(ret) - 1, upload_event, match_start))
+
+	if max_workers == 1 or len(pending) < 2:
+		executor = None
+	else:
+		# Forked workers must not share the parent's database connections. Those of a
+		# surrounding transaction are kept open, the workers never use them.
+		for connection in connections.all():
+			if not connection.in_atomic_block:
+				connection.close()
+		try:
+			executor = ProcessPoolExecutor(max_workers=max_workers)
+		except (OSError, NotImplementedError) as e:
+			# Some environments (eg. Lambda) do not provide the shared memory
+			# required by multiprocessing. Parse serially in that case.
+			log.warning("Could not create a parsing process pool: %r", e)
+			executor = None
+
+	if executor is None:
+		for i, upload_event, match_start in pending:
+			try:
+				ret[i] = (ret[i][0], parse_upload_event_log(upload_event, match_start), None)
+			except Exception as e:
+				ret[i] = (ret[i][0], None, e)
+		return ret
+
+	with executor:
+		futures = [
+			(i, executor.submit(_parse_upload_event_log_in_worker, upload_event, match_start))
+			for i, upload_event, match_start in pending
+		]
+		for i, future in futures:
+			try:
+				ret[i] = (ret[i][0], future.result(), None)
+			except Exception as e:
+				ret[i] = (ret[i][0], None, e)
+
+	return ret
+
+
+def _parse_upload_event_log_in_worker(upload_event, match_start):
+	try:
+		return parse_upload_event_log(upload_event, match_start)
+	finally:
+		# Pool workers exit without giving the flush thread a chance to run
+		influx_flush()
+
+
+def prepare_upload_event_for_processing(upload_event):
+	upload_event.error = ""
+	upload_event.traceback = ""
+	if upload_event.status != UploadEventStatus.PROCESSING:
+		upload_event.status = UploadEventStatus.PROCESSING
+		upload_event.save()
+
+
+def record_upload_event_exception(e, upload_event):
+	"""
+	Saves the error, traceback and status for the exception on the UploadEvent.
+	Returns True if the exception should be reraised.
+	"""
+	from traceback import format_exc
+	upload_event.error = str(e)
+	upload_event.traceback = format_exc()
+	upload_event.status, reraise = handle_upload_event_exception(e, upload_event)
+	metric_fields = {"count": 1}
+	if upload_event.game:
+		metric_fields["shortid"] = str(upload_event.game.shortid)
+	influx_metric(
+		"upload_event_exception",
+		metric_fields,
+		error=upload_event.status.name.lower()
+	)
+	upload_event.save()
+	return reraise
+
+
+def flush_redshift_exporter(do_flush_exporter):
 	try:
 		with influx_timer("redshift_exporter_flush_duration"):
 			do_flush_exporter()
@@ -358,10 +527,44 @@ def process_upload_event(upload_event):
 			}
 		)
 
-	return replay
 
+def update_live_stats(live_stats):
+	try:
+		with influx_timer("live_stats_update_duration", count=len(live_stats)):
+			live_stats.execute()
+	except Exception as e:
+		# Don't fail on this
+		error_handler(e)
 
-def parse_upload_event(upload_event, meta):
+
+@contextmanager
+def live_stats_update_in_background(live_stats):
+	"""
+	Writes the live stats in a separate thread while the body of the `with` block
+	(eg. the Redshift exporter flush) runs, and waits for it on exit.
+	"""
+	thread = threading.Thread(target=update_live_stats, args=(live_stats, ))
+	thread.start()
+	try:
+		yield
+	finally:
+		thread.join()
+
+
+def get_upload_event_metadata(upload_event):
+	meta = json.loads(upload_event.metadata)
+
+	# Hack until we do something better
+	# We need the correct tz, but here it's stored as UTC because it goes through DRF
+	# https://github.com/encode/django-rest-framework/commit/7d6d043531
+	if upload_event.descriptor_data:
+		descriptor_data = json.loads(upload_event.descriptor_data)
+		meta["match_start"] = descriptor_data["upload_metadata"]["match_start"]
+
+	return meta
+
+
+def get_upload_event_match_start(upload_event, meta):
 	orig_match_start = dateutil_parse(meta["match_start"])
 	match_start = get_valid_match_start(orig_match_start, upload_event.created)
 	if match_start != orig_match_start:
@@ -370,17 +573,40 @@ def parse_upload_event(upload_event, meta):
 		difference = (orig_match_start - match_start).seconds
 		influx_metric("tainted_replay", {"count": 1, "difference": difference})
 
-	log_bytes = upload_event.log_bytes()
-	if not log_bytes:
-		raise ValidationError("The uploaded log file is empty.")
+	return match_start
+
+
+def parse_upload_event(upload_event, meta):
+	match_start = get_upload_event_match_start(upload_event, meta)
+	return parse_upload_event_log(upload_event, match_start)
 
-	powerlog = StringIO(log_bytes.decode("utf-8"))
-	upload_event.file.close()
 
+def parse_upload_event_log(upload_event, match_start):
+	"""
+	Parses the log file of the upload event.
+	This does not touch the database so it can run in a worker process.
+
+	The log is streamed and fed line by line to the parser, so that the raw
+	(and possibly gzipped) log is never held in memory in its entirety.
+	"""
 	parser = LogParser()
 	parser._game_state_processor = "GameState"
 	parser._current_date = match_start
-	parser.read(powerlog)
+
+	with influx_timer("replay_log_parsing_duration") as timer_fields:
+		log_stream = upload_event.open_log_stream()
+		try:
+			powerlog = LogStreamReader(log_stream)
+			parser.read(powerlog)
+		finally:
+			log_stream.close()
+
+		timer_fields["bytes"] = powerlog.bytes_read
+		timer_fields["bytes_decoded"] = powerlog.bytes_decoded
+		timer_fields["bytes_per_second"] = powerlog.bytes_per_second
+
+	if not powerlog.bytes_read:
+		raise ValidationError("The uploaded log file is empty.")
 
 	return parser
 
@@ -443,7 +669,7 @@ def validate_parser(parser, meta):
 			raise UnsupportedReplay("No hero found for player %r" % (player.name))
 
 		try:
-			db_hero = Card.objects.get(card_id=player._hero.card_id)
+			db_hero = get_card(card_id=player._hero.card_id)
 		except Card.DoesNotExist:
 			raise UnsupportedReplay("Hero %r not found." % (player._hero))
 		if db_hero.type != CardType.HERO:
@@ -485,7 +711,65 @@ def _is_decklist_superset(superset_decklist, subset_decklist):
 	return s1.issuperset(s2)
 
 
-def update_global_players(global_game, entity_tree, meta, upload_event, exporter):
+def get_or_create_player_decks(entity_tree, decklists, global_game, meta, upload_event):
+	"""
+	Returns a dict of player_id -> Deck for all the players in the game.
+	The decks are resolved in a single query, unless one of them cannot be created.
+	"""
+	players = entity_tree.players
+	try:
+		with transaction.atomic():
+			results = Deck.objects.get_or_create_many(
+				[decklists[player.player_id] for player in players],
+				hero_ids=[player._hero.card_id for player in players],
+				game_type=global_game.game_type,
+				classify_archetype=True
+			)
+	except IntegrityError:
+		# Find out which of the decks is the culprit
+		results = [
+			get_or_create_player_deck(
+				player, decklists[player.player_id], global_game, meta, upload_event
+			) for player in players
+		]
+
+	decks = {}
+	for player, (deck, created) in zip(players, results):
+		log.debug("Prepared deck %i (created=%r)", deck.id, created)
+		decks[player.player_id] = deck
+
+	return decks
+
+
+def get_or_create_player_deck(player, decklist, global_game, meta, upload_event):
+	try:
+		with transaction.atomic():
+			return Deck.objects.get_or_create_from_id_list(
+				decklist,
+				hero_id=player._hero.card_id,
+				game_type=global_game.game_type,
+				classify_archetype=True
+			)
+	except IntegrityError as e:
+		# This will happen if cards in the deck are not in the DB
+		# For example, during a patch release
+		influx_metric("replay_deck_create_failure", {
+			"count": 1,
+			"build": meta["build"],
+			"global_game_id": global_game.id,
+			"server_ip": meta.get("server_ip", ""),
+			"upload_ip": upload_event.upload_ip,
+			"error": str(e),
+		})
+		log.exception("Could not create deck for player %r", player)
+		global_game.tainted_decks = True
+		# Replace with an empty deck
+		return Deck.objects.get_or_create_from_id_list([])
+
+
+def update_global_players(
+	global_game, entity_tree, meta, upload_event, exporter, live_stats
+):
 	# Fill the player metadata and objects
 	players = {}
 	played_cards = exporter.export_played_cards()
@@ -493,6 +777,7 @@ def update_global_players(global_game, entity_tree, meta, upload_event, exporter
 	is_spectated_replay = meta.get("spectator_mode", False)
 	is_dungeon_run = meta.get("scenario_id", 0) == 2663
 
+	decklists = {}
 	for player in entity_tree.players:
 		is_friendly_player = player.player_id == meta["friendly_player"]
 		player_meta = meta.get("player%i" % (player.player_id), {})
@@ -515,41 +800,26 @@ def update_global_players(global_game, entity_tree, meta, upload_event, exporter
 			# Spectated replays never know more than is in the replay data
 			# But may have erroneous data from the spectator's client's memory
 			# Read from before they entered the spectated game
-			decklist = decklist_from_replay
+			decklists[player.player_id] = decklist_from_replay
 		else:
-			decklist = decklist_from_meta
+			decklists[player.player_id] = decklist_from_meta
+
+	decks = get_or_create_player_decks(entity_tree, decklists, global_game, meta, upload_event)
+
+	for player in entity_tree.players:
+		is_friendly_player = player.player_id == meta["friendly_player"]
+		player_meta = meta.get("player%i" % (player.player_id), {})
+		decklist = decklists[player.player_id]
+		deck = decks[player.player_id]
 
 		name, real_name = get_player_names(player)
 		player_hero_id = player._hero.card_id
 
-		try:
-			deck, _ = Deck.objects.get_or_create_from_id_list(
-				decklist,
-				hero_id=player_hero_id,
-				game_type=global_game.game_type,
-				classify_archetype=True
-			)
-			log.debug("Prepared deck %i (created=%r)", deck.id, _)
-		except IntegrityError as e:
-			# This will happen if cards in the deck are not in the DB
-			# For example, during a patch release
-			influx_metric("replay_deck_create_failure", {
-				"count": 1,
-				"build": meta["build"],
-				"global_game_id": global_game.id,
-				"server_ip": meta.get("server_ip", ""),
-				"upload_ip": upload_event.upload_ip,
-				"error": str(e),
-			})
-			log.exception("Could not create deck for player %r", player)
-			global_game.tainted_decks = True
-			# Replace with an empty deck
-			deck, _ = Deck.objects.get_or_create_from_id_list([])
-
 		capture_played_card_stats(
 			global_game,
 			[c.dbf_id for c in played_cards[player.player_id]],
-			is_friendly_player
+			is_friendly_player,
+			live_stats
 		)
 
 		eligible_formats = [FormatType.FT_STANDARD, FormatType.FT_WILD]
@@ -576,17 +846,14 @@ def update_global_players(global_game, entity_tree, meta, upload_event, exporter
 				if deck.size is not None:
 					deck_size = deck.size
 				else:
-					deck_size = sum(i.count for i in deck.includes.all())
+					deck_size = sum(count for _, count in deck.dbf_pairs)
 
 				has_enough_observed_cards = deck_size >= min_observed_cards
 				has_enough_played_cards = len(played_card_dbfs) >= min_played_cards
 
 				if deck_size == 30:
-					tree.observe(
-						deck.id,
-						deck.dbf_map(),
-						played_card_dbfs
-					)
+					# The deck may be rolled back along with the replay
+					observe_deck_on_commit(tree, deck, played_card_dbfs)
 					# deck_id == proxy_deck_id for complete decks
 					deck.guessed_full_deck = deck
 					deck.save()
@@ -607,6 +874,10 @@ def update_global_players(global_game, entity_tree, meta, upload_event, exporter
 						"tie": res.tie
 					}
 
+					for depth, latency in res.depth_latencies:
+						key = "depth_%i_latency_ms" % (depth)
+						fields[key] = fields.get(key, 0) + latency
+
 					if settings.DETAILED_PREDICTION_METRICS:
 						fields["actual_deck"] = repr(deck)
 
@@ -625,7 +896,7 @@ def update_global_players(global_game, entity_tree, meta, upload_event, exporter
 								if path_dbf_id == "ROOT":
 									path_str = path_dbf_id
 								else:
-									path_card = Card.objects.get(dbf_id=path_dbf_id)
+									path_card = get_card(dbf_id=path_dbf_id)
 									path_str = path_card.name
 								node_labels.append("[%s]" % path_str)
 							fields["node"] = "->".join(node_labels)
@@ -745,13 +1016,24 @@ def update_global_players(global_game, entity_tree, meta, upload_event, exporter
 	return players
 
 
-def update_player_class_distribution(replay):
+def observe_deck_on_commit(tree, deck, played_card_dbfs):
+	deck_id, dbf_map = deck.id, deck.dbf_map()
+
+	def observe():
+		try:
+			tree.observe(deck_id, dbf_map, played_card_dbfs)
+		except Exception as e:
+			error_handler(e)
+
+	transaction.on_commit(observe)
+
+
+def update_player_class_distribution(replay, live_stats):
 	try:
 		game_type_name = BnetGameType(replay.global_game.game_type).name
-		distribution = get_player_class_distribution(game_type_name)
 		opponent = replay.opposing_player
 		player_class = opponent.hero_class_name
-		distribution.increment(player_class, win=opponent.won)
+		live_stats.add_player_class(game_type_name, player_class, win=opponent.won)
 	except Exception as e:
 		error_handler(e)
 
@@ -763,46 +1045,50 @@ def elapsed_seconds_from_match_end(global_game):
 	return abs(diff.total_seconds())
 
 
-def capture_played_card_stats(global_game, played_cards, is_friendly_player):
+def capture_played_card_stats(global_game, played_cards, is_friendly_player, live_stats):
 	try:
 		elapsed_minutes = elapsed_seconds_from_match_end(global_game) / 60.0
 		if not is_friendly_player and elapsed_minutes <= 5.0:
 			game_type_name = BnetGameType(global_game.game_type).name
-			redis = get_live_stats_redis()
-			pipeline = redis.pipeline(transaction=True)
-			dist = get_played_cards_distribution(game_type_name, redis_client=pipeline)
-			for dbf_id in played_cards:
-				dist.increment(dbf_id)
-			pipeline.execute()
+			live_stats.add_played_cards(game_type_name, played_cards)
 	except Exception as e:
 		error_handler(e)
 
 
-def do_process_upload_event(upload_event):
-	meta = json.loads(upload_event.metadata)
+def do_process_upload_event(upload_event, meta=None, parser=None, live_stats=None):
+	"""
+	The live stats increments of the replay are collected into live_stats, for the
+	caller to write once the upload event has been processed. If live_stats is not
+	passed, they are written before returning.
+	"""
+	update_live_stats_now = live_stats is None
+	if update_live_stats_now:
+		live_stats = LiveStatsUpdate()
 
-	# Hack until we do something better
-	# We need the correct tz, but here it's stored as UTC because it goes through DRF
-	# https://github.com/encode/django-rest-framework/commit/7d6d043531
-	if upload_event.descriptor_data:
-		descriptor_data = json.loads(upload_event.descriptor_data)
-		meta["match_start"] = descriptor_data["upload_metadata"]["match_start"]
+	if meta is None:
+		meta = get_upload_event_metadata(upload_event)
 
-	# Parse the UploadEvent's file
-	parser = parse_upload_event(upload_event, meta)
+	if parser is None:
+		# Parse the UploadEvent's file
+		parser = parse_upload_event(upload_event, meta)
 	# Validate the resulting object and metadata
 	entity_tree, exporter = validate_parser(parser, meta)
 
 	# Create/Update the global game object and its players
 	global_game, global_game_created = find_or_create_global_game(entity_tree, meta)
-	players = update_global_players(global_game, entity_tree, meta, upload_event, exporter)
+	players = update_global_players(
+		global_game, entity_tree, meta, upload_event, exporter, live_stats
+	)
 
 	# Create/Update the replay object itself
 	replay, game_replay_created = find_or_create_replay(
 		parser, entity_tree, meta, upload_event, global_game, players
 	)
 
-	update_player_class_distribution(replay)
+	update_player_class_distribution(replay, live_stats)
+	if update_live_stats_now:
+		update_live_stats(live_stats)
+
 	can_attempt_redshift_load = False
 
 	if global_game.loaded_into_redshift is None:
@@ -927,9 +1213,15 @@ def get_game_info(global_game, replay):
 	player1 = replay.player(1)
 	player2 = replay.player(2)
 
+	# Fetch the cards of both decks and of their guessed full decks at once
+	decks = (player1.deck_list, player2.deck_list)
+	deck_ids = [deck.id for deck in decks]
+	deck_ids += [deck.guessed_full_deck_id for deck in decks if deck.guessed_full_deck_id]
 	with influx_timer("generate_redshift_player_decklists_duration"):
-		player1_decklist = player1.deck_list.as_dbf_json()
-		player2_decklist = player2.deck_list.as_dbf_json()
+		dbf_pairs = get_dbf_pairs(deck_ids)
+
+	player1_decklist = dbf_pairs_as_json(dbf_pairs[player1.deck_list.id])
+	player2_decklist = dbf_pairs_as_json(dbf_pairs[player2.deck_list.id])
 
 	if settings.REDSHIFT_USE_MATCH_START_AS_GAME_DATE and global_game.match_start:
 		game_date = global_game.match_start.date()
@@ -937,12 +1229,12 @@ def get_game_info(global_game, replay):
 		game_date = timezone.now().date()
 
 	if player1.deck_list.size is None:
-		player1_deck_size = sum(i.count for i in player1.deck_list.includes.all())
+		player1_deck_size = sum(count for _, count in dbf_pairs[player1.deck_list.id])
 	else:
 		player1_deck_size = player1.deck_list.size
 
 	if player2.deck_list.size is None:
-		player2_deck_size = sum(i.count for i in player2.deck_list.includes.all())
+		player2_deck_size = sum(count for _, count in dbf_pairs[player2.deck_list.id])
 	else:
 		player2_deck_size = player2.deck_list.size
 
@@ -974,16 +1266,16 @@ def get_game_info(global_game, replay):
 		}
 	}
 
-	if player1.deck_list.guessed_full_deck:
-		player1_proxy_deck = player1.deck_list.guessed_full_deck
-		player1_proxy_decklist = player1_proxy_deck.as_dbf_json()
-		game_info["players"]["1"]["proxy_deck_id"] = player1_proxy_deck.id
+	if player1.deck_list.guessed_full_deck_id:
+		player1_proxy_deck_id = player1.deck_list.guessed_full_deck_id
+		player1_proxy_decklist = dbf_pairs_as_json(dbf_pairs[player1_proxy_deck_id])
+		game_info["players"]["1"]["proxy_deck_id"] = player1_proxy_deck_id
 		game_info["players"]["1"]["proxy_deck_list"] = player1_proxy_decklist
 
-	if player2.deck_list.guessed_full_deck:
-		player2_proxy_deck = player2.deck_list.guessed_full_deck
-		player2_proxy_decklist = player2_proxy_deck.as_dbf_json()
-		game_info["players"]["2"]["proxy_deck_id"] = player2_proxy_deck.id
+	if player2.deck_list.guessed_full_deck_id:
+		player2_proxy_deck_id = player2.deck_list.guessed_full_deck_id
+		player2_proxy_decklist = dbf_pairs_as_json(dbf_pairs[player2_proxy_deck_id])
+		game_info["players"]["2"]["proxy_deck_id"] = player2_proxy_deck_id
 		game_info["players"]["2"]["proxy_deck_list"] = player2_proxy_decklist
 
 	return game_info
@@ -2,6 +2,7 @@
 
 The cron schedule for these must be setup via the AWS Web Console.
 """
+from hsreplaynet.live.distributions import update_player_class_distribution_series
 from hsreplaynet.uploads.models import RedshiftStagingTrack
 from hsreplaynet.utils.instrumentation import lambda_handler
 
@@ -15,3 +16,16 @@ from hsreplaynet.utils.instrumentation import lambda_handler
 def do_redshift_etl_maintenance(event, context):
 	"""A periodic job to orchestrate Redshift ETL Maintenance"""
 	RedshiftStagingTrack.objects.do_maintenance()
+
+
+@lambda_handler(
+	cpu_seconds=65,
+	requires_vpc_access=True,
+	tracing=False,
+)
+def update_live_distribution_series(event, context):
+	"""
+	A job scheduled every minute, which keeps the live player class distribution
+	series up to date for the following 55 seconds.
+	"""
+	update_player_class_distribution_series(duration=55)
@@ -138,6 +138,53 @@ def process_s3_create_handler(event, context):
 	process_raw_upload(raw_upload, reprocessing, log_group_name, log_stream_name)
 
 
+@instrumentation.lambda_handler(
+	cpu_seconds=300,
+	requires_vpc_access=True,
+	memory=settings.LAMBDA_PROCESSING_MEMORY_MB,
+)
+def process_replay_upload_stream_batch_handler(event, context):
+	"""
+	A handler that processes every record of a Kinesis batch within a single invocation.
+
+	Unlike process_replay_upload_stream_handler, which invokes one Lambda per record,
+	this validates all the raw uploads and then hands the resulting UploadEvents to
+	process_upload_events(), which parses them in parallel and saves the games one
+	after the other. It can be attached to the stream in place of the fan-out handler.
+	"""
+	from hsreplaynet.games.processing import process_upload_events
+
+	logger = logging.getLogger(
+		"hsreplaynet.lambdas.process_replay_upload_stream_batch_handler"
+	)
+	records = event["Records"]
+	logger.debug("Kinesis batch handler invoked with %s records", len(records))
+
+	upload_events = []
+	for record in records:
+		try:
+			raw_upload = RawUpload.from_kinesis_event(record["kinesis"])
+			logger.info(
+				"Kinesis RawUpload: %r (reprocessing=%r)",
+				raw_upload, raw_upload.attempt_reprocessing
+			)
+			obj = prepare_raw_upload(
+				raw_upload,
+				raw_upload.attempt_reprocessing,
+				context.log_group_name,
+				context.log_stream_name
+			)
+		except Exception as e:
+			# Validation errors are already saved on the UploadEvent
+			instrumentation.error_handler(e)
+		else:
+			if obj is not None:
+				upload_events.append(obj)
+
+	logger.debug("Processing %i UploadEvents", len(upload_events))
+	process_upload_events(upload_events)
+
+
 def auth_token_from_header(header: str):
 	header = header.lower()
 
@@ -155,6 +202,20 @@ def process_raw_upload(raw_upload, reprocess=False, log_group_name="", log_strea
 	"""
 	Generic processing logic for raw log files.
 	"""
+	obj = prepare_raw_upload(raw_upload, reprocess, log_group_name, log_stream_name)
+	if obj is not None:
+		logging.getLogger("hsreplaynet.lambdas.process_raw_upload").debug(
+			"Starting GameReplay processing for UploadEvent"
+		)
+		obj.process()
+
+
+def prepare_raw_upload(raw_upload, reprocess=False, log_group_name="", log_stream_name=""):
+	"""
+	Validates the raw log file and creates its UploadEvent.
+
+	Returns the UploadEvent if it is ready to be processed, None otherwise.
+	"""
 	from ..games.serializers import UploadEventSerializer
 
 	logger = logging.getLogger("hsreplaynet.lambdas.process_raw_upload")
@@ -176,7 +237,7 @@ def process_raw_upload(raw_upload, reprocess=False, log_group_name="", log_strea
 			"key": raw_upload.log_key
 		})
 
-		return
+		return None
 
 	obj.log_group_name = log_group_name
 	obj.log_stream_name = log_stream_name
@@ -260,24 +321,21 @@ def process_raw_upload(raw_upload, reprocess=False, log_group_name="", log_strea
 			# Wait until after we have deleted the raw_upload to exit
 			# But do not start processing if it's an unsupported client
 			logger.info("Exiting Without Processing - Unsupported Client")
-			return
+			return None
 
 	serializer = UploadEventSerializer(obj, data=upload_metadata)
 	if serializer.is_valid():
 		logger.debug("UploadEvent passed serializer validation")
 		obj.status = UploadEventStatus.PROCESSING
 		serializer.save()
-
-		logger.debug("Starting GameReplay processing for UploadEvent")
-		obj.process()
+		return obj
 	else:
 		obj.error = serializer.errors
 		logger.info("UploadEvent failed validation with errors: %r", obj.error)
 
 		obj.status = UploadEventStatus.VALIDATION_ERROR
 		obj.save()
-
-	logger.debug("Done")
+		return None
 
 
 @instrumentation.lambda_handler(
@@ -1,6 +1,11 @@
+import json
+import time
+from datetime import datetime, timedelta
+
 from django.core.cache import caches
+from hearthstone.enums import BnetGameType
 
-from hsreplaynet.utils.redis import RedisPopularityDistribution
+from hsreplaynet.utils.redis import RedisPopularityDistribution, SpaceSavingSketch
 
 
 class PopularityWinrateDistribution:
@@ -25,10 +30,10 @@ class PopularityWinrateDistribution:
 			bucket_size=self.bucket_size
 		)
 
-	def increment(self, key, win=False, as_of=None):
-		self.observations.increment(key, as_of=as_of)
+	def increment(self, key, win=False, as_of=None, pipeline=None):
+		self.observations.increment(key, as_of=as_of, pipeline=pipeline)
 		if win:
-			self.wins.increment(key, as_of=as_of)
+			self.wins.increment(key, as_of=as_of, pipeline=pipeline)
 
 	def distribution(self, start_ts, end_ts):
 		games = self.observations.distribution(
@@ -58,7 +63,9 @@ def get_player_class_distribution(game_type, redis_client=None, ttl=3200):
 	return PopularityWinrateDistribution(redis, name=name, ttl=ttl)
 
 
-def get_played_cards_distribution(game_type, redis_client=None, ttl=600):
+def get_played_cards_distribution(
+	game_type, redis_client=None, ttl=600, max_items=5000, sketch=SpaceSavingSketch
+):
 	if redis_client:
 		redis = redis_client
 	else:
@@ -70,10 +77,211 @@ def get_played_cards_distribution(game_type, redis_client=None, ttl=600):
 		name=name,
 		namespace="POPULARITY",
 		ttl=ttl,
-		max_items=5000,
-		bucket_size=5
+		max_items=max_items,
+		bucket_size=5,
+		sketch=sketch
 	)
 
 
 def get_live_stats_redis():
 	return caches["live_stats"].client.get_client()
+
+
+class LiveStatsUpdate:
+	"""
+	Collects the live stats increments of one or more replays, so that they can all
+	be written at once, in a single Redis pipeline, with execute().
+	"""
+
+	def __init__(self):
+		self.player_classes = []
+		self.played_cards = []
+
+	def __len__(self):
+		return len(self.player_classes) + len(self.played_cards)
+
+	def add_player_class(self, game_type, player_class, win=False, as_of=None):
+		self.player_classes.append((game_type, player_class, win, as_of))
+
+	def add_played_cards(self, game_type, dbf_ids, as_of=None):
+		self.played_cards.extend((game_type, dbf_id, as_of) for dbf_id in dbf_ids)
+
+	def extend(self, other):
+		self.player_classes.extend(other.player_classes)
+		self.played_cards.extend(other.played_cards)
+
+	def execute(self, redis_client=None):
+		"""Writes all the collected increments and clears them."""
+		if not len(self):
+			return
+
+		redis = redis_client or get_live_stats_redis()
+		pipeline = redis.pipeline(transaction=False)
+
+		player_class_distributions = {}
+		for game_type, player_class, win, as_of in self.player_classes:
+			if game_type not in player_class_distributions:
+				player_class_distributions[game_type] = get_player_class_distribution(
+					game_type, redis_client=redis
+				)
+			player_class_distributions[game_type].increment(
+				player_class, win=win, as_of=as_of, pipeline=pipeline
+			)
+
+		played_cards_distributions = {}
+		for game_type, dbf_id, as_of in self.played_cards:
+			if game_type not in played_cards_distributions:
+				played_cards_distributions[game_type] = get_played_cards_distribution(
+					game_type, redis_client=redis
+				)
+			played_cards_distributions[game_type].increment(
+				dbf_id, as_of=as_of, pipeline=pipeline
+			)
+
+		pipeline.execute()
+		self.player_classes = []
+		self.played_cards = []
+
+
+# The game types for which the player class distribution series are precomputed
+PLAYER_CLASS_SERIES_GAME_TYPES = [
+	BnetGameType.BGT_RANKED_STANDARD,
+	BnetGameType.BGT_RANKED_WILD,
+	BnetGameType.BGT_ARENA,
+]
+
+
+class DistributionSeries:
+	"""
+	A ring buffer in Redis holding one distribution per tick, each computed over a
+	sliding window ending on that tick, for the last lookback seconds.
+
+	Each tick is computed once for the whole cluster by whichever producer claims it
+	first (see update_player_class_distribution_series()), so readers get the whole
+	series with a single LRANGE.
+	"""
+
+	def __init__(self, redis, name, distribution, lookback=600, window=300, tick=5):
+		self.redis = redis
+		self.name = name
+		self.distribution = distribution
+		self.lookback = lookback
+		self.window = window
+		self.tick = tick
+		self.key = "SERIES:%s" % (name)
+		self.size = (lookback - window) // tick + 1
+
+	def _tick_key(self, end_ts):
+		return "%s:%i" % (self.key, int(end_ts.timestamp()))
+
+	def ticks(self, most_recent_tick_ts):
+		"""Returns the end of each window in the series ending at most_recent_tick_ts"""
+		return [
+			most_recent_tick_ts - timedelta(seconds=i * self.tick)
+			for i in reversed(range(self.size))
+		]
+
+	def update(self, most_recent_tick_ts):
+		"""
+		Computes and appends the ticks up to most_recent_tick_ts which are not in
+		the series yet and have not been claimed by another producer.
+		Returns the number of ticks that were appended.
+		"""
+		existing = {entry["ts"] for entry in self._read()}
+		appended = 0
+		for end_ts in self.ticks(most_recent_tick_ts):
+			if int(end_ts.timestamp()) in existing:
+				continue
+
+			if not self.redis.set(self._tick_key(end_ts), 1, nx=True, ex=self.lookback):
+				# Another producer is taking care of it
+				continue
+
+			try:
+				entry = self._compute(end_ts)
+			except Exception:
+				# Let the next producer retry the tick
+				self.redis.delete(self._tick_key(end_ts))
+				raise
+
+			pipeline = self.redis.pipeline(transaction=False)
+			pipeline.rpush(self.key, json.dumps(entry))
+			pipeline.ltrim(self.key, -self.size, -1)
+			pipeline.expire(self.key, self.lookback)
+			pipeline.execute()
+			appended += 1
+
+		return appended
+
+	def _compute(self, end_ts):
+		data = self.distribution.distribution(
+			start_ts=end_ts - timedelta(seconds=self.window),
+			end_ts=end_ts
+		)
+		return {"ts": int(end_ts.timestamp()), "data": data}
+
+	def _read(self):
+		return [json.loads(entry.decode("utf8")) for entry in self.redis.lrange(self.key, 0, -1)]
+
+	def series(self, most_recent_tick_ts):
+		"""
+		Returns the latest series up to most_recent_tick_ts, oldest tick first.
+		Missing ticks are never computed here: while the producers lag behind, this is
+		the last series they stored, which ends before most_recent_tick_ts.
+		"""
+		end = int(most_recent_tick_ts.timestamp())
+		# Producers may append out of order
+		entries = sorted(
+			(entry for entry in self._read() if entry["ts"] <= end),
+			key=lambda entry: entry["ts"]
+		)
+		return entries[-self.size:]
+
+
+def get_player_class_distribution_series(game_type, redis_client=None):
+	if redis_client:
+		redis = redis_client
+	else:
+		redis = get_live_stats_redis()
+
+	name = "PLAYER_CLASS_%s" % game_type
+	distribution = get_player_class_distribution(game_type, redis_client=redis)
+	return DistributionSeries(redis, name, distribution)
+
+
+def get_most_recent_tick_ts(tick=5, redis_client=None):
+	redis = redis_client or get_live_stats_redis()
+	seconds_since_epoch, microseconds_into_current_second = redis.time()
+	current_ts = datetime.utcfromtimestamp(seconds_since_epoch)
+
+	td = timedelta(microseconds=current_ts.microsecond)
+	most_recent_tick_ts = current_ts - td
+	most_recent_tick_ts = most_recent_tick_ts - timedelta(
+		seconds=(most_recent_tick_ts.second % tick)
+	)
+	return most_recent_tick_ts
+
+
+def update_player_class_distribution_series(duration, redis_client=None):
+	"""
+	Keeps the player class distribution series of PLAYER_CLASS_SERIES_GAME_TYPES up
+	to date, tick after tick, for the given duration (in seconds).
+	"""
+	redis = redis_client or get_live_stats_redis()
+	all_series = [
+		get_player_class_distribution_series(game_type.name, redis_client=redis)
+		for game_type in PLAYER_CLASS_SERIES_GAME_TYPES
+	]
+	tick = all_series[0].tick
+	deadline = time.time() + duration
+
+	while True:
+		most_recent_tick_ts = get_most_recent_tick_ts(tick=tick, redis_client=redis)
+		for series in all_series:
+			series.update(most_recent_tick_ts)
+
+		next_tick_ts = most_recent_tick_ts + timedelta(seconds=tick)
+		sleep_duration = (next_tick_ts - datetime.utcnow()).total_seconds()
+		if time.time() + sleep_duration >= deadline:
+			break
+		time.sleep(max(sleep_duration, 0))
@@ -9,7 +9,8 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from hsreplaynet.live.distributions import (
-	get_live_stats_redis, get_played_cards_distribution, get_player_class_distribution
+	get_most_recent_tick_ts, get_played_cards_distribution,
+	get_player_class_distribution_series
 )
 
 
@@ -24,19 +25,6 @@ def _get_base_ts(bucket_size=5):
 	return base_ts
 
 
-def _get_most_recent_tick_ts(tick=5):
-	redis = get_live_stats_redis()
-	seconds_since_epoch, microseconds_into_current_second = redis.time()
-	current_ts = datetime.utcfromtimestamp(seconds_since_epoch)
-
-	td = timedelta(microseconds=current_ts.microsecond)
-	most_recent_tick_ts = current_ts - td
-	most_recent_tick_ts = most_recent_tick_ts - timedelta(
-		seconds=(most_recent_tick_ts.second % tick)
-	)
-	return most_recent_tick_ts
-
-
 def _validate_game_type(game_type_name):
 	if not hasattr(BnetGameType, game_type_name):
 		raise Http404("Invalid GameType")
@@ -53,28 +41,34 @@ def fetch_player_class_distribution(request, game_type_name):
 	# How many seconds between data points.
 	tick = int(request.GET.get("tick", 5))
 
-	player_class_popularity = get_player_class_distribution(game_type_name)
-
-	# base_ts ensures we generate the result at most once per bucket_size seconds
-	most_recent_tick_ts = _get_most_recent_tick_ts(tick=tick)
-	start_ts = most_recent_tick_ts - timedelta(seconds=lookback)
-	end_ts = start_ts + timedelta(seconds=window)
-
-	if _PLAYER_CLASS_CACHE[game_type_name].get("as_of", None) != most_recent_tick_ts:
-		result = []
-		while end_ts <= most_recent_tick_ts:
-			data = player_class_popularity.distribution(
-				start_ts=start_ts,
-				end_ts=end_ts
-			)
-			result.append({
-				"ts": int(end_ts.timestamp()),
-				"data": data
-			})
-			start_ts = start_ts + timedelta(seconds=tick)
+	# as_of ensures we generate the result at most once per tick
+	most_recent_tick_ts = get_most_recent_tick_ts(tick=tick)
+	as_of = (most_recent_tick_ts, lookback, window, tick)
+
+	if _PLAYER_CLASS_CACHE[game_type_name].get("as_of", None) != as_of:
+		# The default series are precomputed by update_live_distribution_series.
+		# When it lags behind, its last series is served rather than recomputed.
+		series = get_player_class_distribution_series(game_type_name)
+		if (lookback, window, tick) == (series.lookback, series.window, series.tick):
+			result = series.series(most_recent_tick_ts)
+		else:
+			result = []
+			player_class_popularity = series.distribution
+			start_ts = most_recent_tick_ts - timedelta(seconds=lookback)
 			end_ts = start_ts + timedelta(seconds=window)
+			while end_ts <= most_recent_tick_ts:
+				data = player_class_popularity.distribution(
+					start_ts=start_ts,
+					end_ts=end_ts
+				)
+				result.append({
+					"ts": int(end_ts.timestamp()),
+					"data": data
+				})
+				start_ts = start_ts + timedelta(seconds=tick)
+				end_ts = start_ts + timedelta(seconds=window)
 
-		_PLAYER_CLASS_CACHE[game_type_name]["as_of"] = most_recent_tick_ts
+		_PLAYER_CLASS_CACHE[game_type_name]["as_of"] = as_of
 		_PLAYER_CLASS_CACHE[game_type_name]["payload"] = result
 
 	return JsonResponse(
@@ -97,7 +91,7 @@ def fetch_played_cards_distribution(request):
 		BnetGameType.BGT_ARENA
 	]
 
-	if _PLAYER_CLASS_CACHE["ALL"].get("as_of", None) != base_ts:
+	if _PLAYED_CARDS_CACHE["ALL"].get("as_of", None) != base_ts:
 		payload = {}
 		for game_type in eligible_game_types:
 			played_cards_popularity = get_played_cards_distribution(game_type.name)
@@ -116,11 +110,11 @@ def fetch_played_cards_distribution(request):
 				})
 			payload[game_type.name] = result
 
-		_PLAYER_CLASS_CACHE["ALL"]["as_of"] = base_ts
-		_PLAYER_CLASS_CACHE["ALL"]["payload"] = payload
+		_PLAYED_CARDS_CACHE["ALL"]["as_of"] = base_ts
+		_PLAYED_CARDS_CACHE["ALL"]["payload"] = payload
 
 	return JsonResponse(
-		_PLAYER_CLASS_CACHE["ALL"].get("payload", {}),
+		_PLAYED_CARDS_CACHE["ALL"].get("payload", {}),
 		json_dumps_params=dict(indent=4)
 	)
 
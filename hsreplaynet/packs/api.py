@@ -1,7 +1,11 @@
-from rest_framework import serializers
+from django.db import transaction
+from django_hearthstone.cards.models import Card
+from rest_framework import serializers, status
 from rest_framework.authentication import SessionAuthentication
+from rest_framework.decorators import list_route
 from rest_framework.exceptions import ValidationError
 from rest_framework.mixins import CreateModelMixin, RetrieveModelMixin
+from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
 
 from hearthsim.identity.accounts.api import (
@@ -13,6 +17,7 @@ from .models import Pack, PackCard
 
 
 CARDS_PER_PACK = 5
+MAX_PACKS_PER_BATCH = 100
 
 
 class PackCardSerializer(serializers.ModelSerializer):
@@ -35,21 +40,108 @@ class PackSerializer(serializers.HyperlinkedModelSerializer):
 			"id", "booster_type", "date", "account_hi", "account_lo", "cards"
 		)
 
+	def validate_cards(self, value):
+		if len(value) != CARDS_PER_PACK:
+			raise ValidationError("Packs must contain exactly %r cards" % (CARDS_PER_PACK))
+		return value
+
 	def create(self, validated_data):
 		validated_data["user"] = self.context["request"].user
 		cards = validated_data.pop("cards")
-		if len(cards) != CARDS_PER_PACK:
-			raise ValidationError("Packs must contain exactly %r cards" % (CARDS_PER_PACK))
 		pack = Pack.objects.create(**validated_data)
-
-		for card in cards:
-			PackCard.objects.create(pack=pack, card=card["card"], premium=card["premium"])
+		PackCard.objects.bulk_create([
+			PackCard(pack=pack, card=card["card"], premium=card["premium"]) for card in cards
+		])
 
 		return pack
 
 
+class BatchPackCardSerializer(serializers.Serializer):
+	# Cards are looked up for the whole batch at once, see PackBatchSerializer
+	card = serializers.CharField()
+	premium = serializers.BooleanField(default=False)
+
+
+class BatchPackSerializer(PackSerializer):
+	cards = BatchPackCardSerializer(many=True, write_only=True)
+
+
+class PackBatchSerializer(serializers.Serializer):
+	"""
+	Validates and creates a batch of packs.
+	Each pack is validated on its own, and the packs which are valid are created with
+	a single INSERT for the packs and another one for all of their cards.
+	"""
+	packs = serializers.ListField(
+		child=serializers.DictField(), min_length=1, max_length=MAX_PACKS_PER_BATCH
+	)
+
+	def create_packs(self):
+		"""
+		Returns a list with the PackSerializer data of each created pack,
+		or {"errors": ...} for each invalid pack, in the order they were submitted.
+		"""
+		results = []
+		valid = []
+		for data in self.validated_data["packs"]:
+			serializer = BatchPackSerializer(data=data, context=self.context)
+			if serializer.is_valid():
+				valid.append((len(results), serializer.validated_data))
+				results.append(None)
+			else:
+				results.append({"errors": serializer.errors})
+
+		card_ids = set(card["card"] for _, pack in valid for card in pack["cards"])
+		known_card_ids = set(Card.objects.filter(pk__in=card_ids).values_list("pk", flat=True))
+
+		packs = []
+		for index, pack in valid:
+			unknown = sorted(set(c["card"] for c in pack["cards"]) - known_card_ids)
+			if unknown:
+				results[index] = {"errors": {"cards": ["Unknown cards: %s" % (", ".join(unknown))]}}
+				continue
+			packs.append((index, pack))
+
+		user = self.context["request"].user
+		with transaction.atomic():
+			created = Pack.objects.bulk_create([
+				Pack(user=user, **{k: v for k, v in pack.items() if k != "cards"})
+				for _, pack in packs
+			])
+			PackCard.objects.bulk_create([
+				PackCard(pack=obj, card_id=card["card"], premium=card["premium"])
+				for obj, (_, pack) in zip(created, packs) for card in pack["cards"]
+			])
+
+		for obj, (index, _) in zip(created, packs):
+			results[index] = PackSerializer(obj, context=self.context).data
+
+		return results
+
+
 class PackViewSet(CreateModelMixin, RetrieveModelMixin, GenericViewSet):
 	authentication_classes = (SessionAuthentication, AuthTokenAuthentication)
 	permission_classes = (IsOwnerOrStaff, RequireAuthToken, LegacyAPIKeyPermission)
 	queryset = Pack.objects.all()
 	serializer_class = PackSerializer
+
+	@list_route(methods=["post"])
+	def batch(self, request):
+		"""
+		Creates up to MAX_PACKS_PER_BATCH packs, submitted as {"packs": [...]}.
+		Responds with the result of each pack: 201 if all the packs were created,
+		207 if only some of them were and 400 if none were.
+		"""
+		serializer = PackBatchSerializer(data=request.data, context={"request": request})
+		serializer.is_valid(raise_exception=True)
+		results = serializer.create_packs()
+
+		errors = sum(1 for result in results if "errors" in result)
+		if not errors:
+			response_status = status.HTTP_201_CREATED
+		elif errors == len(results):
+			response_status = status.HTTP_400_BAD_REQUEST
+		else:
+			response_status = status.HTTP_207_MULTI_STATUS
+
+		return Response({"results": results}, status=response_status)
@@ -2,7 +2,7 @@ import csv
 import json
 from hashlib import sha256
 from hmac import HMAC
-from io import StringIO
+from itertools import groupby
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
@@ -11,6 +11,9 @@ from hearthstone.enums import BnetRegion, Booster
 from ...models import Pack, PackCard
 
 
+EXPORT_CHUNK_SIZE = 5000
+
+
 VALID_BOOSTERS = [bt.name for bt in Booster.__members__.values()]
 
 
@@ -30,21 +33,27 @@ class Command(BaseCommand):
 		)
 		parser.add_argument("--format", choices=("csv", "json"), default="csv")
 
-	def get_rows(self, qs):
-		rows = []
-		for pack in qs:
-			cards = PackCard.objects.filter(pack=pack)
-			region = BnetRegion.from_account_hi(pack.account_hi)
+	def get_rows(self, qs, chunk_size=EXPORT_CHUNK_SIZE):
+		"""
+		Yields the row of each pack in qs (which have any cards), with its cards.
+		The cards of all the packs are read in one query, with a server-side cursor.
+		"""
+		cards = PackCard.objects.filter(pack__in=qs).order_by("pack_id", "id").values_list(
+			"pack_id", "pack__user_id", "pack__account_hi", "pack__account_lo",
+			"pack__booster_type", "pack__date", "card_id", "premium"
+		)
+		for pack_id, pack_cards in groupby(cards.iterator(chunk_size=chunk_size), lambda c: c[0]):
+			pack_cards = list(pack_cards)
+			_, user_id, account_hi, account_lo, booster_type, date, _, _ = pack_cards[0]
+			region = BnetRegion.from_account_hi(account_hi)
 			row = [
-				pack.id, anonymize(pack.user_id), anonymize(pack.account_lo),
-				pack.booster_type.name, pack.date.isoformat(),
+				pack_id, anonymize(user_id), anonymize(account_lo),
+				Booster(booster_type).name, date.isoformat(),
 				region.name
 			]
-			for card in cards:
-				row += [card.card_id, int(card.premium)]
-			rows.append(row)
-
-		return rows
+			for card in pack_cards:
+				row += [card[6], int(card[7])]
+			yield row
 
 	def handle(self, *args, **options):
 		packs = Pack.objects.all()
@@ -58,16 +67,14 @@ class Command(BaseCommand):
 			packs = packs.filter(user__username=username)
 
 		rows = self.get_rows(packs)
-		value = ""
 
 		format = options["format"]
 		if format == "csv":
-			s = StringIO()
-			writer = csv.writer(s)
+			writer = csv.writer(self.stdout)
 			for row in rows:
 				writer.writerow(row)
-			value = s.getvalue()
 		elif format == "json":
-			value = json.dumps(rows, indent="\t")
-
-		self.stdout.write(value)
+			self.stdout.write("[", ending="")
+			for i, row in enumerate(rows):
+				self.stdout.write((",\n\t" if i else "\n\t") + json.dumps(row), ending="")
+			self.stdout.write("\n]")
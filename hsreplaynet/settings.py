@@ -429,6 +429,14 @@ REDSHIFT_USE_MATCH_START_AS_GAME_DATE = False
 #  20 Minutes = 1200
 MINIMUM_QUERY_REFRESH_INTERVAL = 1200
 
+# Results of global queries are kept in each worker's memory for this many seconds
+# (0 disables the worker cache), up to QUERY_RESULT_CACHE_MAX_BYTES per worker.
+QUERY_RESULT_CACHE_TTL = 30
+QUERY_RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# The fraction of query fetches which are reported to Influx
+REDSHIFT_QUERY_METRICS_SAMPLE_RATE = 0.1
+
 ARCHETYPE_QUERIES_FOR_IMMEDIATE_REFRESH = [
 	"head_to_head_archetype_matchups",
 	"archetype_popularity_distribution_stats",
@@ -464,6 +472,10 @@ WEBHOOKS = {
 DECK_PREDICTION_MINIMUM_CARDS = 5
 # Set false to increase redis brute force search efficiency
 INCLUDE_CURRENT_HOUR_IN_LOOKUP = False
+# Run the whole deck prediction lookup as a single Lua script on the replica, rather
+# than with a few round trips per tree level. This requires a single node Redis (see
+# DeckPredictionTree.LOOKUP_SCRIPT).
+DECK_PREDICTION_SERVER_SIDE_LOOKUP = True
 DETAILED_PREDICTION_METRICS = False
 
 # Used in some pages such as /downloads
@@ -24,4 +24,5 @@ class Command(BaseCommand):
 			created__lte=to_date
 		)
 
-		queue_upload_events_for_reprocessing(uploads, use_kinesis=True)
+		count = queue_upload_events_for_reprocessing(uploads, use_kinesis=True)
+		self.stdout.write("Queued %i upload events for reprocessing" % (count))
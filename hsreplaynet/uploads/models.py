@@ -27,6 +27,8 @@ from hsreplaynet.utils.influx import influx_metric, influx_timer
 from hsreplaynet.utils.instrumentation import error_handler
 from hsreplaynet.utils.synchronization import advisory_lock
 
+from .utils import RetryingStream
+
 
 def get_handle_status(handle, min_statements=1):
 	"""
@@ -130,10 +132,11 @@ class RawUpload(object):
 	LOG_KEY_PATTERN = r"(?P<prefix>raw|uploads)/(?P<ts>[\d/]{16})/(?P<shortid>\w{22})\.(?:power|canary)\.log"  # noqa
 	TIMESTAMP_FORMAT = "%Y/%m/%d/%H/%M"
 
-	def __init__(self, bucket, key):
+	def __init__(self, bucket, key, upload_event=None):
 		self.bucket = bucket
 		self.log_key = key
 		self.upload_event = None
+		self._descriptor_json = None
 		self._descriptor_on_postgres = False
 		self._descriptor_on_s3 = False
 
@@ -151,9 +154,11 @@ class RawUpload(object):
 			self._descriptor = None
 		elif groups["prefix"] == "uploads":
 			self.state = RawUploadState.HAS_UPLOAD_EVENT
-			self.upload_event = UploadEvent.objects.get(shortid=self.shortid)
-			self.descriptor_json = self.upload_event.descriptor_data
-			self._descriptor = json.loads(self.descriptor_json)
+			if upload_event is None:
+				upload_event = UploadEvent.objects.get(shortid=self.shortid)
+			self.upload_event = upload_event
+			# Lazy-loaded from the upload event
+			self._descriptor = None
 		else:
 			assert False
 
@@ -197,7 +202,7 @@ class RawUpload(object):
 		bucket = settings.AWS_STORAGE_BUCKET_NAME
 		log_key = str(event.file)
 
-		return RawUpload(bucket, log_key)
+		return RawUpload(bucket, log_key, upload_event=event)
 
 	@staticmethod
 	def from_kinesis_event(kinesis_event):
@@ -247,10 +252,23 @@ class RawUpload(object):
 			HttpMethod="GET"
 		)
 
+	@property
+	def descriptor_json(self):
+		if self._descriptor_json is None and self.state == RawUploadState.HAS_UPLOAD_EVENT:
+			self._descriptor_json = self.upload_event.descriptor_data
+		return self._descriptor_json
+
+	@descriptor_json.setter
+	def descriptor_json(self, value):
+		self._descriptor_json = value
+
 	@property
 	def descriptor(self):
 		if self._descriptor is None:
-			self._load_descriptor()
+			if self.state == RawUploadState.HAS_UPLOAD_EVENT:
+				self._descriptor = json.loads(self.descriptor_json)
+			else:
+				self._load_descriptor()
 		return self._descriptor
 
 	def _load_descriptor(self):
@@ -436,6 +454,29 @@ class UploadEvent(models.Model):
 
 		return self.file.read()
 
+	def open_log_stream(self):
+		"""
+		Returns a binary file-like object for the log file.
+		On S3, the object body is streamed rather than downloaded up front.
+		Read timeouts are retried once, resuming from where the stream left off.
+		"""
+		from botocore.vendored.requests.packages.urllib3.exceptions import ReadTimeoutError
+
+		if settings.AWS_STORAGE_BUCKET_NAME and aws.S3:
+			def open_at(offset):
+				kwargs = {"Range": "bytes=%i-" % (offset)} if offset else {}
+				obj = aws.clients.get_s3_client().get_object(
+					Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=str(self.file), **kwargs
+				)
+				return obj["Body"]
+		else:
+			def open_at(offset):
+				self.file.open(mode="rb")
+				self.file.seek(offset)
+				return self.file
+
+		return RetryingStream(open_at, ReadTimeoutError)
+
 	def process(self):
 		from hsreplaynet.games.processing import process_upload_event
 
@@ -2,15 +2,22 @@
 A module for scheduling UploadEvents to be processed or reprocessed.
 """
 import logging
+import time
 
 from django.conf import settings
+from django.db.models import QuerySet
 
 from hsreplaynet.uploads.models import RawUpload
 from hsreplaynet.utils import aws
+from hsreplaynet.utils.influx import influx_metric
 
 
 logger = logging.getLogger(__file__)
 
+# The number of UploadEvents fetched per round trip when streaming a queryset
+REPROCESSING_CHUNK_SIZE = 2000
+REPROCESSING_PROGRESS_INTERVAL = 10
+
 
 def queue_raw_uploads_for_processing(attempt_reprocessing, limit=None):
 	"""
@@ -51,24 +58,86 @@ def current_raw_upload_bucket_size():
 	return aws.get_bucket_size(settings.S3_RAW_LOG_UPLOAD_BUCKET)
 
 
-def _generate_raw_uploads_from_events(events):
+def _generate_raw_uploads_from_events(events, chunk_size=REPROCESSING_CHUNK_SIZE):
+	"""
+	Yields a RawUpload, flagged for reprocessing, for each of the events.
+	Querysets are streamed, with only the fields a RawUpload needs.
+	"""
+	if isinstance(events, QuerySet):
+		events = events.only("id", "shortid", "file").iterator(chunk_size=chunk_size)
+
 	for event in events:
 		raw_upload = RawUpload.from_upload_event(event)
 		raw_upload.attempt_reprocessing = True
 		yield raw_upload
 
 
+class ReprocessingProgress:
+	"""
+	Counts the items of an iterable as they are consumed, and periodically
+	logs (and reports to Influx) the progress and throughput.
+	"""
+	def __init__(self, iterable, total=None, interval=REPROCESSING_PROGRESS_INTERVAL):
+		self.iterable = iterable
+		self.total = total
+		self.interval = interval
+		self.count = 0
+		self.start = None
+		self._last_report = None
+
+	def __iter__(self):
+		self.start = self._last_report = time.time()
+		for item in self.iterable:
+			self.count += 1
+			yield item
+			if time.time() - self._last_report >= self.interval:
+				self.report()
+		self.report()
+
+	@property
+	def throughput(self):
+		elapsed = time.time() - self.start if self.start else 0
+		return self.count / elapsed if elapsed else 0.0
+
+	def report(self):
+		self._last_report = time.time()
+		if self.total:
+			progress = "%i/%i (%.1f%%)" % (self.count, self.total, 100 * self.count / self.total)
+		else:
+			progress = str(self.count)
+		logger.info(
+			"Queued %s upload events for reprocessing (%.1f/s)", progress, self.throughput
+		)
+		influx_metric("upload_reprocessing_progress", {
+			"count": self.count,
+			"total": self.total or 0,
+			"throughput": self.throughput,
+		})
+
+
 def queue_upload_events_for_reprocessing(events, use_kinesis=False):
+	"""
+	Queues events (a queryset or an iterable of UploadEvents) for reprocessing.
+	Returns the number of events which were queued.
+	"""
 	if settings.ENV_AWS or use_kinesis:
 		from hsreplaynet.utils.aws.streams import fill_stream_from_iterable
-		iterable = _generate_raw_uploads_from_events(events)
+		if isinstance(events, QuerySet):
+			total = events.count()
+		else:
+			total = len(events) if hasattr(events, "__len__") else None
+		progress = ReprocessingProgress(_generate_raw_uploads_from_events(events), total)
 		publisher_func = aws.publish_raw_upload_batch_to_processing_stream
 		stream_name = settings.KINESIS_UPLOAD_PROCESSING_STREAM_NAME
-		fill_stream_from_iterable(stream_name, iterable, publisher_func)
+		fill_stream_from_iterable(stream_name, iter(progress), publisher_func)
+		return progress.count
 	else:
+		count = 0
 		for event in events:
 			logger.info("Processing UploadEvent %r locally", event)
 			event.process()
+			count += 1
+		return count
 
 
 def queue_upload_event_for_reprocessing(event):
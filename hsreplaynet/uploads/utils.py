@@ -0,0 +1,130 @@
+import codecs
+import time
+import zlib
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# Size of the chunks pulled from the underlying file object
+DEFAULT_CHUNK_SIZE = 256 * 1024
+
+
+class LogStreamReader:
+	"""
+	Iterates over the lines of a (possibly gzipped) binary log stream.
+
+	The stream is read in chunks of `chunk_size` bytes, decompressed on the fly
+	if it starts with the gzip magic bytes, and decoded as UTF-8. Only a single
+	chunk and the current partial line are held in memory at any time, so this
+	can be fed directly to LogParser.read() without materializing the log.
+	"""
+
+	def __init__(self, fp, chunk_size=DEFAULT_CHUNK_SIZE):
+		self.fp = fp
+		self.chunk_size = chunk_size
+		self.bytes_read = 0
+		self.bytes_decoded = 0
+		self.compressed = False
+		self._start_time = None
+		self._stop_time = None
+
+	def __iter__(self):
+		decoder = codecs.getincrementaldecoder("utf-8")()
+		buffer = ""
+		for chunk in self._decompressed_chunks():
+			self.bytes_decoded += len(chunk)
+			buffer += decoder.decode(chunk)
+			lines = buffer.split("\n")
+			buffer = lines.pop()
+			for line in lines:
+				yield line + "\n"
+
+		buffer += decoder.decode(b"", final=True)
+		if buffer:
+			yield buffer
+
+	def _raw_chunks(self):
+		self._start_time = time.time()
+		while True:
+			chunk = self.fp.read(self.chunk_size)
+			if not chunk:
+				break
+			self.bytes_read += len(chunk)
+			yield chunk
+		self._stop_time = time.time()
+
+	def _decompressed_chunks(self):
+		chunks = self._raw_chunks()
+		head = b""
+		for chunk in chunks:
+			head += chunk
+			if len(head) >= len(GZIP_MAGIC):
+				break
+
+		if not head.startswith(GZIP_MAGIC):
+			if head:
+				yield head
+			yield from chunks
+			return
+
+		self.compressed = True
+		decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		yield decompressor.decompress(head)
+		for chunk in chunks:
+			yield decompressor.decompress(chunk)
+		yield decompressor.flush()
+
+	@property
+	def duration(self):
+		if self._start_time is None:
+			return 0
+		if self._stop_time is None:
+			return time.time() - self._start_time
+		return self._stop_time - self._start_time
+
+	@property
+	def bytes_per_second(self):
+		duration = self.duration
+		if not duration:
+			return 0
+		return self.bytes_read / duration
+
+
+class RetryingStream:
+	"""
+	A binary file-like object which reopens its stream where it left off, after waiting
+	`delay` seconds, when opening or reading it raises one of `exceptions`.
+
+	`open_at(offset)` must return a file-like object positioned at `offset`. Up to
+	`max_retries` consecutive failures are retried before the exception is raised.
+	"""
+
+	def __init__(self, open_at, exceptions, max_retries=1, delay=1):
+		self.open_at = open_at
+		self.exceptions = exceptions
+		self.max_retries = max_retries
+		self.delay = delay
+		self.offset = 0
+		self._fp = None
+
+	def read(self, size=-1):
+		retries = 0
+		while True:
+			try:
+				if self._fp is None:
+					self._fp = self.open_at(self.offset)
+				data = self._fp.read(size)
+			except self.exceptions:
+				if retries >= self.max_retries:
+					raise
+				retries += 1
+				self.close()
+				time.sleep(self.delay)
+			else:
+				self.offset += len(data)
+				return data
+
+	def close(self):
+		if self._fp is not None:
+			fp, self._fp = self._fp, None
+			fp.close()
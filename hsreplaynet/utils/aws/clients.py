@@ -1,3 +1,5 @@
+import os
+
 import boto3
 from django.conf import settings
 
@@ -12,3 +14,16 @@ if settings.CONNECT_TO_AWS:
 else:
 	# Stubbed to prevent ImportErrors
 	IAM, LAMBDA, KINESIS, S3, FIREHOSE, SQS = None, None, None, None, None, None
+
+
+_clients_pid = os.getpid()
+
+
+def get_s3_client():
+	"""
+	Returns the shared S3 client, or a new one when called from a forked process.
+	boto3 clients hold on to their connection pool and cannot be shared across processes.
+	"""
+	if S3 is None or os.getpid() == _clients_pid:
+		return S3
+	return boto3.client("s3")
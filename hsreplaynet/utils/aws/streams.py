@@ -1,5 +1,9 @@
 import logging
+import threading
 import time
+from bisect import bisect_right
+from collections import deque
+from hashlib import md5
 from math import ceil, log
 
 from django.conf import settings
@@ -12,74 +16,301 @@ from .clients import FIREHOSE, IAM, KINESIS
 logger = logging.getLogger("hsreplaynet")
 
 KINESIS_WRITES_PER_SEC = 1000
+KINESIS_BYTES_PER_SEC = 1024 * 1024
 KINESIS_MAX_BATCH_WRITE_SIZE = 500
+KINESIS_MAX_BATCH_WRITE_BYTES = 5 * 1024 * 1024
 MAX_WRITES_SAFETY_LIMIT = .8
 
 
-def publish_from_iterable_at_fixed_speed(
-	iterable,
-	publisher_func,
-	max_records_per_second,
-	publish_batch_size=1
-):
-	if max_records_per_second == 0:
-		raise ValueError("times_per_second must be greater than 0!")
+class TokenBucket:
+	"""
+	A token bucket refilled at rate tokens per second, holding up to one second
+	of tokens. Not thread safe: each bucket is only used by one writer.
+	"""
+	def __init__(self, rate):
+		self.rate = rate
+		self.tokens = rate
+		self.updated = time.time()
 
-	finished = False
-	while not finished:
+	def refill(self):
+		now = time.time()
+		self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+	def set_rate(self, rate):
+		self.refill()
+		self.rate = rate
+		self.tokens = min(self.tokens, rate)
+
+	def available(self):
+		self.refill()
+		return self.tokens
+
+	def delay(self, amount):
+		"""Returns how many seconds to wait until amount tokens are available."""
+		# Amounts larger than the bucket only need a full bucket
+		amount = min(amount, self.rate)
+		return max(0.0, (amount - self.available()) / self.rate)
+
+	def consume(self, amount):
+		self.tokens -= amount
+
+
+class _PendingRecord:
+	__slots__ = ("record", "size", "attempt", "ready_at")
+
+	def __init__(self, record, size):
+		self.record = record
+		self.size = size
+		self.attempt = 0
+		self.ready_at = 0
+
+
+class ShardWriter:
+	"""
+	The records waiting to be written to a shard, and its throughput limits.
+
+	The rate starts at MAX_WRITES_SAFETY_LIMIT of the shard capacity. It is halved
+	whenever the shard reports ProvisionedThroughputExceeded (eg. because of other
+	producers), and grows back by RATE_INCREASE after each successful batch.
+	"""
+	MIN_SCALE = 0.1
+	RATE_INCREASE = 0.05
+	# Batches are only sent with fewer records when fewer are waiting
+	MIN_BATCH_SIZE = 100
+
+	def __init__(self, shard_id, starting_hash_key):
+		self.shard_id = shard_id
+		self.starting_hash_key = starting_hash_key
+		self.scale = MAX_WRITES_SAFETY_LIMIT
+		self.records = TokenBucket(KINESIS_WRITES_PER_SEC * self.scale)
+		self.bytes = TokenBucket(KINESIS_BYTES_PER_SEC * self.scale)
+		self.pending = deque()
+		self.retries = []
+
+	def __len__(self):
+		return len(self.pending) + len(self.retries)
+
+	def _set_scale(self, scale):
+		self.scale = scale
+		self.records.set_rate(KINESIS_WRITES_PER_SEC * scale)
+		self.bytes.set_rate(KINESIS_BYTES_PER_SEC * scale)
+
+	def throttled(self):
+		self._set_scale(max(self.MIN_SCALE, self.scale / 2))
+
+	def succeeded(self):
+		if self.scale < 1:
+			self._set_scale(min(1.0, self.scale + self.RATE_INCREASE))
+
+	def retry(self, pending_record, backoff):
+		pending_record.attempt += 1
+		pending_record.ready_at = time.time() + backoff * 2 ** (pending_record.attempt - 1)
+		self.retries.append(pending_record)
+
+	def next_batch(self):
+		"""
+		Returns the records which can be written now, within the batch and
+		throughput limits of the shard. Records being retried come first.
+		"""
+		now = time.time()
+		ready = [r for r in self.retries if r.ready_at <= now]
+		if ready:
+			self.retries = [r for r in self.retries if r.ready_at > now]
+
+		batch, batch_bytes = [], 0
+		record_tokens = min(self.records.available(), KINESIS_MAX_BATCH_WRITE_SIZE)
+		byte_tokens = min(self.bytes.available(), KINESIS_MAX_BATCH_WRITE_BYTES)
+		if record_tokens < min(len(ready) + len(self.pending), self.MIN_BATCH_SIZE):
+			# Wait for enough tokens, rather than sending lots of tiny batches
+			self.retries += ready
+			return batch
+
+		while ready or self.pending:
+			pending_record = ready[0] if ready else self.pending[0]
+			if len(batch) + 1 > record_tokens or batch_bytes + pending_record.size > byte_tokens:
+				if batch or self.delay(pending_record) > 0:
+					break
+			batch.append(ready.pop(0) if ready else self.pending.popleft())
+			batch_bytes += pending_record.size
+
+		# Put back the retries which did not fit in the batch
+		self.retries += ready
+		self.records.consume(len(batch))
+		self.bytes.consume(batch_bytes)
+		return batch
+
+	def delay(self, pending_record=None):
+		"""Returns how long to wait before the next record can be written."""
+		now = time.time()
+		if pending_record is None:
+			if self.pending:
+				pending_record = self.pending[0]
+			elif self.retries:
+				pending_record = min(self.retries, key=lambda r: r.ready_at)
+			else:
+				return None
+
+		return max(
+			pending_record.ready_at - now,
+			self.records.delay(min(len(self.pending) or 1, self.MIN_BATCH_SIZE)),
+			self.bytes.delay(pending_record.size),
+		)
+
+
+class KinesisPublisher:
+	"""
+	Publishes records to a Kinesis stream as fast as its shards allow.
+
+	Records are routed to the shard their partition key hashes to. Each shard has
+	token buckets for its record and byte limits (1000 records and 1MB per second),
+	and shards are written to concurrently, by up to max_workers writer threads.
+	When put_records partially fails, only the failed records are retried, with an
+	exponential backoff, up to max_attempts times.
+
+	publisher_func(records) is called with each batch and must return the
+	put_records response. Records need kinesis_data and kinesis_partition_key.
+	"""
+	RETRY_BACKOFF = 0.2
+	MAX_PENDING_PER_SHARD = 2 * KINESIS_MAX_BATCH_WRITE_SIZE
+
+	def __init__(self, stream_name, publisher_func, max_workers=8, max_attempts=5):
+		self.stream_name = stream_name
+		self.publisher_func = publisher_func
+		self.max_workers = max_workers
+		self.max_attempts = max_attempts
+		self.published = 0
+		self.failed = 0
+		self.retried = 0
+		self._stats_lock = threading.Lock()
+		self._producer_done = threading.Event()
+		self._error = None
+
+	def get_shards(self):
+		shards = sorted(
+			get_open_shards(self.stream_name),
+			key=lambda s: int(s["HashKeyRange"]["StartingHashKey"])
+		)
+		return [
+			ShardWriter(s["ShardId"], int(s["HashKeyRange"]["StartingHashKey"])) for s in shards
+		]
+
+	def publish(self, iterable):
+		"""Publishes all the records of iterable. Returns the number of records published."""
+		shards = self.get_shards()
+		if not shards:
+			raise ValueError("Stream %s has no open shards" % (self.stream_name))
+		starting_keys = [shard.starting_hash_key for shard in shards]
+		max_pending = self.MAX_PENDING_PER_SHARD * len(shards)
+		self._slots = threading.BoundedSemaphore(max_pending)
+
+		num_workers = max(1, min(self.max_workers, len(shards)))
+		threads = [
+			threading.Thread(target=self._write, args=(shards[i::num_workers], ))
+			for i in range(num_workers)
+		]
+		for thread in threads:
+			thread.start()
+
+		start = time.time()
 		try:
-			start_time = time.time()
-			records_this_second = 0
-			while not finished and records_this_second < max_records_per_second:
-				# NOTE: If the aggregate data published exceeds 1MB / second there will
-				# be write throughput failures.
-				# As Of 9-20-16 the average record was ~ 180 Bytes
-				# 180 Bytes * 1000 = 180KB (which is well below the threshold)
-				batch = next_record_batch_of_size(iterable, publish_batch_size)
-				if batch:
-					records_this_second += len(batch)
-					publisher_func(batch)
-				else:
-					finished = True
-
-			if not finished:
-				elapsed_time = time.time() - start_time
-				sleep_duration = 1 - elapsed_time
-				if sleep_duration > 0:
-					time.sleep(sleep_duration)
-		except StopIteration:
-			finished = True
-
-
-def next_record_batch_of_size(iterable, max_batch_size):
-	result = []
-	count = 0
-	record = next(iterable, None)
-	while record and count < max_batch_size:
-		result.append(record)
-		count += 1
-		record = next(iterable, None)
-	return result
+			for record in iterable:
+				while not self._slots.acquire(timeout=1):
+					if self._error:
+						break
+				if self._error:
+					break
+				hash_key = int(md5(record.kinesis_partition_key.encode("utf-8")).hexdigest(), 16)
+				shard = shards[bisect_right(starting_keys, hash_key) - 1]
+				size = len(record.kinesis_data) + len(record.kinesis_partition_key)
+				shard.pending.append(_PendingRecord(record, size))
+		finally:
+			self._producer_done.set()
+			for thread in threads:
+				thread.join()
+
+		if self._error:
+			raise self._error
+
+		elapsed = time.time() - start
+		logger.info(
+			"Published %i records to %s in %.1fs (%.1f/s), %i retried, %i failed",
+			self.published, self.stream_name, elapsed, self.published / max(elapsed, 1e-6),
+			self.retried, self.failed
+		)
+		return self.published
+
+	def _write(self, shards):
+		try:
+			while True:
+				wrote = False
+				for shard in shards:
+					batch = shard.next_batch()
+					if batch:
+						self._publish_batch(shard, batch)
+						wrote = True
+
+				if wrote:
+					continue
+
+				delays = [d for d in (shard.delay() for shard in shards) if d is not None]
+				if not delays and self._producer_done.is_set():
+					# Check again, the producer may have added records meanwhile
+					if not any(len(shard) for shard in shards):
+						return
+				time.sleep(max(0.005, min(delays + [0.05])))
+		except Exception as e:
+			self._error = e
+			raise
+
+	def _publish_batch(self, shard, batch):
+		try:
+			response = self.publisher_func([r.record for r in batch])
+		except Exception as e:
+			logger.warning("put_records to shard %s failed: %r", shard.shard_id, e)
+			shard.throttled()
+			results = [{"ErrorCode": type(e).__name__}] * len(batch)
+		else:
+			results = (response or {}).get("Records") or [{}] * len(batch)
+
+		published, failed, retried = 0, 0, 0
+		throttled = False
+		for pending_record, result in zip(batch, results):
+			if "ErrorCode" not in result:
+				published += 1
+				self._slots.release()
+				continue
+
+			throttled = throttled or result["ErrorCode"] == "ProvisionedThroughputExceededException"
+			if pending_record.attempt + 1 >= self.max_attempts:
+				failed += 1
+				self._slots.release()
+				logger.error(
+					"Dropping record %r after %i attempts: %s",
+					pending_record.record, pending_record.attempt + 1, result["ErrorCode"]
+				)
+			else:
+				retried += 1
+				shard.retry(pending_record, self.RETRY_BACKOFF)
+
+		if throttled:
+			shard.throttled()
+		elif not retried and not failed:
+			shard.succeeded()
+
+		with self._stats_lock:
+			self.published += published
+			self.failed += failed
+			self.retried += retried
 
 
 def fill_stream_from_iterable(stream_name, iterable, publisher_func):
 	"""
-	Invoke func on the next item from iter at the maximum throughput the stream supports.
+	Publish every record from iterable with publisher_func, at the maximum
+	throughput the stream supports (see KinesisPublisher).
 	"""
-	stream_size = current_stream_size(stream_name)
-	max_transactions_per_sec = stream_size * KINESIS_WRITES_PER_SEC
-	target_writes_per_sec = ceil(max_transactions_per_sec * MAX_WRITES_SAFETY_LIMIT)
-	logger.info(
-		"About to fill stream %s at a target of %s writes per second" %
-		(stream_name, target_writes_per_sec)
-	)
-
-	publish_from_iterable_at_fixed_speed(
-		iterable,
-		publisher_func,
-		target_writes_per_sec,
-		publish_batch_size=KINESIS_MAX_BATCH_WRITE_SIZE
-	)
+	logger.info("About to fill stream %s", stream_name)
+	return KinesisPublisher(stream_name, publisher_func).publish(iterable)
 
 
 def resize_upload_processing_stream(num_shards=None):
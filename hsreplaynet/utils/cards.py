@@ -0,0 +1,118 @@
+"""
+A process-wide cache of the card database.
+
+Replay processing needs card metadata (type, class, dbf id...) for every hero and for
+every card of the decks it sees. Rather than querying the card table each time, the
+whole table is loaded once per worker into a CardLookup, which is indexed by card_id
+and by dbf_id.
+
+The lookup is versioned on a card data version kept in the shared cache, which is
+bumped whenever a card is saved or deleted (see bump_card_data_version()). Each worker
+checks it at most once per VERSION_CHECK_INTERVAL_SECONDS. The lookup is also reloaded
+(at most once per RELOAD_INTERVAL_SECONDS) when a card cannot be found, since that
+usually means new cards have been loaded into the database since it was built.
+"""
+import time
+from uuid import uuid4
+
+from django.core.cache import caches
+
+from . import log
+
+
+RELOAD_INTERVAL_SECONDS = 60
+VERSION_CHECK_INTERVAL_SECONDS = 60
+CARD_DATA_VERSION_CACHE_KEY = "CARD_DATA_VERSION"
+
+
+class CardLookup:
+	def __init__(self, cards, version):
+		self.version = version
+		self.created = time.time()
+		self.by_card_id = {}
+		self.by_dbf_id = {}
+		for card in cards:
+			self.by_card_id[card.card_id] = card
+			if card.dbf_id:
+				self.by_dbf_id[card.dbf_id] = card
+
+	def __len__(self):
+		return len(self.by_card_id)
+
+	def get(self, card_id=None, dbf_id=None):
+		"""
+		Returns the card matching either card_id or dbf_id.
+		Raises Card.DoesNotExist, like Card.objects.get() would.
+		"""
+		from django_hearthstone.cards.models import Card
+
+		if dbf_id is not None:
+			card = self.by_dbf_id.get(int(dbf_id))
+		else:
+			card = self.by_card_id.get(card_id)
+
+		if card is None:
+			raise Card.DoesNotExist("Card %r not found" % (card_id or dbf_id))
+
+		return card
+
+
+_lookup_cache = {}
+_version_cache = {}
+
+
+def get_card_data_version():
+	version, checked = _version_cache.get("version", (None, 0))
+	if version is None or time.time() - checked > VERSION_CHECK_INTERVAL_SECONDS:
+		cache = caches["default"]
+		version = cache.get(CARD_DATA_VERSION_CACHE_KEY)
+		if version is None:
+			cache.add(CARD_DATA_VERSION_CACHE_KEY, uuid4().hex, None)
+			version = cache.get(CARD_DATA_VERSION_CACHE_KEY)
+		_version_cache["version"] = (version, time.time())
+	return version
+
+
+def bump_card_data_version():
+	"""Makes every worker reload its lookup on their next version check."""
+	caches["default"].set(CARD_DATA_VERSION_CACHE_KEY, uuid4().hex, None)
+	_version_cache.clear()
+
+
+def load_card_lookup():
+	from django_hearthstone.cards.models import Card
+
+	version = get_card_data_version()
+	lookup = CardLookup(Card.objects.all(), version)
+	log.debug("Loaded %i cards into the card lookup (version=%r)", len(lookup), version)
+	return lookup
+
+
+def get_card_lookup():
+	lookup = _lookup_cache.get("lookup")
+	if lookup is None or lookup.version != get_card_data_version():
+		lookup = load_card_lookup()
+		_lookup_cache["lookup"] = lookup
+	return lookup
+
+
+def invalidate_card_lookup():
+	_lookup_cache.pop("lookup", None)
+
+
+def get_card(card_id=None, dbf_id=None):
+	"""
+	Returns a card by card_id or dbf_id from the process-wide lookup.
+	A missing card triggers a (rate limited) reload of the lookup before giving up.
+	"""
+	from django_hearthstone.cards.models import Card
+
+	lookup = get_card_lookup()
+	try:
+		return lookup.get(card_id=card_id, dbf_id=dbf_id)
+	except Card.DoesNotExist:
+		if time.time() - lookup.created < RELOAD_INTERVAL_SECONDS:
+			raise
+
+	invalidate_card_lookup()
+	return get_card_lookup().get(card_id=card_id, dbf_id=dbf_id)
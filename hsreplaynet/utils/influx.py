@@ -1,6 +1,10 @@
 """Utils for interacting with Influx"""
+import os
+import random
 import resource
+import threading
 import time
+from collections import deque
 from contextlib import contextmanager
 
 from django.conf import settings
@@ -50,17 +54,131 @@ else:
 	influx = None
 
 
-def influx_write_payload(payload, client=influx):
+class InfluxBuffer:
+	"""
+	Buffers points in memory and writes them to Influx in batches from a
+	background thread, once batch_size points are waiting or every flush_interval
+	seconds, whichever comes first.
+
+	Adding a point never blocks on the network: once max_size points are waiting,
+	new points are dropped and counted. The number of dropped points is reported
+	as the influx_dropped_points measurement with the next batch.
+	"""
+
+	def __init__(self, client, max_size=10000, batch_size=500, flush_interval=1.0):
+		self.client = client
+		self.max_size = max_size
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.dropped = 0
+		self.failed = 0
+		self._reset()
+
+	def _reset(self):
+		self._pid = os.getpid()
+		self._points = deque()
+		self._lock = threading.Lock()
+		self._flush_lock = threading.Lock()
+		self._wakeup = threading.Event()
+		self._thread = None
+		self._unreported_drops = 0
+
+	def __len__(self):
+		return len(self._points)
+
+	def add(self, points):
+		if self._pid != os.getpid():
+			# The buffer, locks and thread of the parent are useless in a forked process
+			self._reset()
+
+		with self._lock:
+			available = self.max_size - len(self._points)
+			if len(points) > available:
+				self.dropped += len(points) - max(available, 0)
+				self._unreported_drops += len(points) - max(available, 0)
+				points = points[:max(available, 0)]
+			self._points.extend(points)
+			pending = len(self._points)
+
+		self._ensure_thread()
+		if pending >= self.batch_size:
+			self._wakeup.set()
+
+	def flush(self):
+		"""Synchronously write all the buffered points."""
+		with self._flush_lock:
+			while True:
+				batch = self._take_batch()
+				if not batch:
+					break
+				self._write(batch)
+
+	def _take_batch(self):
+		with self._lock:
+			batch = []
+			while self._points and len(batch) < self.batch_size:
+				batch.append(self._points.popleft())
+			if batch and self._unreported_drops:
+				batch.append({
+					"measurement": "influx_dropped_points",
+					"tags": {},
+					"fields": {"count": self._unreported_drops},
+					"time": now().isoformat(),
+				})
+				self._unreported_drops = 0
+			return batch
+
+	def _write(self, batch):
+		try:
+			result = self.client.write_points(batch)
+			if not result:
+				self.failed += len(batch)
+				log.warning("Influx write failure")
+		except Exception:
+			self.failed += len(batch)
+			log.exception("Exception while writing to influx.")
+
+	def _ensure_thread(self):
+		if self._thread is not None and self._thread.is_alive():
+			return
+
+		with self._lock:
+			if self._thread is None or not self._thread.is_alive():
+				self._thread = threading.Thread(
+					target=self._run, name="InfluxBuffer", daemon=True
+				)
+				self._thread.start()
+
+	def _run(self):
+		while True:
+			self._wakeup.wait(self.flush_interval)
+			self._wakeup.clear()
+			self.flush()
+
+
+_influx_buffers = {}
+
+
+def get_influx_buffer(client=influx):
 	if client is None:
-		return
+		return None
 
-	try:
-		result = client.write_points(payload)
-		if not result:
-			log.warn("Influx write failure")
-	except Exception as e:
-		log.exception("Exception while writing to influx.")
-		result = None
+	if id(client) not in _influx_buffers:
+		_influx_buffers[id(client)] = InfluxBuffer(client)
+
+	return _influx_buffers[id(client)]
+
+
+def influx_flush():
+	"""Writes all the buffered points (eg. before a Lambda invocation returns)."""
+	for buffer in list(_influx_buffers.values()):
+		buffer.flush()
+
+
+def influx_write_payload(payload, client=influx):
+	buffer = get_influx_buffer(client)
+	if buffer is not None:
+		buffer.add(payload)
 
 
 def influx_metric(measure, fields, timestamp=None, **kwargs):
@@ -76,6 +194,22 @@ def influx_metric(measure, fields, timestamp=None, **kwargs):
 	influx_write_payload([payload])
 
 
+def influx_sampled_metric(measure, fields, sample_rate, timestamp=None, **kwargs):
+	"""
+	Writes the metric for a random sample_rate fraction of the calls only.
+	The "count" field (if any) is scaled up so that sums remain accurate.
+	"""
+	if sample_rate < 1 and random.random() >= sample_rate:
+		return
+
+	fields = dict(fields, sample_rate=float(sample_rate))
+	if "count" in fields:
+		# Keep integer counts as integers, Influx does not allow field type changes
+		fields["count"] = int(round(fields["count"] / sample_rate))
+
+	influx_metric(measure, fields, timestamp=timestamp, **kwargs)
+
+
 class Timer():
 	def __init__(self):
 		self._start_time = None
@@ -97,25 +231,40 @@ class Timer():
 		return self._stop_time - self._start_time
 
 
+_max_rss = {"value": 0, "ts": 0}
+
+
+def get_max_rss(max_age=1.0):
+	"""Returns the peak RSS of the process, sampled at most every max_age seconds."""
+	current_ts = time.time()
+	if current_ts - _max_rss["ts"] > max_age:
+		_max_rss["value"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		_max_rss["ts"] = current_ts
+	return _max_rss["value"]
+
+
 @contextmanager
 def influx_timer(measure, timestamp=None, cloudwatch_url=None, **kwargs):
 	"""
 	Reports the duration of the context manager.
 	Additional kwargs are passed to InfluxDB as tags.
+
+	The context manager yields a dict which can be filled with additional fields.
 	"""
 	start_time = time.time()
 	exception_raised = False
+	extra_fields = {}
 	if timestamp is None:
 		timestamp = now()
 	try:
-		yield
+		yield extra_fields
 	except Exception:
 		exception_raised = True
 		raise
 	finally:
 		stop_time = time.time()
 		duration = (stop_time - start_time) * 1000
-		mem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		mem = get_max_rss()
 
 		tags = kwargs
 		tags["exception_thrown"] = exception_raised
@@ -129,6 +278,8 @@ def influx_timer(measure, timestamp=None, cloudwatch_url=None, **kwargs):
 			"time": timestamp.isoformat(),
 		}
 
+		payload["fields"].update(extra_fields)
+
 		if exception_raised and cloudwatch_url:
 			payload["fields"]["cloudwatch"] = cloudwatch_url
 		influx_write_payload([payload])
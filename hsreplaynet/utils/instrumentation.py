@@ -5,7 +5,7 @@ from django.utils.timezone import now
 from raven.contrib.django.raven_compat.models import client as sentry
 
 from . import log
-from .influx import influx_timer
+from .influx import influx_flush, influx_timer
 
 
 def error_handler(e):
@@ -132,7 +132,14 @@ def lambda_handler(
 					raise
 			finally:
 				from django import db
+				from hsreplaynet.decks.journal import flush_archetype_journal
 				db.connections.close_all()
+				# Lambda freezes the process (and the flush thread) once we return
+				try:
+					flush_archetype_journal()
+				except Exception as e:
+					error_handler(e)
+				influx_flush()
 
 		return wrapper
 
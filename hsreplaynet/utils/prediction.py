@@ -1,13 +1,17 @@
 import random
+import time
 from copy import copy
 from datetime import datetime, timedelta
+from itertools import chain
 from random import randrange
 
 from django.conf import settings
 from hearthstone.enums import CardClass, FormatType
+from redis import StrictRedis
 
 from hsreplaynet.utils.redis import (
-	SECONDS_PER_DAY, RedisIntegerMapStorage, RedisPopularityDistribution, RedisTree
+	SECONDS_PER_DAY, RedisIntegerMapStorage,
+	RedisPopularityDistribution, RedisTree, SpaceSavingSketch
 )
 
 
@@ -36,13 +40,18 @@ def deck_prediction_tree(player_class, game_format, redis_client=None):
 
 
 class PredictionResult:
-	def __init__(self, tree, predicted_deck_id, node, tie, match_attempts, sequence):
+	def __init__(
+		self, tree, predicted_deck_id, node, tie, match_attempts, sequence,
+		depth_latencies=None
+	):
 		self.tree = tree
 		self.predicted_deck_id = predicted_deck_id
 		self.node = node
 		self.tie = tie
 		self.match_attempts = match_attempts
 		self.play_sequences = sequence
+		# A list of (depth, milliseconds) for each match attempt
+		self.depth_latencies = depth_latencies or []
 		if node:
 			self.popularity_distribution = tree._popularity_distribution(node)
 		else:
@@ -58,15 +67,165 @@ class PredictionResult:
 
 
 DEFAULT_POPULARITY_TTL = 2 * SECONDS_PER_DAY
+# The number of decks counted in each bucket of each node's popularity distribution
+DEFAULT_POPULARITY_MAX_ITEMS = 2000
 
 
 class DeckPredictionTree:
+	# Server side implementation of _lookup(), run against the replica.
+	# It walks down the tree, ranks the candidates of each node on the stack by
+	# summing their popularity buckets and checks them for a superset of the
+	# partial deck, with the same tie-breaking rules as _lookup(). Ties at the
+	# root are returned to the caller, which picks one at random.
+	# The node, popularity bucket and deck keys it reads are only known as it
+	# walks the tree, so they cannot be declared in KEYS and are built from the
+	# namespaces in ARGV instead. This assumes a single node Redis (as the
+	# deck_prediction caches are): it does not work on Redis Cluster, where
+	# server_side_lookup must be disabled.
+	LOOKUP_SCRIPT = RedisIntegerMapStorage.SUPERSET_FUNCTIONS + """
+		local tree_key = ARGV[1]
+		local popularity_namespace = ARGV[2]
+		local storage_namespace = ARGV[3]
+		local limit = tonumber(ARGV[4])
+		local pos = 5
+
+		local read_list = function ()
+			local size = tonumber(ARGV[pos])
+			local result = {}
+			for i = 1, size do
+				result[i] = ARGV[pos + i]
+			end
+			pos = pos + size + 1
+			return result
+		end
+
+		local buckets = read_list()
+		local sequence = read_list()
+		local partial_keys = {}
+		local partial_values = {}
+		while pos < #ARGV do
+			partial_keys[#partial_keys + 1] = ARGV[pos]
+			partial_values[#partial_values + 1] = tonumber(ARGV[pos + 1])
+			pos = pos + 2
+		end
+
+		local now = function ()
+			local t = redis.call('TIME')
+			return tonumber(t[1]) * 1000000 + tonumber(t[2])
+		end
+
+		local ranked_candidates = function (node_key)
+			local scores = {}
+			local members = {}
+			for _, bucket in ipairs(buckets) do
+				local bucket_key = popularity_namespace .. ':' .. node_key .. ':' .. bucket
+				local data = redis.call('ZRANGE', bucket_key, 0, -1, 'WITHSCORES')
+				for i = 1, #data, 2 do
+					local member = data[i]
+					if scores[member] == nil then
+						members[#members + 1] = member
+						scores[member] = tonumber(data[i + 1])
+					else
+						scores[member] = scores[member] + tonumber(data[i + 1])
+					end
+				end
+			end
+
+			-- Same order as ZREVRANGE on the union of the buckets
+			table.sort(members, function (a, b)
+				if scores[a] ~= scores[b] then
+					return scores[a] > scores[b]
+				end
+				return a > b
+			end)
+
+			return members, scores
+		end
+
+		local evaluate = function (depth, node_key)
+			local members, scores = ranked_candidates(node_key)
+			local count = #members
+			if limit >= 0 and count > limit + 1 then
+				count = limit + 1
+			end
+
+			local matches = {}
+			for i = 1, count do
+				local member = members[i]
+				if #matches >= 2 then
+					-- The top matches are tied: only the root needs all of them
+					if depth > 0 or scores[member] < scores[matches[1]] then
+						break
+					end
+				end
+
+				if is_superset(storage_namespace, member, partial_keys, partial_values) then
+					matches[#matches + 1] = member
+					if #matches == 2 and scores[member] < scores[matches[1]] then
+						break
+					end
+				end
+			end
+
+			if #matches == 1 then
+				return {1, matches}
+			elseif #matches > 1 then
+				if scores[matches[1]] > scores[matches[2]] then
+					return {1, {matches[1]}}
+				elseif depth == 0 then
+					return {2, matches}
+				end
+			end
+
+			return {0, {}}
+		end
+
+		-- Seek to the maximum depth in the tree, keeping track of the
+		-- depth at which each match attempt will be made
+		local node_key = tree_key .. ':NODE:ROOT'
+		local node_keys = {[0] = node_key}
+		local path = {}
+		local stack = {}
+		for i, label in ipairs(sequence) do
+			stack[#stack + 1] = #path
+			if redis.call('SISMEMBER', node_key .. ':CHILDREN', label) == 1 then
+				node_key = node_key .. '->' .. label
+				path[#path + 1] = i
+				node_keys[#path] = node_key
+			end
+		end
+		stack[#stack + 1] = #path
+
+		-- Then start looking for a match starting from the deepest node
+		local timings = {}
+		local evaluated = {}
+		for i = #stack, 1, -1 do
+			local depth = stack[i]
+			local start = now()
+			if evaluated[depth] == nil then
+				evaluated[depth] = evaluate(depth, node_keys[depth])
+			end
+			timings[#timings + 1] = depth
+			timings[#timings + 1] = now() - start
+
+			local result = evaluated[depth]
+			if result[1] ~= 0 then
+				return {result[1], depth, path, #timings / 2, timings, result[2]}
+			end
+		end
+
+		return {0, -1, path, #timings / 2, timings, {}}
+	"""
+
 	def __init__(
 		self, player_class, format, redis_primary, redis_replica,
 		max_depth=4,
 		ttl=DEFAULT_POPULARITY_TTL,
 		popularity_ttl=DEFAULT_POPULARITY_TTL,
-		include_current_hour=settings.INCLUDE_CURRENT_HOUR_IN_LOOKUP
+		include_current_hour=settings.INCLUDE_CURRENT_HOUR_IN_LOOKUP,
+		server_side_lookup=getattr(settings, "DECK_PREDICTION_SERVER_SIDE_LOOKUP", True),
+		popularity_max_items=DEFAULT_POPULARITY_MAX_ITEMS,
+		popularity_sketch=SpaceSavingSketch
 	):
 		self.redis_primary = redis_primary
 		self.redis_replica = redis_replica
@@ -76,24 +235,85 @@ class DeckPredictionTree:
 		self.ttl = ttl
 		self.popularity_ttl = popularity_ttl
 		self.include_current_hour = include_current_hour
+		self.popularity_max_items = popularity_max_items
+		self.popularity_sketch = popularity_sketch
 		self.storage = RedisIntegerMapStorage(
 			(redis_primary, redis_replica), "DECK", ttl=self.ttl
 		)
 		self.tree_name = "%s_%s_%s" % ("DECK_PREDICTION", player_class.name, format.name)
 		self.tree = RedisTree(self.redis_primary, self.tree_name, ttl=self.ttl)
+		self._popularity_distributions = {}
+		self.server_side_lookup = server_side_lookup
+		self.use_lua = isinstance(self.redis_replica, StrictRedis)
+		if self.use_lua:
+			self.lua_lookup = self.redis_replica.register_script(self.LOOKUP_SCRIPT)
 
 	def lookup(self, dbf_map, sequence):
 		play_sequence = copy(sequence)
-		predicted_deck_id, node, tie, match_attempts = self._lookup(dbf_map, play_sequence)
+		if self.server_side_lookup and self.use_lua:
+			result = self._lookup_server_side(dbf_map, play_sequence)
+		else:
+			result = self._lookup(dbf_map, play_sequence)
+
+		predicted_deck_id, node, tie, match_attempts, depth_latencies = result
 		return PredictionResult(
 			self,
 			predicted_deck_id,
 			node,
 			tie,
 			match_attempts,
-			sequence
+			sequence,
+			depth_latencies
 		)
 
+	def _lookup_end_ts(self):
+		if self.include_current_hour:
+			return datetime.utcnow()
+		else:
+			return datetime.utcnow() - timedelta(hours=1)
+
+	def _lookup_server_side(self, dbf_map, play_sequence):
+		# All the nodes share the same bucketing, so use the root's to find
+		# the buckets making up the distribution()
+		dist = self._popularity_distribution(self.tree.root)
+		start_token = dist._to_start_token(dist.earliest_available_datetime)
+		end_token = dist._to_end_token(self._lookup_end_ts())
+		buckets = [
+			"%s:%s" % (s, e) for s, e in dist._generate_bucket_tokens_between(start_token, end_token)
+		]
+
+		args = [
+			self.tree.key,
+			dist.namespace,
+			self.storage.namespace,
+			self.storage.max_match_size - 1,
+			len(buckets),
+		]
+		args += buckets
+		args.append(len(play_sequence))
+		args += play_sequence
+		args += list(chain.from_iterable(dbf_map.items()))
+		result = self.lua_lookup(args=args)
+		result_type, depth, path, match_attempts, timings, matches = result
+
+		depth_latencies = [
+			(timings[i], timings[i + 1] / 1000.0) for i in range(0, len(timings), 2)
+		]
+		if not result_type:
+			return None, None, False, match_attempts, depth_latencies
+
+		node = self.tree.root
+		for index in path[:depth]:
+			node = node.make_child(play_sequence[index - 1])
+
+		if result_type == 1:
+			final_match = matches[0]
+		else:
+			# We are at the root and there is a tie, so we must make a choice.
+			final_match = matches[randrange(0, len(matches))]
+
+		return int(final_match), node, False, match_attempts, depth_latencies
+
 	def _lookup(self, dbf_map, play_sequence):
 		# Seek to the maximum depth in the tree
 		stack = []
@@ -109,17 +329,15 @@ class DeckPredictionTree:
 
 		# Then start looking for a match starting from the deepest node
 		match_attempts = 0
+		depth_latencies = []
 		while len(stack):
 			node = stack.pop(0)
 			popularity_dist = self._popularity_distribution(node)
-
-			if self.include_current_hour:
-				end_ts = datetime.utcnow()
-			else:
-				end_ts = datetime.utcnow() - timedelta(hours=1)
+			end_ts = self._lookup_end_ts()
+			start_time = time.time()
 
 			# Do not request more candidates than the maximum amount
-			# That our deck storage system supports brute force search over
+			# That our deck storage system supports searching over
 			# - 1 because distribution(limit=..) is inclusive
 			num_candidates = self.storage.max_match_size - 1
 			candidate_decks = popularity_dist.distribution(
@@ -136,6 +354,7 @@ class DeckPredictionTree:
 
 			matches = self.storage.match(dbf_map, *most_popular)
 			match_attempts += 1
+			depth_latencies.append((node.depth, (time.time() - start_time) * 1000.0))
 
 			if len(matches) > 1:
 				first_match = matches[0]
@@ -145,7 +364,7 @@ class DeckPredictionTree:
 
 				# If multiple matches have equal popularity then return None
 				if first_match_popularity > second_match_popularity:
-					return int(first_match), node, False, match_attempts
+					return int(first_match), node, False, match_attempts, depth_latencies
 				else:
 					# There is a tie for most popular deck
 					if node.depth == 0:
@@ -156,40 +375,54 @@ class DeckPredictionTree:
 							if candidate_decks[additional_match] == first_match_popularity:
 								top_matches.append(additional_match)
 						final_match = top_matches[randrange(0, len(top_matches))]
-						return int(final_match), node, False, match_attempts
+						return int(final_match), node, False, match_attempts, depth_latencies
 					else:
 						pass
 						# We are not at the root, so we pass
 						# And let a node higher up the tree decide
 
 			if len(matches) == 1:
-				return int(matches[0]), node, False, match_attempts
+				return int(matches[0]), node, False, match_attempts, depth_latencies
 
-		return None, None, False, match_attempts
+		return None, None, False, match_attempts, depth_latencies
 
 	def observe(self, deck_id, dbf_map, play_sequence, as_of=None):
-		self.storage.store(deck_id, dbf_map)
-		return self._observe(deck_id, copy(play_sequence), as_of)
+		self.observe_many([(deck_id, dbf_map, play_sequence, as_of)])
+
+	def observe_many(self, observations):
+		"""
+		Record an iterable of (deck_id, dbf_map, play_sequence, as_of) observations.
+		All the resulting writes are sent to the primary in a single pipeline.
+		"""
+		pipeline = self.redis_primary.pipeline(transaction=False)
+		for deck_id, dbf_map, play_sequence, as_of in observations:
+			self.storage.store(deck_id, dbf_map, pipeline=pipeline)
+			self._observe(deck_id, copy(play_sequence), as_of, pipeline=pipeline)
+		pipeline.execute()
 
-	def _observe(self, deck_id, play_sequence, as_of=None):
+	def _observe(self, deck_id, play_sequence, as_of=None, pipeline=None):
 		node = self.tree.root
 		while node and node.depth < self.max_depth:
 			popularity_dist = self._popularity_distribution(node)
-			popularity_dist.increment(deck_id, as_of=as_of)
+			popularity_dist.increment(deck_id, as_of=as_of, pipeline=pipeline)
 			if len(play_sequence):
 				next_sequence = play_sequence.pop(0)
-				node = node.get_child(next_sequence, create=True)
+				node = node.add_child(next_sequence, pipeline=pipeline)
 			else:
 				break
 
 	def _popularity_distribution(self, node):
-		dist = RedisPopularityDistribution(
-			self.redis_primary,
-			name=node.key,
-			ttl=self.popularity_ttl,
-			max_items=self._max_collection_size_for_depth(node.depth),
-			bucket_size=21600  # 6 Hours
-		)
+		dist = self._popularity_distributions.get(node.key)
+		if dist is None:
+			dist = RedisPopularityDistribution(
+				self.redis_primary,
+				name=node.key,
+				ttl=self.popularity_ttl,
+				max_items=self._max_collection_size_for_depth(node.depth),
+				bucket_size=21600,  # 6 Hours
+				sketch=self.popularity_sketch
+			)
+			self._popularity_distributions[node.key] = dist
 		return dist
 
 	def _max_collection_size_for_depth(self, depth, min_size=200.0):
@@ -207,4 +440,4 @@ class DeckPredictionTree:
 		# 9+ = min_size
 		# from math import ceil, floor, pow
 		# return int(min_size * ceil(16.0 / pow(2.0, floor(depth / 2.0))))
-		return 2000
+		return self.popularity_max_items
@@ -9,12 +9,27 @@ SECONDS_PER_DAY = 24 * SECONDS_PER_HOUR
 DEFAULT_TTL = 15 * SECONDS_PER_DAY  # 15 Days
 
 
-class RedisPopularityDistribution:
+class SpaceSavingSketch:
+	"""
+	Counts the keys of a single popularity bucket using the Space-Saving algorithm
+	(Metwally et al.) with max_items counters: a new key takes over the counter of
+	the least popular key, inheriting its count, once all the counters are in use.
+
+	For a bucket with N observations, the count reported for any key exceeds its
+	true count by at most the smallest count in the bucket, which is <= N / max_items
+	(and 0 while the bucket is not full). Any key seen more than N / max_items times
+	is guaranteed to be in the bucket. When buckets are combined, their counts and
+	their error bounds add up. Memory is O(max_items) per bucket.
+	"""
+	# The key of the per-key errors, when they are tracked
+	ERRORS_KEY = None
+
 	INCREMENT_SCRIPT = """
 		local myset = ARGV[1]
 		local set_length = tonumber(ARGV[2])
 		local mykey = ARGV[3]
 		local exp_ts = tonumber(ARGV[4])
+		local errors = ARGV[5]
 
 		if redis.call('ZRANK', myset, mykey) then
 			redis.call('ZINCRBY', myset, 1.0, mykey)
@@ -24,9 +39,105 @@ class RedisPopularityDistribution:
 			local value = redis.call('ZRANGE', myset, 0, 0, 'withscores')
 			redis.call('ZREM', myset, value[1])
 			redis.call('ZADD', myset, value[2] + 1.0, mykey)
+
+			if errors then
+				redis.call('ZREM', errors, value[1])
+				redis.call('ZADD', errors, value[2], mykey)
+			end
 		end
 
 		redis.call('EXPIREAT', myset, exp_ts)
+		if errors and redis.call('EXISTS', errors) == 1 then
+			redis.call('EXPIREAT', errors, exp_ts)
+		end
+	"""
+
+	def __init__(self, redis, max_items):
+		self.redis = redis
+		self.max_items = max_items
+		self.use_lua = isinstance(redis, StrictRedis)
+		if self.use_lua:
+			self.lua_increment = self.redis.register_script(self.INCREMENT_SCRIPT)
+
+	def errors_key(self, bucket_key):
+		if self.ERRORS_KEY:
+			return "%s:%s" % (bucket_key, self.ERRORS_KEY)
+
+	def increment(self, bucket_key, key, expire_at, pipeline=None):
+		errors_key = self.errors_key(bucket_key)
+
+		if self.use_lua:
+			args = [bucket_key, self.max_items, key, expire_at]
+			if errors_key:
+				args.append(errors_key)
+			self.lua_increment(args=args, client=pipeline)
+		else:
+			if self.redis.zrank(bucket_key, key) is not None:
+				self.redis.zincrby(bucket_key, key, 1.0)
+			elif self.redis.zcard(bucket_key) < self.max_items:
+				self.redis.zadd(bucket_key, 1.0, key)
+			else:
+				evicted_key, evicted_score = self.redis.zrange(
+					bucket_key, 0, 0, withscores=True
+				)[0]
+				self.redis.zrem(bucket_key, evicted_key)
+				self.redis.zadd(bucket_key, evicted_score + 1.0, key)
+
+				if errors_key:
+					self.redis.zrem(errors_key, evicted_key)
+					self.redis.zadd(errors_key, evicted_score, key)
+
+			self.redis.expireat(bucket_key, expire_at)
+			if errors_key and self.redis.exists(errors_key):
+				self.redis.expireat(errors_key, expire_at)
+
+
+class TrackedSpaceSavingSketch(SpaceSavingSketch):
+	"""
+	A SpaceSavingSketch which also keeps the error of each key's count (the count
+	it inherited when it took over a counter) in a second sorted set per bucket.
+	This gives a tighter, per-key error bound (see error_bounds()) at the cost of
+	up to twice the memory of a full bucket.
+	"""
+	ERRORS_KEY = "ERRORS"
+
+
+class RedisPopularityDistribution:
+	# Builds the summary of a window of complete buckets from the summary of the
+	# window one bucket earlier, adding the newest bucket and subtracting the one
+	# which left it. Both inputs are checked in the same script, since the previous
+	# summary and the outgoing bucket expire at the same time: if either of them is
+	# missing, the summary is built from the union of all the buckets instead.
+	# KEYS: summary, previous summary, newest bucket, outgoing bucket, *buckets
+	# ARGV: the expiry timestamp of the summary
+	SUMMARY_SCRIPT = """
+		local summary_key = KEYS[1]
+		if redis.call('EXISTS', summary_key) == 1 then
+			return redis.call('ZCARD', summary_key)
+		end
+
+		local previous_key = KEYS[2]
+		local outgoing_key = KEYS[4]
+		local previous_exists = redis.call('EXISTS', previous_key) == 1
+		if previous_exists and redis.call('EXISTS', outgoing_key) == 1 then
+			redis.call(
+				'ZUNIONSTORE', summary_key, 3, previous_key, KEYS[3], outgoing_key,
+				'WEIGHTS', 1, 1, -1
+			)
+			redis.call('ZREMRANGEBYSCORE', summary_key, '-inf', 0)
+		else
+			local buckets = {}
+			for i = 5, #KEYS do
+				buckets[#buckets + 1] = KEYS[i]
+			end
+			redis.call('ZUNIONSTORE', summary_key, #buckets, unpack(buckets))
+		end
+
+		local size = redis.call('ZCARD', summary_key)
+		if size > 0 then
+			redis.call('EXPIREAT', summary_key, tonumber(ARGV[1]))
+		end
+		return size
 	"""
 
 	def __init__(
@@ -36,7 +147,8 @@ class RedisPopularityDistribution:
 		namespace="POPULARITY",
 		ttl=DEFAULT_TTL,
 		max_items=100,
-		bucket_size=3600  # 1 Hour
+		bucket_size=3600,  # 1 Hour
+		sketch=SpaceSavingSketch
 	):
 		self.redis = redis
 		self.name = name
@@ -51,9 +163,10 @@ class RedisPopularityDistribution:
 		if self.bucket_size > self.ttl:
 			raise ValueError("bucket_size cannot be larger than ttl")
 
+		self.sketch = sketch(redis, max_items)
 		self.use_lua = isinstance(redis, StrictRedis)
 		if self.use_lua:
-			self.lua_increment = self.redis.register_script(self.INCREMENT_SCRIPT)
+			self.lua_summary = self.redis.register_script(self.SUMMARY_SCRIPT)
 
 	def __str__(self):
 		return "%s:%s" % (self.namespace, self.name)
@@ -61,7 +174,12 @@ class RedisPopularityDistribution:
 	def __repr__(self):
 		return "%s:%s" % (self.namespace, self.name)
 
-	def increment(self, key, as_of=None):
+	def increment(self, key, as_of=None, pipeline=None):
+		"""
+		Increment the count for key in the bucket containing as_of.
+		If pipeline is passed, the increment is queued on it instead of being sent
+		right away (this is only supported by the Lua implementation).
+		"""
 		if as_of and not isinstance(as_of, datetime):
 			raise ValueError("as_of must be a datetime")
 
@@ -72,20 +190,7 @@ class RedisPopularityDistribution:
 		bucket_key = self._bucket_key(start_token, end_token)
 		expire_at = self._to_expire_at(ts)
 
-		if self.use_lua:
-			args = [bucket_key, self.max_items, key, expire_at]
-			self.lua_increment(args=args)
-		else:
-			if self.redis.zrank(bucket_key, key) is not None:
-				self.redis.zincrby(bucket_key, key, 1.0)
-			elif self.redis.zcard(bucket_key) < self.max_items:
-				self.redis.zadd(bucket_key, 1.0, key)
-			else:
-				vals = self.redis.zrange(bucket_key, 0, 0, withscores=True)
-				self.redis.zrem(bucket_key, vals[0])
-				self.redis.zadd(bucket_key, vals[1] + 1.0, key)
-
-			self.redis.expireat(bucket_key, expire_at)
+		self.sketch.increment(bucket_key, key, expire_at, pipeline=pipeline)
 
 	def distribution(self, start_ts=None, end_ts=None, limit=None, as_percentages=False):
 		start_ts = start_ts if start_ts else self.earliest_available_datetime
@@ -94,16 +199,13 @@ class RedisPopularityDistribution:
 		if start_ts > end_ts:
 			raise ValueError("start_ts cannot be greater than end_ts")
 
-		exists = self._ensure_exists(start_ts, end_ts)
-		if not exists:
+		summary_key = self._ensure_summary(start_ts, end_ts)
+		if not summary_key:
 			# We have no distribution data for this time period
 			return {}
 
-		start_token = self._to_start_token(start_ts)
-		end_token = self._to_end_token(end_ts)
-		bucket_key = self._bucket_key(start_token, end_token)
 		num_items = -1 if not limit else limit
-		raw_data = self.redis.zrevrange(bucket_key, 0, num_items, withscores=True)
+		raw_data = self.redis.zrevrange(summary_key, 0, num_items, withscores=True)
 		data = {k.decode("utf8"): int(v) for k, v in raw_data}
 		if len(data) and as_percentages:
 			total = sum(data.values())
@@ -111,6 +213,51 @@ class RedisPopularityDistribution:
 		else:
 			return data
 
+	def error_bound(self, start_ts=None, end_ts=None):
+		"""
+		Returns the maximum amount by which any count in distribution() may be
+		overestimated. This is also the maximum true count of a missing key.
+		"""
+		start_ts = start_ts if start_ts else self.earliest_available_datetime
+		end_ts = end_ts if end_ts else datetime.utcnow()
+		bucket_keys = self._bucket_keys_between(start_ts, end_ts)
+
+		pipeline = self.redis.pipeline(transaction=False)
+		for bucket_key in bucket_keys:
+			pipeline.zcard(bucket_key)
+			pipeline.zrange(bucket_key, 0, 0, withscores=True)
+		results = pipeline.execute()
+
+		bound = 0
+		for size, smallest in zip(results[::2], results[1::2]):
+			if size >= self.max_items and smallest:
+				bound += int(smallest[0][1])
+		return bound
+
+	def error_bounds(self, start_ts=None, end_ts=None):
+		"""
+		Returns the maximum overestimation of each key's count in distribution().
+		Keys which are not included have an exact count. This requires a sketch
+		which tracks errors, such as TrackedSpaceSavingSketch.
+		"""
+		start_ts = start_ts if start_ts else self.earliest_available_datetime
+		end_ts = end_ts if end_ts else datetime.utcnow()
+		bucket_keys = self._bucket_keys_between(start_ts, end_ts)
+		errors_keys = [self.sketch.errors_key(bucket_key) for bucket_key in bucket_keys]
+		if not all(errors_keys):
+			raise ValueError("%r does not track errors" % (self.sketch))
+
+		pipeline = self.redis.pipeline(transaction=False)
+		for errors_key in errors_keys:
+			pipeline.zrange(errors_key, 0, -1, withscores=True)
+
+		result = {}
+		for data in pipeline.execute():
+			for k, v in data:
+				k = k.decode("utf8")
+				result[k] = result.get(k, 0) + int(v)
+		return result
+
 	def size(self, start_ts=None, end_ts=None):
 		return len(self.distribution(start_ts, end_ts))
 
@@ -124,39 +271,82 @@ class RedisPopularityDistribution:
 		popularity = 100.0 * (numerator / denominator)
 		return round(popularity, precision)
 
-	def _ensure_exists(self, start_ts, end_ts):
+	def _ensure_summary(self, start_ts, end_ts):
+		"""
+		Returns the key of a sorted set summarizing all the buckets between start_ts
+		and end_ts, or None if there is no data for that period.
+
+		Buckets which have ended never change again, so their summaries are kept
+		around and are built incrementally from the summary of the previous window.
+		The buckets which are still open are added on top of it on every call.
+		"""
 		start_token = self._to_start_token(start_ts)
 		end_token = self._to_end_token(end_ts)
-		summary_key = self._bucket_key(start_token, end_token)
-		summary_exists = self.redis.exists(summary_key)
 
 		if self._next_token(start_token) > end_token:
 			# We are dealing with the a single time bucket
-			return summary_exists
-
-		includes_current_bucket = end_token > self._current_start_token
-		if not summary_exists or includes_current_bucket:
-			# We either need to build or refresh the summary
-			buckets = []
-			oldest_bucket_ttl = None
-			for s, e in self._generate_bucket_tokens_between(start_token, end_token):
-				bucket_key = self._bucket_key(s, e)
-				if self.redis.exists(bucket_key):
-					buckets.append(bucket_key)
-					if not oldest_bucket_ttl:
-						oldest_bucket_ttl = self.redis.ttl(bucket_key)
-
-			if len(buckets):
-				self.redis.zunionstore(summary_key, buckets)
-
-				# The summary table inherits the TTL of its oldest bucket
-				self.redis.expire(summary_key, oldest_bucket_ttl)
-				return True
-			else:
-				return False
-		else:
-			# The summary already exists and does not include the current bucket
-			return True
+			bucket_key = self._bucket_key(start_token, end_token)
+			return bucket_key if self.redis.exists(bucket_key) else None
+
+		current_start_token = self._current_start_token
+		buckets = self._generate_bucket_tokens_between(start_token, end_token)
+		complete_buckets = [(s, e) for s, e in buckets if e < current_start_token]
+		open_buckets = [(s, e) for s, e in buckets if e >= current_start_token]
+
+		complete_summary_key = None
+		if complete_buckets:
+			complete_summary_key = self._ensure_complete_summary(complete_buckets)
+
+		if not open_buckets:
+			return complete_summary_key
+
+		keys = [self._bucket_key(s, e) for s, e in open_buckets]
+		if complete_summary_key:
+			keys.insert(0, complete_summary_key)
+
+		summary_key = "%s:OPEN" % (self._summary_key(start_token, end_token))
+		pipeline = self.redis.pipeline(transaction=False)
+		pipeline.zunionstore(summary_key, keys)
+		pipeline.expire(summary_key, self.bucket_size)
+		size, _ = pipeline.execute()
+		return summary_key if size else None
+
+	def _ensure_complete_summary(self, buckets):
+		start_token, end_token = buckets[0][0], buckets[-1][1]
+		if len(buckets) == 1:
+			bucket_key = self._bucket_key(start_token, end_token)
+			return bucket_key if self.redis.exists(bucket_key) else None
+
+		summary_key = self._summary_key(start_token, end_token)
+		bucket_keys = [self._bucket_key(s, e) for s, e in buckets]
+		# The summary table inherits the TTL of its oldest bucket
+		now = int(datetime.utcnow().timestamp())
+		expire_at = max(buckets[0][1] + self.ttl, now + 1)
+
+		if not self.use_lua:
+			pipeline = self.redis.pipeline(transaction=False)
+			pipeline.zunionstore(summary_key, bucket_keys)
+			pipeline.expireat(summary_key, expire_at)
+			size, _ = pipeline.execute()
+			return summary_key if size else None
+
+		# The summary of the window one bucket earlier, and the bucket which left it
+		previous_key = self._summary_key(
+			start_token - self.bucket_size, end_token - self.bucket_size
+		)
+		outgoing_key = self._bucket_key(start_token - self.bucket_size, start_token - 1)
+
+		keys = [summary_key, previous_key, bucket_keys[-1], outgoing_key] + bucket_keys
+		size = self.lua_summary(keys=keys, args=[expire_at])
+		return summary_key if size else None
+
+	def _bucket_keys_between(self, start_ts, end_ts):
+		start_token = self._to_start_token(start_ts)
+		end_token = self._to_end_token(end_ts)
+		if self._next_token(start_token) > end_token:
+			return [self._bucket_key(start_token, end_token)]
+		buckets = self._generate_bucket_tokens_between(start_token, end_token)
+		return [self._bucket_key(s, e) for s, e in buckets]
 
 	def _generate_bucket_tokens_between(self, start_token, end_token):
 		result = []
@@ -170,6 +360,10 @@ class RedisPopularityDistribution:
 	def _bucket_key(self, start_token, end_token):
 		return "%s:%s:%s:%s" % (self.namespace, self.name, start_token, end_token)
 
+	def _summary_key(self, start_token, end_token):
+		# Versioned, so that summaries from older releases are never reused
+		return "%s:SUMMARY:2" % (self._bucket_key(start_token, end_token))
+
 	def _convert_to_end_token(self, start_token, units=None):
 		next_token = self._next_token(start_token, units)
 		return next_token - 1
@@ -205,55 +399,40 @@ class RedisPopularityDistribution:
 
 class RedisIntegerMapStorage:
 	"""Redis storage for {Integer:Integer} maps, e.g. {DBF:COUNT}"""
-	# This native Lua implementation can brute force search: ~ 25 keys / ms
-	# In order to always return within 100ms we should never search more than 2,000 keys
-	MATCH_SCRIPT = """
-		-- Return the first deck_id in KEYS that is a superset of ARGV
-		-- Return -1 if nothing matches
-
-		local get_default = function (tab, element, default)
-
-			for k, v in pairs(tab) do
-				if k == element then
-					return v
-				end
+	# Checking a candidate takes a single HMGET of the partial keys, rather than
+	# fetching the whole map with HGETALL and scanning it for every partial key.
+	SUPERSET_FUNCTIONS = """
+		-- Return true if the map stored at key contains the partial map
+		local is_superset = function (namespace, key, partial_keys, partial_values)
+			if #partial_keys == 0 then
+				return true
 			end
 
-			return default
-		end
-
-		local to_map = function (members)
-			local result = {}
-			local nextkey
-
-			for i, v in ipairs(members) do
-				if i % 2 == 1 then
-					nextkey = tostring(v)
-				else
-					result[nextkey] = tonumber(v)
+			local values = redis.call('HMGET', namespace .. ':' .. key, unpack(partial_keys))
+			for i, v in ipairs(partial_values) do
+				if v > (tonumber(values[i]) or 0) then
+					return false
 				end
 			end
-
-			return result
+			return true
 		end
+	"""
+
+	MATCH_SCRIPT = SUPERSET_FUNCTIONS + """
+		-- Return the deck_ids in KEYS that are a superset of ARGV
 
 		local namespace = table.remove(ARGV, 1)
-		local partial = to_map(ARGV)
+		local partial_keys = {}
+		local partial_values = {}
+		for i = 1, #ARGV, 2 do
+			partial_keys[#partial_keys + 1] = ARGV[i]
+			partial_values[#partial_values + 1] = tonumber(ARGV[i + 1])
+		end
 
 		local final_result = {}
 
 		for i, key in ipairs(KEYS) do
-			local candidate_key = namespace .. ":" .. key
-			local candidate = to_map(redis.call('HGETALL', candidate_key))
-			local match = true
-
-			for k, v in pairs(partial) do
-				if v > get_default(candidate, k, 0) then
-					match = false
-				end
-			end
-
-			if match == true then
+			if is_superset(namespace, key, partial_keys, partial_values) then
 				final_result[#final_result+1]=key
 			end
 		end
@@ -273,9 +452,17 @@ class RedisIntegerMapStorage:
 	def namespaced_key(self, key):
 		return "%s:%s" % (self.namespace, key)
 
-	def store(self, key, val):
-		self.redis_primary.hmset(self.namespaced_key(key), val)
-		self.redis_primary.expire(self.namespaced_key(key), self.ttl)
+	def store(self, key, val, pipeline=None):
+		if pipeline is None:
+			redis = self.redis_primary.pipeline(transaction=False)
+		else:
+			redis = pipeline
+
+		redis.hmset(self.namespaced_key(key), val)
+		redis.expire(self.namespaced_key(key), self.ttl)
+
+		if pipeline is None:
+			redis.execute()
 
 	def retrieve(self, key):
 		data = self.redis_replica.hgetall(self.namespaced_key(key))
@@ -332,44 +519,41 @@ class RedisTreeNode:
 	def _make_key(self):
 		return "%s:%s:%s" % (self.tree.key, self.namespace, self.fully_qualified_label)
 
+	def make_child(self, label):
+		"""Return the child node with the given label, without checking it exists."""
+		return RedisTreeNode(
+			self.redis,
+			self.tree,
+			self,
+			label,
+			self.depth + 1,
+			self.namespace,
+			self.ttl
+		)
+
 	def children(self):
 		for member in self.redis.smembers(self.children_key):
-			yield RedisTreeNode(
-				self.redis,
-				self.tree,
-				self,
-				member,
-				self.depth + 1,
-				self.namespace,
-				self.ttl
-			)
+			yield self.make_child(member)
 
 	def get_child(self, label, create=False):
 		if self.redis.sismember(self.children_key, label):
-			return RedisTreeNode(
-				self.redis,
-				self.tree,
-				self,
-				label,
-				self.depth + 1,
-				self.namespace,
-				self.ttl
-			)
+			return self.make_child(label)
 		elif create:
-			self.redis.sadd(self.children_key, label)
-			self.redis.expire(self.children_key, self.ttl)
-			return RedisTreeNode(
-				self.redis,
-				self.tree,
-				self,
-				label,
-				self.depth + 1,
-				self.namespace,
-				self.ttl
-			)
+			return self.add_child(label)
 		else:
 			return None
 
+	def add_child(self, label, pipeline=None):
+		"""
+		Unconditionally add (or refresh) the child with the given label.
+		Unlike get_child(create=True), this does not need to read from Redis first,
+		so the writes can be queued on a pipeline.
+		"""
+		redis = self.redis if pipeline is None else pipeline
+		redis.sadd(self.children_key, label)
+		redis.expire(self.children_key, self.ttl)
+		return self.make_child(label)
+
 	def get(self, key):
 		return self.redis.hget(self.key, key).decode("utf8")
 
@@ -1,12 +1,10 @@
 from django.conf import settings
 from django.contrib.messages import get_messages
-from djpaypal.models import BillingPlan
-from djpaypal.settings import PAYPAL_CLIENT_ID, PAYPAL_LIVE_MODE
-from djstripe.enums import SubscriptionStatus
-from djstripe.models import Plan
+from djpaypal.settings import PAYPAL_CLIENT_ID
 from djstripe.settings import STRIPE_LIVE_MODE, STRIPE_PUBLIC_KEY
 
-from hsreplaynet.features.models import Feature
+from hsreplaynet.billing.utils import get_plan_catalogue, user_has_subscription_past_due
+from hsreplaynet.features.utils import get_feature_snapshot
 
 
 def userdata(request):
@@ -44,13 +42,9 @@ def userdata(request):
 			})
 
 	data["features"] = {}
-	for feature in Feature.objects.all():
-		is_enabled = bool(feature.enabled_for_user(request.user))  # Django 1.10 hack
-		if not is_enabled:
-			continue
-
+	for feature in get_feature_snapshot(request.user).enabled_features():
 		data["features"][feature.name] = {
-			"enabled": is_enabled
+			"enabled": True
 		}
 		if feature.read_only:
 			data["features"][feature.name]["read_only"] = True
@@ -79,13 +73,7 @@ def debug(request):
 
 def premium(request):
 	is_premium = request.user.is_authenticated and request.user.is_premium
-	has_subscription_past_due = False
-	if request.user.is_authenticated and request.user.stripe_customer:
-		customer = request.user.stripe_customer
-		has_subscription_past_due = customer.subscriptions.filter(
-			status=SubscriptionStatus.past_due).exists()
-	stripe_plans = Plan.objects.filter(livemode=STRIPE_LIVE_MODE)
-	paypal_plans = BillingPlan.objects.filter(livemode=PAYPAL_LIVE_MODE)
+	has_subscription_past_due = user_has_subscription_past_due(request.user)
 	stripe_debug = not STRIPE_LIVE_MODE and settings.DEBUG
 
 	if is_premium and request.COOKIES.get("free-mode") == "true":
@@ -95,14 +83,7 @@ def premium(request):
 		"premium": is_premium,
 		"has_subscription_past_due": has_subscription_past_due,
 		"show_premium_modal": not is_premium and "premium-modal" in request.GET,
-		"stripe_monthly_plan": stripe_plans.filter(stripe_id=settings.MONTHLY_PLAN_ID).first(),
-		"stripe_semiannual_plan": stripe_plans.filter(
-			stripe_id=settings.SEMIANNUAL_PLAN_ID
-		).first(),
-		"paypal_monthly_plan": paypal_plans.filter(id=settings.PAYPAL_MONTHLY_PLAN_ID).first(),
-		"paypal_semiannual_plan": paypal_plans.filter(
-			id=settings.PAYPAL_SEMIANNUAL_PLAN_ID
-		).first(),
+		**get_plan_catalogue(),
 		"stripe_debug": stripe_debug,
 		"STRIPE_PUBLIC_KEY": STRIPE_PUBLIC_KEY,
 		"PAYPAL_CLIENT_ID": PAYPAL_CLIENT_ID,
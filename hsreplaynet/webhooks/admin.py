@@ -1,6 +1,8 @@
 from django.contrib import admin
 
-from .models import Event, Webhook, WebhookDelivery, WebhookEndpoint
+from .models import (
+	Event, OutboxEvent, Webhook, WebhookDelivery, WebhookEndpoint, schedule_webhook_deliveries
+)
 
 
 def send_test_payload(admin, request, queryset):
@@ -12,8 +14,7 @@ send_test_payload.short_description = "Send test payload"
 
 
 def redeliver(admin, request, queryset):
-	for obj in queryset:
-		obj.schedule_delivery()
+	schedule_webhook_deliveries(queryset.select_related("endpoint"))
 
 
 redeliver.short_description = "Redeliver payload"
@@ -33,6 +34,13 @@ class EventAdmin(admin.ModelAdmin):
 	inlines = (WebhookInline, )
 
 
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(admin.ModelAdmin):
+	list_display = ("__str__", "type", "object_id", "user", "created")
+	list_filter = ("type", )
+	raw_id_fields = ("user", )
+
+
 @admin.register(WebhookEndpoint)
 class WebhookEndpointAdmin(admin.ModelAdmin):
 	list_display = (
@@ -0,0 +1,196 @@
+"""
+Webhook delivery engine.
+
+Webhooks are delivered from a thread pool. Each destination host gets its own
+requests Session, so connections are kept alive and reused across deliveries.
+Deliveries which fail with a connection error or a 429/5xx response are retried
+up to max_attempts times, with an exponential backoff. Other errors, such as read
+timeouts, are not retried as the endpoint may already have received the webhook.
+No attempt is started which could not complete before the optional deadline.
+
+The WebhookDelivery records and the final status of each webhook are written as
+soon as that webhook has been delivered.
+"""
+import json
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.utils.timezone import now
+from requests import Request, Session, exceptions
+from requests.adapters import HTTPAdapter
+
+from hsreplaynet.utils import log
+from hsreplaynet.utils.influx import influx_metric
+
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BACKOFF = 0.5
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(url):
+	"""Returns the shared, connection pooling Session for the host of url."""
+	host = urlsplit(url).netloc
+	with _sessions_lock:
+		if host not in _sessions:
+			session = Session()
+			adapter = HTTPAdapter(pool_connections=1, pool_maxsize=DEFAULT_MAX_WORKERS)
+			session.mount("http://", adapter)
+			session.mount("https://", adapter)
+			_sessions[host] = session
+		return _sessions[host]
+
+
+def _send_webhook(webhook, deliveries, max_attempts, backoff, deadline=None):
+	"""
+	Delivers a single webhook, retrying as needed.
+	Appends the unsaved WebhookDelivery of each attempt to deliveries and returns
+	the final WebhookStatus.
+	"""
+	from .models import (
+		RESPONSE_BODY_MAX_SIZE, WEBHOOK_CONTENT_TYPE, WEBHOOK_USER_AGENT,
+		WebhookDelivery, WebhookStatus, generate_signature
+	)
+
+	secret = str(webhook.endpoint.secret).encode("utf-8")
+	body = json.dumps(webhook.payload, cls=DjangoJSONEncoder).encode("utf-8")
+	session = get_session(webhook.url)
+
+	status = WebhookStatus.ERROR
+	for attempt in range(max_attempts):
+		delay = backoff * 2 ** (attempt - 1) if attempt else 0
+		timeout = webhook.endpoint.timeout
+		if deadline is not None:
+			remaining = deadline - time.time() - delay
+			if remaining < 1:
+				log.warning("Giving up on webhook %r after %i attempts", webhook.pk, attempt)
+				break
+			timeout = min(timeout, remaining)
+
+		if delay:
+			time.sleep(delay)
+
+		headers = {
+			"content-type": WEBHOOK_CONTENT_TYPE,
+			"user-agent": WEBHOOK_USER_AGENT,
+			"x-webhook-signature": generate_signature(secret, body),
+		}
+		request = session.prepare_request(
+			Request("POST", webhook.url, headers=headers, data=body)
+		)
+		delivery = WebhookDelivery(
+			webhook=webhook, url=request.url, request_headers=dict(request.headers),
+			request_body=body
+		)
+		deliveries.append(delivery)
+
+		begin = time.time()
+		try:
+			response = session.send(
+				request, allow_redirects=False, timeout=timeout
+			)
+		except Exception as e:
+			delivery.success = False
+			delivery.error = str(e)
+			delivery.traceback = traceback.format_exc()
+			delivery.response_headers = {}
+			delivery.response_body = ""
+			status = WebhookStatus.ERROR
+			# The request may have been received unless the connection failed
+			retry = isinstance(e, exceptions.ConnectionError)
+		else:
+			delivery.success = 200 <= response.status_code <= 299
+			delivery.response_status = response.status_code
+			delivery.response_headers = dict(response.headers)
+			delivery.response_body = response.text[:RESPONSE_BODY_MAX_SIZE]
+			status = WebhookStatus.SUCCESS
+			retry = response.status_code in RETRY_STATUS_CODES
+
+		delivery.completed_time = int((time.time() - begin) * 1000)
+		if not retry:
+			break
+
+	return status
+
+
+def _deliver_webhook(webhook, max_attempts, backoff, deadline=None):
+	"""
+	Delivers a single webhook and saves its deliveries and final status.
+	"""
+	from .models import Webhook, WebhookDelivery, WebhookStatus
+
+	deliveries = []
+	status = WebhookStatus.ERROR
+	try:
+		status = _send_webhook(webhook, deliveries, max_attempts, backoff, deadline)
+	finally:
+		webhook.status = status
+		WebhookDelivery.objects.bulk_create(deliveries)
+		Webhook.objects.filter(pk=webhook.pk).update(status=status, updated=now())
+
+	return status, len(deliveries)
+
+
+def deliver_webhooks(
+	webhooks, max_workers=DEFAULT_MAX_WORKERS, max_attempts=DEFAULT_MAX_ATTEMPTS,
+	backoff=DEFAULT_BACKOFF, max_duration=None
+):
+	"""
+	Delivers a batch of PENDING webhooks concurrently, retrying each of them only
+	while it can complete within max_duration seconds.
+	Webhooks with no endpoint or which are not PENDING are skipped.
+	"""
+	from .models import Webhook, WebhookStatus
+
+	deliverable = []
+	for webhook in webhooks:
+		if not webhook.endpoint:
+			log.warning("Cannot deliver webhook %r with no endpoint", webhook.pk)
+		elif webhook.status != WebhookStatus.PENDING:
+			log.warning("Not triggering webhook %r for status %r", webhook.pk, webhook.status)
+		else:
+			deliverable.append(webhook)
+
+	if not deliverable:
+		return
+
+	Webhook.objects.filter(pk__in=[w.pk for w in deliverable]).update(
+		status=WebhookStatus.IN_PROGRESS, updated=now()
+	)
+
+	begin = time.time()
+	deadline = begin + max_duration if max_duration is not None else None
+
+	def send(webhook):
+		try:
+			return _deliver_webhook(webhook, max_attempts, backoff, deadline)
+		finally:
+			# Worker threads each open their own database connection
+			connection.close()
+
+	if len(deliverable) == 1 or max_workers < 2:
+		results = [
+			_deliver_webhook(webhook, max_attempts, backoff, deadline)
+			for webhook in deliverable
+		]
+	else:
+		with ThreadPoolExecutor(max_workers=min(max_workers, len(deliverable))) as executor:
+			results = list(executor.map(send, deliverable))
+
+	influx_metric("webhook_delivery_batch", {
+		"count": len(deliverable),
+		"attempts": sum(attempts for status, attempts in results),
+		"errors": sum(status == WebhookStatus.ERROR for status, attempts in results),
+		"duration": time.time() - begin,
+	})
@@ -2,7 +2,9 @@ import logging
 
 from hsreplaynet.utils.instrumentation import lambda_handler
 
+from .delivery import deliver_webhooks
 from .models import Webhook
+from .outbox import dispatch_outbox
 
 
 @lambda_handler(cpu_seconds=30)
@@ -11,10 +13,30 @@ def trigger_webhook(event, context):
 	A handler that handles firing game replay webhooks.
 	"""
 	logger = logging.getLogger("hsreplaynet.webhooks.lambdas.trigger_webhook")
-	webhook_pk = event["webhook"]
+	if "webhooks" in event:
+		webhook_pks = event["webhooks"]
+	else:
+		webhook_pks = [event["webhook"]]
 
-	logger.info("Preparing to trigger Webhook %r", webhook_pk)
-	webhook = Webhook.objects.get(pk=webhook_pk)
+	logger.info("Preparing to trigger Webhooks %r", webhook_pks)
+	webhooks = list(Webhook.objects.filter(pk__in=webhook_pks).select_related("endpoint"))
 
-	logger.info("Triggering webhook %r", webhook)
-	webhook.deliver()
+	logger.info("Triggering %i webhooks", len(webhooks))
+	# Leave time to record the deliveries before the invocation times out
+	max_duration = context.get_remaining_time_in_millis() / 1000 - 5
+	deliver_webhooks(webhooks, max_duration=max_duration)
+
+
+@lambda_handler(
+	cpu_seconds=65,
+	requires_vpc_access=True,
+	tracing=False,
+)
+def dispatch_webhook_outbox(event, context):
+	"""
+	A job scheduled every minute, which dispatches the webhook outbox
+	for up to 55 seconds.
+	"""
+	logger = logging.getLogger("hsreplaynet.webhooks.lambdas.dispatch_webhook_outbox")
+	count = dispatch_outbox(duration=55)
+	logger.info("Dispatched %i outbox events", count)
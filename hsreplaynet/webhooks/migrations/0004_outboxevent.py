@@ -0,0 +1,33 @@
+# Generated by Django 2.0 on 2018-01-22 11:04
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+	dependencies = [
+		migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+		("webhooks", "0003_auto_20170626_1307"),
+	]
+
+	operations = [
+		migrations.CreateModel(
+			name="OutboxEvent",
+			fields=[
+				("id", models.BigAutoField(primary_key=True, serialize=False)),
+				("type", models.CharField(max_length=50)),
+				("object_id", models.CharField(max_length=64)),
+				("created", models.DateTimeField(auto_now_add=True)),
+				(
+					"user",
+					models.ForeignKey(
+						on_delete=django.db.models.deletion.CASCADE,
+						related_name="+",
+						to=settings.AUTH_USER_MODEL
+					)
+				),
+			],
+		),
+	]
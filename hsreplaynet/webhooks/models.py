@@ -1,6 +1,4 @@
 import json
-import time
-import traceback
 from datetime import datetime
 from enum import IntEnum
 from uuid import uuid4
@@ -10,9 +8,10 @@ from django.contrib.postgres.fields import JSONField
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 from django.urls import reverse
+from django.utils.timezone import now
 from django_intenum import IntEnumField
-from requests import Request, Session
 
+from .delivery import deliver_webhooks
 from .validators import WebhookURLValidator
 
 
@@ -67,19 +66,56 @@ class Event(models.Model):
 	def __str__(self):
 		return self.type
 
-	def create_webhooks(self):
-		endpoints = self.user.webhook_endpoints.filter(is_active=True, is_deleted=False)
-		payload = {
+	@property
+	def payload(self):
+		return {
 			"event": self.uuid,
 			"type": self.type,
 			"data": self.data,
 			"created": int(self.created.timestamp()),
 		}
-		for endpoint in endpoints:
-			webhook = Webhook.objects.create(
-				endpoint=endpoint, url=endpoint.url, event=self, payload=payload
-			)
-			webhook.schedule_delivery()
+
+	def create_webhooks(self):
+		schedule_webhook_deliveries(create_event_webhooks([self]))
+
+
+def create_event_webhooks(events):
+	"""
+	Creates the PENDING webhooks of a batch of events, for every active endpoint
+	of their users. Returns the (unscheduled) webhooks.
+	"""
+	endpoints = {}
+	for endpoint in WebhookEndpoint.objects.filter(
+		user_id__in=set(event.user_id for event in events), is_active=True, is_deleted=False
+	):
+		endpoints.setdefault(endpoint.user_id, []).append(endpoint)
+
+	return Webhook.objects.bulk_create([
+		Webhook(
+			endpoint=endpoint, url=endpoint.url, event=event, payload=event.payload,
+			status=WebhookStatus.PENDING
+		) for event in events for endpoint in endpoints.get(event.user_id, [])
+	])
+
+
+class OutboxEvent(models.Model):
+	"""
+	An event waiting to be turned into an Event and its webhooks.
+
+	Outbox events only reference the object the event is about, so they are cheap
+	to create. They are dispatched in batches (see hsreplaynet.webhooks.outbox).
+	"""
+	id = models.BigAutoField(primary_key=True)
+	type = models.CharField(max_length=50)
+	object_id = models.CharField(max_length=64)
+	user = models.ForeignKey(
+		settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="+"
+	)
+
+	created = models.DateTimeField(auto_now_add=True)
+
+	def __str__(self):
+		return "%s: %s" % (self.type, self.object_id)
 
 
 class WebhookEndpoint(models.Model):
@@ -147,23 +183,9 @@ class Webhook(models.Model):
 
 	def schedule_delivery(self):
 		"""
-		Schedule the webhook for delivery.
-
-		On ENV_AWS, this schedules a Lambda trigger.
-		Otherwise, triggers immediately.
+		Schedule the webhook for delivery (see schedule_webhook_deliveries()).
 		"""
-		self.status = WebhookStatus.PENDING
-		self.save()
-
-		if settings.WEBHOOKS["USE_LAMBDA"]:
-			from hsreplaynet.utils.aws.clients import LAMBDA
-			LAMBDA.invoke(
-				FunctionName="trigger_webhook",
-				InvocationType="Event",
-				Payload=json.dumps({"webhook": str(self.pk)}),
-			)
-		else:
-			self.deliver()
+		schedule_webhook_deliveries([self])
 
 	def deliver(self):
 		if not self.endpoint:
@@ -172,45 +194,37 @@ class Webhook(models.Model):
 		if self.status != WebhookStatus.PENDING:
 			raise ForbiddenWebhookDelivery("Not triggering for status %r" % (self.status))
 
-		self.status = WebhookStatus.IN_PROGRESS
-		self.save()
+		deliver_webhooks([self])
 
-		secret = str(self.endpoint.secret).encode("utf-8")
-		body = json.dumps(self.payload, cls=DjangoJSONEncoder).encode("utf-8")
-		signature = generate_signature(secret, body)
-		default_headers = {
-			"content-type": WEBHOOK_CONTENT_TYPE,
-			"user-agent": WEBHOOK_USER_AGENT,
-			"x-webhook-signature": signature,
-		}
-		session = Session()
-		request = session.prepare_request(
-			Request("POST", self.url, headers=default_headers, data=body)
-		)
 
-		delivery = WebhookDelivery(
-			webhook=self, url=request.url, request_headers=dict(request.headers), request_body=body
+def schedule_webhook_deliveries(webhooks):
+	"""
+	Schedule a batch of webhooks for delivery.
+
+	With WEBHOOKS["USE_LAMBDA"], this schedules a single Lambda trigger for all of
+	them. Otherwise, they are delivered immediately.
+	"""
+	webhooks = list(webhooks)
+	if not webhooks:
+		return
+
+	pending = [w.pk for w in webhooks if w.status != WebhookStatus.PENDING]
+	if pending:
+		Webhook.objects.filter(pk__in=pending).update(
+			status=WebhookStatus.PENDING, updated=now()
 		)
-		begin = time.time()
-		try:
-			response = session.send(request, allow_redirects=False, timeout=self.endpoint.timeout)
-		except Exception as e:
-			delivery.success = False
-			delivery.error = str(e)
-			delivery.traceback = traceback.format_exc()
-			delivery.response_headers = {}
-			delivery.response_body = ""
-			self.status = WebhookStatus.ERROR
-		else:
-			delivery.success = 200 <= response.status_code <= 299
-			delivery.response_status = response.status_code
-			delivery.response_headers = dict(response.headers)
-			delivery.response_body = response.text[:RESPONSE_BODY_MAX_SIZE]
-			self.status = WebhookStatus.SUCCESS
-
-		delivery.completed_time = int((time.time() - begin) * 1000)
-		delivery.save()
-		self.save()
+		for webhook in webhooks:
+			webhook.status = WebhookStatus.PENDING
+
+	if settings.WEBHOOKS["USE_LAMBDA"]:
+		from hsreplaynet.utils.aws.clients import LAMBDA
+		LAMBDA.invoke(
+			FunctionName="trigger_webhook",
+			InvocationType="Event",
+			Payload=json.dumps({"webhooks": [str(w.pk) for w in webhooks]}),
+		)
+	else:
+		deliver_webhooks(webhooks)
 
 
 class WebhookDelivery(models.Model):
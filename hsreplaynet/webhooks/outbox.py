@@ -0,0 +1,144 @@
+"""
+The webhook event outbox.
+
+Code paths which must stay fast (such as replay processing) do not create Events
+themselves. They only queue an OutboxEvent, which references the object the event
+is about. The outbox is dispatched in batches by dispatch_outbox_events(): the
+objects are serialized, the Events and their Webhooks are created in bulk and the
+webhooks are scheduled for delivery together.
+
+With WEBHOOKS["USE_LAMBDA"], the outbox is dispatched by the dispatch_webhook_outbox
+cron Lambda. Otherwise, it is dispatched as soon as the event is committed.
+"""
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.timezone import now
+
+from hsreplaynet.utils import log
+from hsreplaynet.utils.influx import influx_metric
+from hsreplaynet.utils.instrumentation import error_handler
+
+
+OUTBOX_BATCH_SIZE = 500
+
+
+def serialize_replays(shortids):
+	"""
+	Replays which fail to serialize are reported and left out, so that their outbox
+	events are dropped rather than blocking the rest of the outbox.
+	"""
+	from hsreplaynet.games.models import GameReplay
+
+	replays = GameReplay.objects.filter(shortid__in=shortids).select_related(
+		"user", "global_game", "opponent_revealed_deck"
+	)
+	ret = {}
+	for replay in replays:
+		try:
+			ret[replay.shortid] = replay.serialize()
+		except Exception as e:
+			log.warning("Could not serialize replay %r for the outbox", replay.shortid)
+			error_handler(e)
+
+	return ret
+
+
+# Event type -> function returning the serialized data of a list of object ids
+OUTBOX_SERIALIZERS = {
+	"replay.created": serialize_replays,
+}
+
+
+def queue_outbox_event(user, type, object_id):
+	from .models import OutboxEvent
+
+	OutboxEvent.objects.create(user=user, type=type, object_id=object_id)
+	if not settings.WEBHOOKS["USE_LAMBDA"]:
+		transaction.on_commit(dispatch_outbox_events)
+
+
+def dispatch_outbox_events(batch_size=OUTBOX_BATCH_SIZE):
+	"""
+	Dispatches up to batch_size outbox events, oldest first.
+	Returns the number of outbox events which were dispatched.
+
+	Events whose object cannot be found or serialized are dropped with a warning, and
+	webhooks which fail to be scheduled are set to ERROR.
+
+	Outbox events are locked with SKIP LOCKED, so that concurrent dispatchers
+	never dispatch the same event twice.
+	"""
+	from .models import (
+		Event, OutboxEvent, Webhook, WebhookStatus, create_event_webhooks,
+		schedule_webhook_deliveries
+	)
+
+	begin = time.time()
+	with transaction.atomic():
+		outbox = list(
+			OutboxEvent.objects.select_for_update(skip_locked=True).order_by("id")[:batch_size]
+		)
+		if not outbox:
+			return 0
+
+		object_ids = {}
+		for outbox_event in outbox:
+			object_ids.setdefault(outbox_event.type, set()).add(outbox_event.object_id)
+
+		serialized = {}
+		for type, ids in object_ids.items():
+			if type in OUTBOX_SERIALIZERS:
+				serialized[type] = OUTBOX_SERIALIZERS[type](list(ids))
+			else:
+				log.warning("Dropping outbox events with unknown type %r", type)
+				serialized[type] = {}
+
+		events = []
+		for outbox_event in outbox:
+			data = serialized[outbox_event.type].get(outbox_event.object_id)
+			if data is None:
+				log.warning("Dropping outbox event for missing object %s", outbox_event)
+				continue
+			events.append(Event(user_id=outbox_event.user_id, type=outbox_event.type, data=data))
+
+		events = Event.objects.bulk_create(events)
+		webhooks = create_event_webhooks(events)
+		OutboxEvent.objects.filter(id__in=[e.id for e in outbox]).delete()
+
+	try:
+		schedule_webhook_deliveries(webhooks)
+	except Exception:
+		# The outbox events are gone, so the webhooks would otherwise stay PENDING with
+		# nothing to retry them. In ERROR, they can still be redelivered from the admin.
+		Webhook.objects.filter(
+			pk__in=[w.pk for w in webhooks],
+			status__in=(WebhookStatus.PENDING, WebhookStatus.IN_PROGRESS)
+		).update(status=WebhookStatus.ERROR, updated=now())
+		raise
+
+	influx_metric("webhook_outbox_dispatch", {
+		"count": len(outbox),
+		"events": len(events),
+		"webhooks": len(webhooks),
+		"duration": time.time() - begin,
+	})
+
+	return len(outbox)
+
+
+def dispatch_outbox(duration=None, batch_size=OUTBOX_BATCH_SIZE):
+	"""
+	Dispatches outbox batches until the outbox is empty, or for up to duration seconds.
+	Returns the total number of outbox events which were dispatched.
+	"""
+	begin = time.time()
+	total = 0
+	while duration is None or time.time() - begin < duration:
+		count = dispatch_outbox_events(batch_size=batch_size)
+		total += count
+		if count < batch_size:
+			break
+
+	return total
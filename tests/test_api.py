@@ -7,6 +7,7 @@ from oauth2_provider.models import AccessToken, Grant
 from hearthsim.identity.accounts.models import AccountClaim, AuthToken, User
 from hearthsim.identity.api.models import APIKey
 from hearthsim.identity.oauth2.models import Application
+from hsreplaynet.packs.models import Pack
 from hsreplaynet.webhooks.models import WebhookEndpoint
 
 
@@ -281,3 +282,40 @@ def test_deck_exchange(client):
 	response = client.post(decks_by_list_url, data=data)
 	assert response.status_code == 200
 	assert Deck.objects.all().count() == 1
+
+
+@pytest.mark.django_db
+def test_pack_batch(client):
+	api_key = str(APIKey.objects.create(
+		full_name="Test Client", email="test@example.org", website="https://example.org"
+	).api_key)
+	response = client.post("/api/v1/tokens/", HTTP_X_API_KEY=api_key)
+	headers = {
+		"HTTP_AUTHORIZATION": "Token %s" % (response.json()["key"]),
+		"HTTP_X_API_KEY": api_key,
+	}
+
+	def pack(cards):
+		return {
+			"booster_type": 1, "date": "2018-01-01T00:00:00Z",
+			"account_hi": 144115193835963207, "account_lo": 12345,
+			"cards": [{"card": card_id, "premium": False} for card_id in cards],
+		}
+
+	packs = [
+		pack(["EX1_534", "DS1_070", "DS1_178", "EX1_538", "NEW1_031"]),
+		pack(["EX1_534", "DS1_070", "DS1_178", "EX1_538"]),
+		pack(["EX1_534", "DS1_070", "DS1_178", "EX1_538", "NOT_A_CARD"]),
+		pack(["EX1_539", "OG_179", "EX1_536", "UNG_915", "CFM_315"]),
+	]
+	response = client.post(
+		"/api/v1/packs/batch/", json.dumps({"packs": packs}),
+		content_type="application/json", **headers
+	)
+	assert response.status_code == 207
+	results = response.json()["results"]
+	assert len(results) == 4
+	assert "cards" in results[1]["errors"]
+	assert "NOT_A_CARD" in results[2]["errors"]["cards"][0]
+	created = Pack.objects.filter(id__in=[results[0]["id"], results[3]["id"]])
+	assert sorted(p.packcard_set.count() for p in created) == [5, 5]
@@ -0,0 +1,126 @@
+import random
+
+import pytest
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils.timezone import now
+from hearthstone.enums import CardClass, FormatType
+from hsarchetypes import classify_deck
+
+from hsreplaynet.decks import classification
+from hsreplaynet.decks.classification import (
+	SignatureMatrix, get_live_signature_version, get_signature_matrix,
+	get_signature_weights, invalidate_signature_weights
+)
+from hsreplaynet.decks.models import (
+	ClassClusterSnapshot, ClusterSetSnapshot, ClusterSnapshot
+)
+
+
+def test_signature_matrix_matches_classify_deck():
+	rng = random.Random(42)
+	card_pool = list(range(1000, 1200))
+	signature_weights = {}
+	for archetype_id in range(1, 11):
+		signature = rng.sample(card_pool, 40)
+		signature_weights[archetype_id] = {dbf_id: rng.random() for dbf_id in signature}
+
+	decks = [
+		{dbf_id: rng.randint(1, 2) for dbf_id in rng.sample(card_pool, 15)}
+		for i in range(500)
+	]
+	# Decks sharing no card with any signature
+	decks += [{1: 2, 2: 1}, {}]
+
+	signature_matrix = SignatureMatrix(signature_weights)
+	assert len(signature_matrix) == 10
+
+	expected = [classify_deck(deck, signature_weights) for deck in decks]
+	assert signature_matrix.classify(decks) == expected
+
+	# Scoring card presence rather than card counts would pick archetype 2 here
+	signature_weights = {1: {1: 1.0, 2: 1.0}, 2: {3: 0.8, 4: 0.8, 5: 0.8}}
+	deck = {1: 2, 2: 2, 3: 1, 4: 1, 5: 1}
+	expected = classify_deck(deck, signature_weights)
+	assert SignatureMatrix(signature_weights).classify([deck]) == [expected]
+
+
+def test_signature_matrix_without_signatures():
+	signature_matrix = SignatureMatrix({})
+	assert signature_matrix.classify([{1000: 2}]) == [None]
+
+	# Archetypes with empty signatures fall back to classify_deck()
+	signature_weights = {1: {}, 2: {}}
+	expected = classify_deck({1000: 2}, signature_weights)
+	assert SignatureMatrix(signature_weights).classify([{1000: 2}]) == [expected]
+
+
+@pytest.mark.django_db
+def test_signature_weights_store(mocker):
+	shared_cache = LocMemCache("signatures", {})
+	mocker.patch(
+		"hsreplaynet.decks.classification.get_shared_cache", return_value=shared_cache
+	)
+	signature_weights = {1: {1000: 0.5, 1001: 0.25}, 2: {1002: 1.0}}
+	get_signature_weights_from_db = mocker.patch(
+		"hsreplaynet.decks.models.ClusterSnapshot.objects.get_signature_weights",
+		return_value=signature_weights
+	)
+	cluster_set = ClusterSetSnapshot.objects.create(
+		game_format=FormatType.FT_STANDARD, live_in_production=True, promoted_on=now()
+	)
+	invalidate_signature_weights()
+
+	weights, version = get_signature_weights(FormatType.FT_STANDARD, CardClass.MAGE)
+	assert weights == signature_weights
+	assert version.startswith("%i:" % (cluster_set.id))
+	assert get_signature_weights_from_db.call_count == 1
+	get_signature_weights_from_db.assert_called_with(
+		FormatType.FT_STANDARD, CardClass.MAGE, cluster_set_id=cluster_set.id
+	)
+
+	# Served from the process LRU, then from the shared cache
+	assert get_signature_weights(FormatType.FT_STANDARD, CardClass.MAGE)[1] == version
+	classification._signature_weights.clear()
+	assert get_signature_weights(FormatType.FT_STANDARD, CardClass.MAGE)[1] == version
+	assert get_signature_weights_from_db.call_count == 1
+
+	signature_matrix = get_signature_matrix(FormatType.FT_STANDARD, CardClass.MAGE)
+	assert signature_matrix.version == version
+	assert signature_matrix.classify([{1002: 1}]) == [2]
+
+	# Promoting a cluster set bumps the version
+	new_cluster_set = ClusterSetSnapshot.objects.create(game_format=FormatType.FT_STANDARD)
+	new_cluster_set.update_archetype_signatures(force=True)
+	# on_commit() callbacks do not run within the test transaction
+	invalidate_signature_weights()
+	weights, new_version = get_signature_weights(FormatType.FT_STANDARD, CardClass.MAGE)
+	assert new_version.startswith("%i:" % (new_cluster_set.id))
+	assert get_signature_weights_from_db.call_count == 2
+
+
+@pytest.mark.django_db
+def test_signature_version_follows_signatures(mocker):
+	shared_cache = LocMemCache("signatures", {})
+	mocker.patch(
+		"hsreplaynet.decks.classification.get_shared_cache", return_value=shared_cache
+	)
+	cluster_set = ClusterSetSnapshot.objects.create(
+		game_format=FormatType.FT_WILD, live_in_production=True, promoted_on=now()
+	)
+	class_cluster = ClassClusterSnapshot.objects.create(
+		cluster_set=cluster_set, player_class=CardClass.DRUID
+	)
+	cluster = ClusterSnapshot.objects.create(
+		class_cluster=class_cluster, cluster_id=1, external_id=1, ccp_signature={"1000": 0.5}
+	)
+	invalidate_signature_weights()
+	version = get_live_signature_version(FormatType.FT_WILD)
+	assert get_signature_weights(FormatType.FT_WILD, CardClass.DRUID)[0] == {1: {1000: 0.5}}
+
+	# Editing the signatures of the live cluster set changes its version
+	cluster.ccp_signature = {"1000": 0.5, "1001": 0.25}
+	cluster.save()
+	invalidate_signature_weights()
+	assert get_live_signature_version(FormatType.FT_WILD) != version
+	weights, _ = get_signature_weights(FormatType.FT_WILD, CardClass.DRUID)
+	assert weights == {1: {1000: 0.5, 1001: 0.25}}
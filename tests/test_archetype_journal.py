@@ -0,0 +1,74 @@
+from datetime import datetime
+
+from hsreplaynet.decks.journal import ArchetypeChangeJournal
+
+
+AS_OF = datetime(2018, 1, 1, 12, 30)
+
+
+def test_archetype_journal_batches(mocker):
+	firehose = mocker.patch("hsreplaynet.decks.journal.FIREHOSE")
+	firehose.put_record_batch.side_effect = lambda DeliveryStreamName, Records: {
+		"FailedPutCount": 0,
+		"RequestResponses": [{"RecordId": str(i)} for i in range(len(Records))],
+	}
+	journal = ArchetypeChangeJournal(stream_name="archetypes", batch_size=3)
+
+	journal.record(1, 10, as_of=AS_OF)
+	journal.record(2, None, as_of=AS_OF)
+	assert firehose.put_record_batch.call_count == 0
+	assert len(journal) == 2
+
+	# A full batch is flushed right away
+	journal.record(3, 30, as_of=AS_OF)
+	assert firehose.put_record_batch.call_count == 1
+	assert len(journal) == 0
+	records = firehose.put_record_batch.call_args[1]["Records"]
+	assert [r["Data"] for r in records] == [
+		b"1|10|2018-01-01 12:30:00\n",
+		b"2||2018-01-01 12:30:00\n",
+		b"3|30|2018-01-01 12:30:00\n",
+	]
+
+	journal.record(4, 40, as_of=AS_OF)
+	journal.flush()
+	assert firehose.put_record_batch.call_count == 2
+	assert len(journal) == 0
+
+
+def test_archetype_journal_retries_failed_records(mocker):
+	firehose = mocker.patch("hsreplaynet.decks.journal.FIREHOSE")
+	firehose.put_record_batch.side_effect = [
+		{
+			"FailedPutCount": 1,
+			"RequestResponses": [
+				{"RecordId": "1"},
+				{"ErrorCode": "ServiceUnavailableException", "ErrorMessage": "Slow down"},
+			]
+		},
+		{"FailedPutCount": 0, "RequestResponses": [{"RecordId": "2"}]},
+	]
+	journal = ArchetypeChangeJournal(stream_name="archetypes")
+	journal.record(1, 10, as_of=AS_OF)
+	journal.record(2, 20, as_of=AS_OF)
+	journal.flush()
+
+	assert firehose.put_record_batch.call_count == 2
+	retried = firehose.put_record_batch.call_args[1]["Records"]
+	assert retried == [{"Data": b"2|20|2018-01-01 12:30:00\n"}]
+
+
+def test_archetype_journal_concurrent_flush(mocker):
+	firehose = mocker.patch("hsreplaynet.decks.journal.FIREHOSE")
+	firehose.put_record_batch.side_effect = lambda DeliveryStreamName, Records: {
+		"FailedPutCount": 0,
+		"RequestResponses": [{"RecordId": str(i)} for i in range(len(Records))],
+	}
+	journal = ArchetypeChangeJournal(stream_name="archetypes", batch_size=500, max_workers=4)
+	journal.record_many([(deck_id, 1) for deck_id in range(1, 1201)], as_of=AS_OF)
+
+	assert len(journal) == 0
+	batches = [call[1]["Records"] for call in firehose.put_record_batch.call_args_list]
+	assert sorted(len(batch) for batch in batches) == [200, 500, 500]
+	sent = sorted(int(r["Data"].split(b"|")[0]) for batch in batches for r in batch)
+	assert sent == list(range(1, 1201))
@@ -0,0 +1,34 @@
+import pytest
+from django_hearthstone.cards.models import Card
+from hearthstone.enums import CardClass, CardType
+
+from hsreplaynet.utils.cards import (
+	bump_card_data_version, get_card, get_card_lookup, invalidate_card_lookup
+)
+
+
+@pytest.mark.django_db
+def test_card_lookup(django_assert_num_queries):
+	invalidate_card_lookup()
+	lookup = get_card_lookup()
+	assert len(lookup) == Card.objects.count()
+
+	with django_assert_num_queries(0):
+		hero = get_card(card_id="HERO_05")
+		assert hero.type == CardType.HERO
+		assert hero.card_class == CardClass.HUNTER
+		assert get_card(dbf_id=hero.dbf_id) is hero
+		assert get_card(dbf_id=str(hero.dbf_id)) is hero
+
+	with pytest.raises(Card.DoesNotExist):
+		get_card(card_id="NOT_A_CARD")
+
+
+@pytest.mark.django_db
+def test_card_lookup_version():
+	lookup = get_card_lookup()
+	assert get_card_lookup() is lookup
+
+	# Saving or deleting a card bumps the version once committed
+	bump_card_data_version()
+	assert get_card_lookup() is not lookup
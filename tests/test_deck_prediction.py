@@ -1,3 +1,5 @@
+import random
+
 import fakeredis
 from hearthstone.enums import CardClass, FormatType
 
@@ -82,3 +84,72 @@ def test_prediction_tree():
 		UNOBSERVED_PLAY_SEQUENCE
 	).predicted_deck_id
 	assert lookup_result_5 is None
+
+
+def test_prediction_tree_observe_many():
+	r = fakeredis.FakeStrictRedis()
+	tree = DeckPredictionTree(
+		CardClass.MAGE,
+		FormatType.FT_STANDARD,
+		r, r,
+		max_depth=6,
+		include_current_hour=True
+	)
+
+	tree.observe_many([
+		(1, to_dbf_map(DECK_1), PLAY_SEQUENCES[1], None),
+		(2, to_dbf_map(DECK_2), PLAY_SEQUENCES[2], None),
+		(2, to_dbf_map(DECK_2), PLAY_SEQUENCES[2], None),
+	])
+	assert tree.storage.retrieve(1) == to_dbf_map(DECK_1)
+	assert tree.storage.retrieve(2) == to_dbf_map(DECK_2)
+
+	# Both decks share the first two plays, but deck 2 was observed twice
+	shared_sequence = PLAY_SEQUENCES[1][:2]
+	result = tree.lookup(to_dbf_map(shared_sequence), shared_sequence)
+	assert result.predicted_deck_id == 2
+	assert result.path() == ["ROOT"] + shared_sequence
+
+	result = tree.lookup(to_dbf_map(PLAY_SEQUENCES[1][:-1]), PLAY_SEQUENCES[1][:-1])
+	assert result.predicted_deck_id == 1
+
+
+def test_prediction_tree_server_side_lookup():
+	r = fakeredis.FakeStrictRedis()
+	trees = [
+		DeckPredictionTree(
+			CardClass.MAGE,
+			FormatType.FT_STANDARD,
+			r, r,
+			include_current_hour=True,
+			server_side_lookup=server_side_lookup
+		) for server_side_lookup in (False, True)
+	]
+	assert trees[1].use_lua
+
+	rng = random.Random(42)
+	cards = [DOOMSAYER, BLOODMAGE, LOOTHOARDER, FROSTNOVA, FIREBALL, BLIZZARD, FROSTBOLT]
+	decks = {}
+	for deck_id in range(1, 40):
+		decks[deck_id] = to_dbf_map(rng.choice(cards) for i in range(8))
+		for i in range(rng.randrange(1, 4)):
+			trees[0].observe(deck_id, decks[deck_id], rng.sample(cards, 3))
+
+	sequences = [[]] + [rng.sample(cards, rng.randrange(1, 5)) for i in range(50)]
+	for sequence in sequences:
+		dbf_map = to_dbf_map(sequence)
+		results = []
+		for tree in trees:
+			random.seed(len(sequence))
+			results.append(tree.lookup(dbf_map, sequence))
+
+		python_result, lua_result = results
+		assert lua_result.predicted_deck_id == python_result.predicted_deck_id
+		assert lua_result.match_attempts == python_result.match_attempts
+		if python_result.node:
+			assert lua_result.path() == python_result.path()
+		else:
+			assert lua_result.node is None
+
+		depths = [depth for depth, ms in lua_result.depth_latencies]
+		assert depths == [depth for depth, ms in python_result.depth_latencies]
@@ -5,6 +5,8 @@ from rest_framework.views import APIView
 
 from hsreplaynet.api.permissions import UserHasFeature
 from hsreplaynet.features.models import Feature, FeatureStatus
+from hsreplaynet.features.templatetags.features import get_feature_context
+from hsreplaynet.features.utils import get_feature_snapshot, invalidate_feature_snapshot
 
 
 class PermissionTestAPIView(APIView):
@@ -38,3 +40,27 @@ def test_user_has_feature_api_permission(user):
 	response = permission_test_api_view(request, format="json")
 	assert response.status_code == 200
 	assert response.data == {"test": "OK"}
+
+
+@pytest.mark.django_db
+def test_feature_snapshot(user, django_assert_num_queries):
+	invalidate_feature_snapshot(user)
+	for i in range(5):
+		Feature.objects.create(name="authorized-%i" % (i), status=FeatureStatus.AUTHORIZED_ONLY)
+	Feature.objects.create(name="public", status=FeatureStatus.PUBLIC)
+	Feature.objects.create(name="off", status=FeatureStatus.OFF, read_only=True)
+	Feature.objects.get(name="authorized-3").add_user_to_authorized_group(user)
+
+	# One query for the features, one for the groups of the user
+	with django_assert_num_queries(2):
+		snapshot = get_feature_snapshot(user)
+		enabled = sorted(feature.name for feature in snapshot.enabled_features())
+		assert enabled == ["authorized-3", "public"]
+		assert get_feature_snapshot(user) is snapshot
+		assert get_feature_context(user, "off") == {
+			"name": "off", "enabled": False, "read_only": True, "exists": True
+		}
+		assert not get_feature_context(user, "missing")["exists"]
+
+	Feature.objects.get(name="authorized-1").add_user_to_authorized_group(user)
+	assert get_feature_snapshot(user).is_enabled("authorized-1")
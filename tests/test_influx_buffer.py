@@ -0,0 +1,66 @@
+import time
+
+from hsreplaynet.utils.influx import InfluxBuffer
+
+
+class FakeInfluxClient:
+	def __init__(self):
+		self.writes = []
+
+	def write_points(self, points):
+		self.writes.append(list(points))
+		return True
+
+
+def _point(i):
+	return {"measurement": "test", "tags": {}, "fields": {"i": i}, "time": i}
+
+
+def test_influx_buffer_batches_points():
+	client = FakeInfluxClient()
+	buffer = InfluxBuffer(client, batch_size=3, flush_interval=60)
+	buffer._ensure_thread = lambda: None
+
+	buffer.add([_point(i) for i in range(7)])
+	assert client.writes == []
+	assert len(buffer) == 7
+
+	buffer.flush()
+	assert [len(batch) for batch in client.writes] == [3, 3, 1]
+	assert [p["fields"]["i"] for batch in client.writes for p in batch] == list(range(7))
+	assert len(buffer) == 0
+
+
+def test_influx_buffer_drops_on_overflow():
+	client = FakeInfluxClient()
+	buffer = InfluxBuffer(client, max_size=5, batch_size=100, flush_interval=60)
+	buffer._ensure_thread = lambda: None
+
+	buffer.add([_point(i) for i in range(4)])
+	buffer.add([_point(i) for i in range(4, 8)])
+	assert len(buffer) == 5
+	assert buffer.dropped == 3
+
+	buffer.flush()
+	points = client.writes[0]
+	assert [p["fields"]["i"] for p in points[:-1]] == list(range(5))
+	assert points[-1]["measurement"] == "influx_dropped_points"
+	assert points[-1]["fields"] == {"count": 3}
+
+	# Drops are only reported once
+	buffer.add([_point(8)])
+	buffer.flush()
+	assert client.writes[1] == [_point(8)]
+	assert buffer.dropped == 3
+
+
+def test_influx_buffer_background_flush():
+	client = FakeInfluxClient()
+	buffer = InfluxBuffer(client, batch_size=2, flush_interval=60)
+
+	buffer.add([_point(0), _point(1)])
+	for i in range(50):
+		if client.writes:
+			break
+		time.sleep(0.01)
+	assert [p["fields"]["i"] for batch in client.writes for p in batch] == [0, 1]
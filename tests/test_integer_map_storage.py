@@ -31,3 +31,20 @@ def test_integer_map_storage():
 		expected_deck_id = i + 1
 		partial_map = {dbf: c for dbf, c in dbf_list[:-1]}
 		assert int(storage.match(partial_map, *deck_ids)[0]) == expected_deck_id
+
+
+def test_integer_map_storage_partial_match():
+	r = fakeredis.FakeStrictRedis()
+	r.flushdb()
+
+	storage = RedisIntegerMapStorage((r, r), "DECK")
+	storage.store(1, {138: 2, 315: 1, 1382: 1})
+	storage.store(2, {13: 2, 315: 2})
+
+	assert storage.match({138: 2}, 1, 2) == ["1"]
+	assert storage.match({138: 1, 315: 1}, 2, 1) == ["1"]
+	assert storage.match({13: 1}, 1, 2) == ["2"]
+	assert storage.match({315: 2}, 1, 2) == ["2"]
+	assert storage.match({315: 1}, 2, 1) == ["2", "1"]
+	assert storage.match({138: 3}, 1, 2) == []
+	assert storage.match({}, 1, 2) == ["1", "2"]
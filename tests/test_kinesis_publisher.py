@@ -0,0 +1,69 @@
+from collections import Counter
+
+from hsreplaynet.utils.aws import streams
+from hsreplaynet.utils.aws.streams import KinesisPublisher, TokenBucket
+
+
+class FakeRecord:
+	def __init__(self, i):
+		self.id = i
+		self.kinesis_partition_key = "shortid%i" % (i)
+		self.kinesis_data = b"x" * 100
+
+
+def _shard(shard_id, start, end):
+	return {
+		"ShardId": shard_id,
+		"HashKeyRange": {"StartingHashKey": str(start), "EndingHashKey": str(end)},
+		"SequenceNumberRange": {"StartingSequenceNumber": "0"},
+	}
+
+
+def test_token_bucket(mocker):
+	clock = mocker.patch("hsreplaynet.utils.aws.streams.time.time", return_value=100.0)
+	bucket = TokenBucket(10)
+	assert bucket.delay(10) == 0
+	bucket.consume(10)
+	assert bucket.delay(5) == 0.5
+	clock.return_value = 100.5
+	assert bucket.available() == 5
+	# Amounts larger than the bucket wait for a full bucket
+	assert bucket.delay(50) == 0.5
+
+	bucket.set_rate(2)
+	assert bucket.available() == 2
+
+
+def test_kinesis_publisher_retries_failed_records(mocker):
+	mocker.patch.object(streams, "KINESIS_WRITES_PER_SEC", 100000)
+	mocker.patch.object(streams, "get_open_shards", return_value=[
+		_shard("shard-1", 2 ** 127, 2 ** 128 - 1),
+		_shard("shard-0", 0, 2 ** 127 - 1),
+	])
+	mocker.patch.object(KinesisPublisher, "RETRY_BACKOFF", 0)
+
+	attempts = Counter()
+	batches = []
+
+	def put_records(records):
+		batches.append([r.id for r in records])
+		results = []
+		for record in records:
+			attempts[record.id] += 1
+			if record.id % 3 == 0 and attempts[record.id] == 1:
+				results.append({"ErrorCode": "ProvisionedThroughputExceededException"})
+			elif record.id == 7:
+				results.append({"ErrorCode": "InternalFailure"})
+			else:
+				results.append({"SequenceNumber": "1", "ShardId": "shard"})
+		return {"FailedRecordCount": 0, "Records": results}
+
+	publisher = KinesisPublisher("stream", put_records, max_workers=2, max_attempts=3)
+	published = publisher.publish(FakeRecord(i) for i in range(1500))
+
+	assert published == 1499
+	assert publisher.failed == 1
+	assert publisher.retried == 500 + 2
+	assert attempts[7] == 3
+	assert all(attempts[i] == (2 if i % 3 == 0 else 1) for i in range(1500) if i != 7)
+	assert max(len(batch) for batch in batches) <= 500
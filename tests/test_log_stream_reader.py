@@ -0,0 +1,76 @@
+import gzip
+from io import BytesIO
+
+import pytest
+
+from hsreplaynet.uploads.utils import LogStreamReader, RetryingStream
+
+
+LOG = (
+	"D 10:00:00.0000000 GameState.DebugPrintPower() - CREATE_GAME\n"
+	"D 10:00:00.0000001 GameState.DebugPrintPower() -     Player EntityID=2 PlayerID=1\n"
+	"D 10:00:00.0000002 GameState.DebugPrintPower() - TAG_CHANGE Entity=Gul'dan ÄÖÜ\n"
+	"D 10:00:00.0000003 GameState.DebugPrintPower() - BLOCK_END"
+)
+
+
+def test_log_stream_reader():
+	data = LOG.encode("utf-8")
+	# A tiny chunk size splits lines and multi-byte characters across chunks
+	reader = LogStreamReader(BytesIO(data), chunk_size=7)
+	lines = list(reader)
+
+	assert lines == LOG.splitlines(keepends=True)
+	assert not reader.compressed
+	assert reader.bytes_read == len(data)
+	assert reader.bytes_decoded == len(data)
+
+
+def test_log_stream_reader_gzip():
+	data = LOG.encode("utf-8")
+	compressed = gzip.compress(data)
+	reader = LogStreamReader(BytesIO(compressed), chunk_size=1)
+
+	assert "".join(reader) == LOG
+	assert reader.compressed
+	assert reader.bytes_read == len(compressed)
+	assert reader.bytes_decoded == len(data)
+
+
+def test_log_stream_reader_empty():
+	reader = LogStreamReader(BytesIO(b""))
+
+	assert list(reader) == []
+	assert reader.bytes_read == 0
+
+
+def test_retrying_stream(mocker):
+	sleep = mocker.patch("hsreplaynet.uploads.utils.time.sleep")
+	data = LOG.encode("utf-8")
+	offsets = []
+
+	class FlakyStream(BytesIO):
+		def read(self, size=-1):
+			if len(offsets) == 1 and self.tell() >= 10:
+				raise TimeoutError()
+			return super().read(size)
+
+	def open_at(offset):
+		offsets.append(offset)
+		stream = FlakyStream(data)
+		stream.seek(offset)
+		return stream
+
+	reader = LogStreamReader(RetryingStream(open_at, TimeoutError), chunk_size=5)
+	assert "".join(reader) == LOG
+	assert offsets == [0, 10]
+	sleep.assert_called_once_with(1)
+
+
+def test_retrying_stream_gives_up():
+	def open_at(offset):
+		raise TimeoutError()
+
+	stream = RetryingStream(open_at, TimeoutError, max_retries=2, delay=0)
+	with pytest.raises(TimeoutError):
+		stream.read()
@@ -1,6 +1,10 @@
 import pytest
+from hearthstone.enums import CardClass
 
-from hsreplaynet.decks.models import Archetype, Deck
+from hsreplaynet.decks.models import (
+	Archetype, ClassClusterSnapshot, ClusterSetSnapshot,
+	ClusterSnapshot, Deck, _dbf_pairs_cache, get_dbf_pairs
+)
 
 
 HERO_CARD_ID = "HERO_05"
@@ -60,3 +64,89 @@ def test_deck_creation(mocker, settings):
 
 	assert deck.sync_archetype_to_firehose.call_count == 1, \
 		"The new archetype was not synced to Firehose"
+
+
+@pytest.mark.django_db
+def test_deck_get_or_create_many(settings):
+	settings.ARCHETYPE_CLASSIFICATION_ENABLED = False
+	existing, created = Deck.objects.get_or_create_from_id_list(DECK_LIST[:10])
+	assert created
+
+	results = Deck.objects.get_or_create_many([
+		DECK_LIST,
+		list(reversed(DECK_LIST[:10])),
+		[],
+		list(reversed(DECK_LIST)),
+	])
+	assert len(results) == 4
+
+	deck, created = results[0]
+	assert created
+	assert deck.size == 30
+	assert deck.archetype_id is None
+	assert deck == Deck.objects.get(id=deck.id)
+	assert sorted(deck.card_id_list()) == sorted(DECK_LIST)
+
+	assert results[1] == (existing, False)
+	assert results[1][0].created == existing.created
+	assert results[2][0].size is None
+	assert results[3] == (deck, False)
+
+
+@pytest.mark.django_db
+def test_deck_dbf_pairs(settings, django_assert_num_queries):
+	settings.ARCHETYPE_CLASSIFICATION_ENABLED = False
+	deck, _ = Deck.objects.get_or_create_from_id_list(DECK_LIST)
+	partial_deck, _ = Deck.objects.get_or_create_from_id_list(DECK_LIST[:3])
+	_dbf_pairs_cache.clear()
+
+	with django_assert_num_queries(1):
+		dbf_pairs = get_dbf_pairs([deck.id, partial_deck.id])
+		assert len(dbf_pairs[deck.id]) == 15
+		assert sum(count for _, count in dbf_pairs[deck.id]) == 30
+		assert list(dbf_pairs[deck.id]) == sorted(dbf_pairs[deck.id])
+		assert sum(count for _, count in dbf_pairs[partial_deck.id]) == 3
+
+		# Subsequent reads are served from the per-process cache
+		assert deck.dbf_map() == dict(dbf_pairs[deck.id])
+		assert deck.card_dbf_id_packed_list == list(dbf_pairs[deck.id])
+		assert sorted(deck.card_dbf_id_list()) == deck.card_dbf_id_list()
+		assert len(deck.card_dbf_id_list()) == 30
+		assert deck.as_dbf_json(serialized=False) == [list(p) for p in dbf_pairs[deck.id]]
+
+
+@pytest.mark.django_db
+def test_synchronize_deck_archetype_assignments(mocker, settings):
+	settings.ARCHETYPE_CLASSIFICATION_ENABLED = False
+	record_many = mocker.patch("hsreplaynet.decks.models.archetype_journal.record_many")
+	beast_hunter = Archetype.objects.create(name="Beast Hunter")
+	deck, _ = Deck.objects.get_or_create_from_id_list(DECK_LIST)
+	partial_deck, _ = Deck.objects.get_or_create_from_id_list(DECK_LIST[:10])
+	other_deck, _ = Deck.objects.get_or_create_from_id_list(DECK_LIST[:5])
+
+	cluster_set = ClusterSetSnapshot.objects.create()
+	class_cluster = ClassClusterSnapshot.objects.create(
+		cluster_set=cluster_set, player_class=CardClass.HUNTER
+	)
+	ClusterSnapshot.objects.create(
+		class_cluster=class_cluster,
+		cluster_id=1,
+		external_id=beast_hunter.id,
+		data_points=[{"shortid": deck.shortid}, {"shortid": partial_deck.shortid}],
+	)
+	ClusterSnapshot.objects.create(
+		class_cluster=class_cluster,
+		cluster_id=-1,
+		external_id=-1,
+		data_points=[{"shortid": other_deck.shortid}],
+	)
+
+	cluster_set.synchronize_deck_archetype_assignments(chunk_size=1)
+
+	assert Deck.objects.get(id=deck.id).archetype_id == beast_hunter.id
+	assert Deck.objects.get(id=partial_deck.id).archetype_id == beast_hunter.id
+	assert Deck.objects.get(id=other_deck.id).archetype_id is None
+	journaled = [change for call in record_many.call_args_list for change in call[0][0]]
+	assert sorted(journaled) == sorted([
+		(deck.id, beast_hunter.id), (partial_deck.id, beast_hunter.id)
+	])
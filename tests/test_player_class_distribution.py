@@ -3,9 +3,13 @@ from datetime import datetime, timedelta
 from random import randrange
 
 import fakeredis
+import pytest
 from hearthstone.enums import CardClass
 
-from hsreplaynet.live.distributions import get_player_class_distribution
+from hsreplaynet.live.distributions import (
+	LiveStatsUpdate, get_played_cards_distribution,
+	get_player_class_distribution, get_player_class_distribution_series
+)
 
 
 def test_player_class_distribution():
@@ -43,3 +47,85 @@ def test_player_class_distribution():
 		player_class_data = data[player_class.name]
 		assert player_class_data["games"] == actual_games[player_class.name]
 		assert player_class_data["wins"] == actual_wins[player_class.name]
+
+
+def test_player_class_distribution_series():
+	redis = fakeredis.FakeStrictRedis()
+	series = get_player_class_distribution_series("BGT_RANKED_STANDARD", redis)
+	assert series.size == 61
+
+	current_ts = datetime.utcnow()
+	most_recent_tick_ts = current_ts - timedelta(
+		seconds=current_ts.second % 5 + 5, microseconds=current_ts.microsecond
+	)
+	for i in range(600):
+		ts = most_recent_tick_ts - timedelta(seconds=i)
+		series.distribution.increment(CardClass(2 + i % 9).name, win=i % 2, as_of=ts)
+
+	assert series.series(most_recent_tick_ts) == []
+	assert series.update(most_recent_tick_ts) == 61
+	assert series.update(most_recent_tick_ts) == 0
+
+	result = series.series(most_recent_tick_ts)
+	ticks = list(series.ticks(most_recent_tick_ts))
+	assert [entry["ts"] for entry in result] == [int(ts.timestamp()) for ts in ticks]
+	for entry, end_ts in zip(result, ticks):
+		assert entry["data"] == series.distribution.distribution(
+			start_ts=end_ts - timedelta(seconds=300), end_ts=end_ts
+		)
+
+	# Until the next tick is appended, the last series is served
+	next_tick_ts = most_recent_tick_ts + timedelta(seconds=5)
+	assert series.series(next_tick_ts) == result
+	assert redis.llen(series.key) == 61
+
+	# Then the oldest tick drops out of the ring buffer
+	assert series.update(next_tick_ts) == 1
+	assert len(redis.lrange(series.key, 0, -1)) == 61
+	assert series.series(next_tick_ts)[-1]["ts"] == int(next_tick_ts.timestamp())
+	assert series.series(next_tick_ts)[0]["ts"] == result[1]["ts"]
+	# Older series can still be read
+	assert series.series(most_recent_tick_ts) == result[1:]
+
+
+def test_player_class_distribution_series_releases_failed_ticks(mocker):
+	redis = fakeredis.FakeStrictRedis()
+	series = get_player_class_distribution_series("BGT_RANKED_STANDARD", redis)
+	most_recent_tick_ts = datetime.utcnow().replace(microsecond=0)
+	most_recent_tick_ts -= timedelta(seconds=most_recent_tick_ts.second % 5)
+
+	mocker.patch.object(series.distribution, "distribution", side_effect=ConnectionError)
+	with pytest.raises(ConnectionError):
+		series.update(most_recent_tick_ts)
+
+	# The tick which failed is not left claimed
+	mocker.stopall()
+	assert series.update(most_recent_tick_ts) == 61
+
+
+def test_live_stats_update():
+	redis = fakeredis.FakeStrictRedis()
+	as_of = datetime.utcnow() - timedelta(seconds=30)
+	live_stats = LiveStatsUpdate()
+
+	first_replay = LiveStatsUpdate()
+	first_replay.add_player_class("BGT_RANKED_STANDARD", "MAGE", win=True, as_of=as_of)
+	first_replay.add_played_cards("BGT_RANKED_STANDARD", [1, 2, 2], as_of=as_of)
+	live_stats.extend(first_replay)
+	live_stats.add_player_class("BGT_RANKED_STANDARD", "MAGE", as_of=as_of)
+	live_stats.add_player_class("BGT_ARENA", "ROGUE", win=True, as_of=as_of)
+	live_stats.add_played_cards("BGT_ARENA", [3], as_of=as_of)
+	assert len(live_stats) == 7
+
+	live_stats.execute(redis_client=redis)
+	assert len(live_stats) == 0
+
+	start_ts = as_of - timedelta(seconds=60)
+	end_ts = as_of + timedelta(seconds=10)
+	standard = get_player_class_distribution("BGT_RANKED_STANDARD", redis)
+	assert standard.distribution(start_ts, end_ts) == {"MAGE": {"games": 2, "wins": 1}}
+	arena = get_player_class_distribution("BGT_ARENA", redis)
+	assert arena.distribution(start_ts, end_ts) == {"ROGUE": {"games": 1, "wins": 1}}
+
+	played_cards = get_played_cards_distribution("BGT_RANKED_STANDARD", redis)
+	assert played_cards.distribution(start_ts, end_ts) == {"1": 1, "2": 2}
@@ -5,7 +5,7 @@ from math import ceil
 
 import fakeredis
 
-from hsreplaynet.utils.redis import RedisPopularityDistribution
+from hsreplaynet.utils.redis import RedisPopularityDistribution, TrackedSpaceSavingSketch
 
 
 DECKS = [
@@ -105,35 +105,38 @@ def test_bucket_sizes_and_ttls():
 		bucket_size=1
 	)
 
-	# Create t_0 as 5 seconds in the past
-	current_ts = datetime.utcnow()
-	td = timedelta(seconds=5, microseconds=current_ts.microsecond)
-	t_0 = current_ts - td
+	# Pin t_0 to the start of a bucket, 3 seconds in the past, so that none of the
+	# buckets below expires while the test runs
+	t_0 = datetime.utcnow().replace(microsecond=0) - timedelta(seconds=3)
 
 	def t_N(N):
 		return t_0 + timedelta(seconds=N)
 
-	distribution.increment("A", as_of=t_N(1))
-	distribution.increment("B", as_of=t_N(2))
+	distribution.increment("A", as_of=t_N(0))
+	distribution.increment("B", as_of=t_N(1))
+	distribution.increment("A", as_of=t_N(2))
 	distribution.increment("A", as_of=t_N(3))
-	distribution.increment("A", as_of=t_N(4))
 
 	# First assert the full distribution exists
 	expected_distribution = {"A": 3.0, "B": 1.0}
-	actual_distribution = distribution.distribution()
+	actual_distribution = distribution.distribution(start_ts=t_N(0), end_ts=t_N(3))
 	assert expected_distribution == actual_distribution
 
-	# Then assert accessing a partial distribution (t_2, t_3) within the full time range
+	# Then assert accessing a partial distribution (t_1, t_2) within the full time range
 	expected_distribution = {"A": 1.0, "B": 1.0}
-	actual_distribution = distribution.distribution(start_ts=t_N(2), end_ts=t_N(3))
+	actual_distribution = distribution.distribution(start_ts=t_N(1), end_ts=t_N(2))
 	assert expected_distribution == actual_distribution
 
-	# Finally, assert that the first observation of "A" has aged out due to the TTL
-	time.sleep(1)
-
-	expected_distribution = {"A": 2.0, "B": 1}
-	actual_distribution = distribution.distribution()
-	assert expected_distribution == actual_distribution
+	# Finally, assert that each bucket expires ttl seconds after it ends, so that the
+	# first observation of "A" ages out first
+	for N in range(4):
+		start_token = distribution._to_start_token(t_N(N))
+		end_token = distribution._to_end_token(t_N(N))
+		assert end_token == start_token
+		expire_at = distribution._to_expire_at(t_N(N))
+		assert expire_at == end_token + 5
+		ttl = r.pttl(distribution._bucket_key(start_token, end_token)) / 1000
+		assert abs(ttl - (expire_at - time.time())) < 1
 
 
 def test_bucket_sizes():
@@ -166,3 +169,123 @@ def test_bucket_sizes():
 		# Assert the total number of buckets matches the expected number
 		expected_num_buckets = ceil((end_token - yesterday_start_token) / bucket_size)
 		assert len(buckets) == expected_num_buckets
+
+
+def test_incremental_summaries():
+	r = fakeredis.FakeStrictRedis()
+	distribution = RedisPopularityDistribution(r, "DECKS", ttl=600, bucket_size=5)
+
+	# Buckets of the last 5 minutes, all of which have ended
+	t_0 = datetime.utcnow() - timedelta(seconds=300)
+	t_0 = t_0 - timedelta(seconds=t_0.second % 5, microseconds=t_0.microsecond)
+	observations = defaultdict(lambda: defaultdict(int))
+	for i in range(40):
+		for deck in DECKS[i % len(DECKS):][:3]:
+			distribution.increment(deck, as_of=t_0 + timedelta(seconds=5 * i))
+			observations[i][str(deck)] += 1
+
+	def expected_distribution(first, last):
+		result = defaultdict(int)
+		for i in range(first, last + 1):
+			for deck, count in observations[i].items():
+				result[deck] += count
+		return dict(result)
+
+	window = 12
+	for first in range(0, 40 - window):
+		start_ts = t_0 + timedelta(seconds=5 * first)
+		end_ts = start_ts + timedelta(seconds=5 * window - 1)
+		actual = distribution.distribution(start_ts=start_ts, end_ts=end_ts)
+		assert actual == expected_distribution(first, first + window - 1)
+
+	# The next window is built from the previous summary rather than from the buckets
+	start_ts = t_0 + timedelta(seconds=5 * (40 - window))
+	end_ts = start_ts + timedelta(seconds=5 * window - 1)
+	r.delete(distribution._bucket_key(
+		distribution._to_start_token(start_ts),
+		distribution._to_end_token(start_ts)
+	))
+	actual = distribution.distribution(start_ts=start_ts, end_ts=end_ts)
+	assert actual == expected_distribution(40 - window, 39)
+
+
+def test_summaries_with_missing_inputs():
+	r = fakeredis.FakeStrictRedis()
+	distribution = RedisPopularityDistribution(r, "DECKS", ttl=600, bucket_size=5)
+
+	t_0 = datetime.utcnow() - timedelta(seconds=300)
+	t_0 = t_0 - timedelta(seconds=t_0.second % 5, microseconds=t_0.microsecond)
+	for i in range(10):
+		distribution.increment("A", as_of=t_0 + timedelta(seconds=5 * i))
+		distribution.increment(str(i), as_of=t_0 + timedelta(seconds=5 * i))
+
+	def window(first):
+		start_ts = t_0 + timedelta(seconds=5 * first)
+		return start_ts, start_ts + timedelta(seconds=5 * 4 - 1)
+
+	assert distribution.distribution(*window(0)) == {"A": 4, "0": 1, "1": 1, "2": 1, "3": 1}
+
+	# When the bucket leaving the window is gone, the summary of the previous window
+	# cannot be used, since it still holds that bucket
+	start_ts, end_ts = window(0)
+	r.delete(distribution._bucket_key(
+		distribution._to_start_token(start_ts), distribution._to_end_token(start_ts)
+	))
+	assert distribution.distribution(*window(1)) == {"A": 4, "1": 1, "2": 1, "3": 1, "4": 1}
+
+	# Summaries stored under the unversioned key names are ignored
+	start_ts, end_ts = window(2)
+	r.zadd(distribution._bucket_key(
+		distribution._to_start_token(start_ts), distribution._to_end_token(end_ts)
+	), {"B": 100})
+	assert distribution.distribution(*window(2)) == {"A": 4, "2": 1, "3": 1, "4": 1, "5": 1}
+
+
+def test_summaries_with_current_bucket():
+	r = fakeredis.FakeStrictRedis()
+	distribution = RedisPopularityDistribution(r, "DECKS", ttl=600, bucket_size=5)
+
+	start_ts = datetime.utcnow() - timedelta(seconds=60)
+	distribution.increment("A", as_of=start_ts)
+	distribution.increment("B", as_of=start_ts)
+	distribution.increment("A")
+	assert distribution.distribution(start_ts=start_ts) == {"A": 2, "B": 1}
+
+	# The open bucket is not part of the cached summary
+	distribution.increment("B")
+	distribution.increment("B")
+	assert distribution.distribution(start_ts=start_ts) == {"A": 2, "B": 3}
+
+
+def test_space_saving_error_bounds():
+	r = fakeredis.FakeStrictRedis()
+	distribution = RedisPopularityDistribution(
+		r, "DECKS", max_items=5, sketch=TrackedSpaceSavingSketch
+	)
+
+	actuals = defaultdict(int)
+	for deck in DECKS:
+		actuals[str(deck)] += 1
+		distribution.increment(deck)
+
+	dist = distribution.distribution()
+	assert len(dist) == 5
+	assert sum(dist.values()) == len(DECKS)
+
+	# Every count is overestimated by at most its tracked error,
+	# which is bounded by the smallest count and by N / max_items
+	error_bound = distribution.error_bound()
+	assert 0 < error_bound <= len(DECKS) / 5
+	error_bounds = distribution.error_bounds()
+	for deck, count in dist.items():
+		error = error_bounds.get(deck, 0)
+		assert error <= error_bound
+		assert count - error <= actuals[deck] <= count
+
+	# Missing decks were seen at most error_bound times
+	for deck, count in actuals.items():
+		if deck not in dist:
+			assert count <= error_bound
+
+	# The most popular deck is seen more than N / max_items times, so it is kept
+	assert dist["293400890"] - error_bounds.get("293400890", 0) <= 8 <= dist["293400890"]
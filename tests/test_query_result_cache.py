@@ -0,0 +1,104 @@
+import threading
+from datetime import datetime
+
+from hsreplaynet.analytics.cache import QueryResultCache
+
+
+class FakeQuery:
+	is_personalized = False
+	response_payload_type = "application/json"
+
+	def __init__(self, cache_key, payload='{"series": []}', as_of=datetime(2018, 1, 1)):
+		self.cache_key = cache_key
+		self.payload = payload
+		self.result_as_of = as_of
+		self.result_available = True
+		self.payload_reads = 0
+
+	@property
+	def response_payload_data(self):
+		self.payload_reads += 1
+		return self.payload
+
+
+def test_query_result_cache(mocker):
+	clock = mocker.patch("hsreplaynet.analytics.cache.time.time", return_value=1000)
+	cache = QueryResultCache(ttl=30, max_bytes=1024)
+	query = FakeQuery("q1")
+	on_load = mocker.Mock()
+
+	result, from_memory = cache.get(query, on_load=on_load)
+	assert not from_memory
+	assert result.content == query.payload
+	assert result.last_modified == 1514764800
+	assert on_load.call_count == 1
+
+	result, from_memory = cache.get(query, on_load=on_load)
+	assert from_memory
+	assert query.payload_reads == 1
+	assert on_load.call_count == 1
+
+	# Expired entries whose result did not change are not read again
+	clock.return_value = 1031
+	result, from_memory = cache.get(query, on_load=on_load)
+	assert not from_memory
+	assert query.payload_reads == 1
+	assert on_load.call_count == 2
+
+	clock.return_value = 1062
+	query.result_as_of = datetime(2018, 1, 2)
+	query.payload = '{"series": [1]}'
+	result, _ = cache.get(query)
+	assert result.content == query.payload
+	assert query.payload_reads == 2
+
+	clock.return_value = 1093
+	query.result_available = False
+	assert cache.get(query) == (None, False)
+	assert len(cache) == 0
+	assert cache.size == 0
+
+
+def test_query_result_cache_eviction():
+	cache = QueryResultCache(ttl=30, max_bytes=20)
+	cache.get(FakeQuery("q1", payload="a" * 10))
+	cache.get(FakeQuery("q2", payload="b" * 10))
+	cache.get(FakeQuery("q1"))
+	cache.get(FakeQuery("q3", payload="c" * 10))
+	assert list(cache._entries) == ["q1", "q3"]
+	assert cache.size == 20
+
+	# Results larger than the whole cache are served but not kept
+	result, _ = cache.get(FakeQuery("q4", payload="d" * 21))
+	assert len(result) == 21
+	assert "q4" not in cache._entries
+
+
+def test_query_result_cache_single_flight():
+	cache = QueryResultCache(ttl=30, max_bytes=1024)
+	query = FakeQuery("q1")
+	loading = threading.Event()
+	release = threading.Event()
+
+	def on_load(parameterized_query):
+		loading.set()
+		release.wait(5)
+
+	results = []
+
+	def fetch():
+		results.append(cache.get(query, on_load=on_load)[0])
+
+	leader = threading.Thread(target=fetch)
+	leader.start()
+	loading.wait(5)
+	followers = [threading.Thread(target=fetch) for i in range(4)]
+	for thread in followers:
+		thread.start()
+	release.set()
+	for thread in [leader] + followers:
+		thread.join(5)
+
+	assert len(results) == 5
+	assert all(result is results[0] for result in results)
+	assert query.payload_reads == 1
@@ -1,5 +1,6 @@
 import json
 import os
+from unittest.mock import MagicMock
 
 import pytest
 from django.core.files.storage import default_storage
@@ -7,8 +8,10 @@ from hearthstone.enums import CardType
 
 from hearthsim.identity.accounts.models import AuthToken
 from hearthsim.identity.api.models import APIKey
-from hsreplaynet.lambdas.uploads import process_raw_upload
+from hsreplaynet.games.processing import process_upload_events, save_replay_file
+from hsreplaynet.lambdas.uploads import prepare_raw_upload, process_raw_upload
 from hsreplaynet.uploads.models import UploadEvent, _generate_upload_key
+from hsreplaynet.uploads.processing import queue_upload_events_for_reprocessing
 
 from .conftest import UPLOAD_SUITE
 
@@ -120,9 +123,71 @@ def test_upload_regression_suite():
 		do_process_raw_upload(raw_upload, is_reprocessing=True)
 
 
+@pytest.mark.django_db
+def test_upload_regression_suite_batch():
+	raw_uploads = [
+		MockRawUpload(os.path.join(UPLOAD_SUITE, shortid), default_storage)
+		for shortid in os.listdir(UPLOAD_SUITE)
+	]
+	upload_events = [prepare_raw_upload(raw_upload, True) for raw_upload in raw_uploads]
+	results = process_upload_events(upload_events, max_workers=1)
+	assert len(results) == len(raw_uploads)
+
+	for raw_upload in raw_uploads:
+		validate_processed_raw_upload(raw_upload)
+
+
+@pytest.mark.django_db
+def test_upload_regression_suite_batch_in_process_pool():
+	raw_uploads = [
+		MockRawUpload(os.path.join(UPLOAD_SUITE, shortid), default_storage)
+		for shortid in os.listdir(UPLOAD_SUITE)
+	]
+	upload_events = [prepare_raw_upload(raw_upload, True) for raw_upload in raw_uploads]
+	# The parsers are pickled back from the worker processes
+	results = process_upload_events(upload_events, max_workers=2)
+	assert len(results) == len(raw_uploads)
+	assert all(replay is not None for upload_event, replay in results)
+
+	for raw_upload in raw_uploads:
+		validate_processed_raw_upload(raw_upload)
+
+
+@pytest.mark.django_db
+def test_queue_upload_events_for_reprocessing(mocker, django_assert_num_queries):
+	from django.utils.timezone import now
+
+	for i in range(3):
+		shortid = "reprocessingtestevnt%02i" % (i)
+		UploadEvent.objects.create(
+			shortid=shortid, file=_generate_upload_key(now(), shortid),
+			descriptor_data=json.dumps({"shortid": shortid}),
+		)
+
+	published = []
+	fill_stream = mocker.patch("hsreplaynet.utils.aws.streams.fill_stream_from_iterable")
+	fill_stream.side_effect = lambda stream_name, iterable, func: published.extend(iterable)
+
+	events = UploadEvent.objects.filter(shortid__startswith="reprocessingtestevnt")
+	# One query to count the events, one to stream them
+	with django_assert_num_queries(2):
+		count = queue_upload_events_for_reprocessing(events, use_kinesis=True)
+
+	assert count == 3
+	assert sorted(raw_upload.shortid for raw_upload in published) == [
+		"reprocessingtestevnt%02i" % (i) for i in range(3)
+	]
+	assert all(raw_upload.attempt_reprocessing for raw_upload in published)
+	# The descriptor is loaded lazily, from the event the RawUpload was built from
+	assert published[0].descriptor == {"shortid": published[0].shortid}
+
+
 def do_process_raw_upload(raw_upload, is_reprocessing):
 	process_raw_upload(raw_upload, is_reprocessing)
+	validate_processed_raw_upload(raw_upload)
 
+
+def validate_processed_raw_upload(raw_upload):
 	# Begin asserting correctness
 	created_upload_event = UploadEvent.objects.get(shortid=raw_upload.shortid)
 	assert str(created_upload_event.token.key) == str(raw_upload.auth_token.key)
@@ -201,3 +266,26 @@ def test_validate_upload_date():
 		# assert expected.tzinfo == match_start.tzinfo
 		assert ret.tzinfo == match_start.tzinfo
 		assert ret == expected
+
+
+def test_save_replay_file(mocker):
+	delete_replay_file = mocker.patch("hsreplaynet.games.processing.delete_replay_file")
+	replay = MagicMock()
+	replay.replay_xml.name = "replays/abc.hsreplay.xml"
+
+	def save(name, content, save):
+		# The storage gives the file a different name, as the path is taken
+		replay.replay_xml.name = "replays/abc_1234567.hsreplay.xml"
+
+	replay.replay_xml.save.side_effect = save
+	save_replay_file(replay, "<HSReplay/>", previous_filename="replays/abc.hsreplay.xml")
+	replay.save.assert_called_once_with(update_fields=["replay_xml"])
+	delete_replay_file.assert_called_once_with("replays/abc.hsreplay.xml")
+
+	# The same name is neither saved again nor deleted
+	replay.reset_mock()
+	delete_replay_file.reset_mock()
+	replay.replay_xml.save.side_effect = None
+	save_replay_file(replay, "<HSReplay/>", previous_filename=replay.replay_xml.name)
+	assert not replay.save.called
+	assert not delete_replay_file.called
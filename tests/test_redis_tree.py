@@ -30,3 +30,18 @@ def test_tree_node():
 	child3 = child1.get_child("CHILD3", create=True)
 	assert child3
 	assert child3.key == "TREE:DECK_PREDICTION:NODE:ROOT->CHILD1->CHILD3"
+
+
+def test_tree_node_add_child_pipelined():
+	r = fakeredis.FakeStrictRedis()
+	tree = RedisTree(r, "DECK_PREDICTION", ttl=60)
+
+	pipeline = r.pipeline(transaction=False)
+	child = tree.root.add_child("CHILD1", pipeline=pipeline)
+	assert child.key == "TREE:DECK_PREDICTION:NODE:ROOT->CHILD1"
+	assert not r.sismember(tree.root.children_key, "CHILD1")
+
+	pipeline.execute()
+	assert r.sismember(tree.root.children_key, "CHILD1")
+	assert 0 < r.ttl(tree.root.children_key) <= 60
+	assert tree.root.get_child("CHILD1").key == child.key
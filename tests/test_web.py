@@ -19,3 +19,23 @@ def test_load_homepage(client, settings, mocker):
 
 	response = client.get("/")
 	assert response.status_code == 200
+
+
+@pytest.mark.django_db
+def test_premium_context_processor_anonymous(rf, django_assert_num_queries):
+	from django.contrib.auth.models import AnonymousUser
+	from hsreplaynet.billing.utils import get_plan_catalogue, invalidate_plan_catalogue
+	from hsreplaynet.web.context_processors import premium
+
+	invalidate_plan_catalogue()
+	with django_assert_num_queries(2):
+		get_plan_catalogue()
+
+	request = rf.get("/")
+	request.user = AnonymousUser()
+	with django_assert_num_queries(0):
+		context = premium(request)
+
+	assert not context["premium"]
+	assert not context["has_subscription_past_due"]
+	assert "stripe_monthly_plan" in context
@@ -1,8 +1,16 @@
 import re
+import time
 from hashlib import sha256
 from hmac import HMAC
+from unittest.mock import MagicMock
 
-from hsreplaynet.webhooks.models import generate_signature
+import pytest
+from django.contrib.auth import get_user_model
+
+from hsreplaynet.webhooks.models import (
+	Event, OutboxEvent, Webhook, WebhookEndpoint, WebhookStatus, generate_signature
+)
+from hsreplaynet.webhooks.outbox import dispatch_outbox, queue_outbox_event
 
 
 def test_signature_generation():
@@ -25,3 +33,127 @@ def test_signature_generation():
 	expected_sig = HMAC(key, expected_msg, digestmod=sha256)
 
 	assert sha == expected_sig.hexdigest()
+
+
+def _response(status_code):
+	return MagicMock(status_code=status_code, headers={}, text="")
+
+
+@pytest.mark.django_db
+def test_event_webhook_fan_out(mocker, settings):
+	settings.WEBHOOKS = dict(settings.WEBHOOKS, USE_LAMBDA=False)
+	sleep = mocker.patch("hsreplaynet.webhooks.delivery.time.sleep")
+	user = get_user_model().objects.create(username="webhook_user")
+	ok_endpoint = WebhookEndpoint.objects.create(user=user, url="https://example.com/ok/")
+	flaky_endpoint = WebhookEndpoint.objects.create(user=user, url="https://example.org/x/")
+	WebhookEndpoint.objects.create(user=user, url="https://example.net/", is_active=False)
+
+	responses = {ok_endpoint.url: [_response(200)], flaky_endpoint.url: [
+		_response(503), _response(502), _response(200)
+	]}
+	session = MagicMock()
+	session.prepare_request.side_effect = lambda request: MagicMock(
+		url=request.url, headers=request.headers
+	)
+	session.send.side_effect = lambda request, **kwargs: responses[request.url].pop(0)
+	mocker.patch("hsreplaynet.webhooks.delivery.get_session", return_value=session)
+
+	event = Event.objects.create(user=user, type="replay.created", data={"shortid": "x"})
+	event.create_webhooks()
+
+	webhooks = {w.url: w for w in Webhook.objects.filter(event=event)}
+	assert len(webhooks) == 2
+	assert webhooks[ok_endpoint.url].status == WebhookStatus.SUCCESS
+	assert webhooks[ok_endpoint.url].deliveries.count() == 1
+	assert webhooks[flaky_endpoint.url].status == WebhookStatus.SUCCESS
+	deliveries = webhooks[flaky_endpoint.url].deliveries.all()
+	assert sorted(d.response_status for d in deliveries) == [200, 502, 503]
+	assert sum(d.success for d in deliveries) == 1
+	assert sleep.call_count == 2
+
+
+def test_webhook_retries(mocker):
+	from requests.exceptions import ConnectionError, ReadTimeout
+	from hsreplaynet.webhooks.delivery import _send_webhook
+
+	mocker.patch("hsreplaynet.webhooks.delivery.time.sleep")
+	session = MagicMock()
+	mocker.patch("hsreplaynet.webhooks.delivery.get_session", return_value=session)
+	webhook = Webhook(url="https://example.com/", payload={})
+	webhook.endpoint = WebhookEndpoint(url=webhook.url, timeout=10)
+
+	# Connection errors are retried, read timeouts are not
+	session.send.side_effect = [ConnectionError(), ReadTimeout(), _response(200)]
+	deliveries = []
+	assert _send_webhook(webhook, deliveries, 3, 0.5) == WebhookStatus.ERROR
+	assert len(deliveries) == 2
+
+	# No attempt is started which could not complete before the deadline
+	session.send.side_effect = lambda request, **kwargs: _response(503)
+	deliveries = []
+	_send_webhook(webhook, deliveries, 3, 0.5, deadline=time.time() + 2)
+	assert len(deliveries) == 2
+	assert session.send.call_args[1]["timeout"] < 2
+
+
+@pytest.mark.django_db
+def test_outbox_dispatch(mocker, settings):
+	settings.WEBHOOKS = dict(settings.WEBHOOKS, USE_LAMBDA=True)
+	mocker.patch.dict("hsreplaynet.webhooks.outbox.OUTBOX_SERIALIZERS", {
+		"test.created": lambda ids: {id: {"id": id} for id in ids if id != "missing"}
+	})
+	schedule = mocker.patch("hsreplaynet.webhooks.models.schedule_webhook_deliveries")
+	user = get_user_model().objects.create(username="outbox_user")
+	other_user = get_user_model().objects.create(username="outbox_user_2")
+	WebhookEndpoint.objects.create(user=user, url="https://example.com/1/")
+	WebhookEndpoint.objects.create(user=user, url="https://example.com/2/")
+	WebhookEndpoint.objects.create(user=other_user, url="https://example.com/3/")
+
+	queue_outbox_event(user, "test.created", "a")
+	queue_outbox_event(other_user, "test.created", "b")
+	queue_outbox_event(user, "test.created", "missing")
+	assert not Event.objects.exists()
+
+	assert dispatch_outbox(batch_size=2) == 3
+	assert not OutboxEvent.objects.exists()
+
+	events = {e.data["id"]: e for e in Event.objects.all()}
+	assert sorted(events) == ["a", "b"]
+	assert events["a"].webhooks.count() == 2
+	assert events["b"].webhooks.get().payload["data"] == {"id": "b"}
+	scheduled = [w for call in schedule.call_args_list for w in call[0][0]]
+	assert len(scheduled) == 3
+	assert all(w.status == WebhookStatus.PENDING for w in scheduled)
+
+
+@pytest.mark.django_db
+def test_outbox_dispatch_scheduling_error(mocker, settings):
+	settings.WEBHOOKS = dict(settings.WEBHOOKS, USE_LAMBDA=True)
+	mocker.patch.dict("hsreplaynet.webhooks.outbox.OUTBOX_SERIALIZERS", {
+		"test.created": lambda ids: {id: {"id": id} for id in ids}
+	})
+	mocker.patch(
+		"hsreplaynet.webhooks.models.schedule_webhook_deliveries", side_effect=ValueError
+	)
+	user = get_user_model().objects.create(username="outbox_error_user")
+	WebhookEndpoint.objects.create(user=user, url="https://example.com/1/")
+	queue_outbox_event(user, "test.created", "a")
+
+	with pytest.raises(ValueError):
+		dispatch_outbox()
+
+	assert not OutboxEvent.objects.exists()
+	assert Webhook.objects.get().status == WebhookStatus.ERROR
+
+
+def test_outbox_replay_serialization_errors(mocker):
+	from hsreplaynet.webhooks.outbox import serialize_replays
+
+	good = MagicMock(shortid="good", serialize=lambda: {"shortid": "good"})
+	bad = MagicMock(shortid="bad", serialize=MagicMock(side_effect=ValueError))
+	objects = mocker.patch("hsreplaynet.games.models.GameReplay.objects")
+	objects.filter.return_value.select_related.return_value = [bad, good]
+	error_handler = mocker.patch("hsreplaynet.webhooks.outbox.error_handler")
+
+	assert serialize_replays(["bad", "good"]) == {"good": {"shortid": "good"}}
+	assert error_handler.call_count == 1